@@ -1,4 +1,6 @@
 import streamlit as st
+from data_refresh import foreground_work, start_refresh_worker
+from utils.page_components import supersede_previous_run
 
 pages = {
     "Business Analytics ": [
@@ -9,4 +11,11 @@ pages = {
 }
 
 pg = st.navigation(pages)
-pg.run()
+
+# Rebuild the page data in the background before it expires (no-op once running)
+start_refresh_worker()
+
+# Queries left running by the previous page are cancelled when this run starts, and
+# background builds and refreshes wait until the page has rendered
+with supersede_previous_run(), foreground_work():
+    pg.run()
@@ -0,0 +1,249 @@
+"""
+Benchmark every analysis in utils/, the streaming exports and the attribution
+models against a synthetic stand-in database.
+
+Each analysis runs in a fresh process so its peak RSS is its own. Wall time and
+rows/sec are recorded per analysis and per stage, and compared with a saved baseline;
+any measurement more than --tolerance above the baseline fails the run.
+
+Usage:
+    python benchmarks/synthetic_data.py --size 1m
+    python benchmarks/run_benchmarks.py benchmarks/data/synthetic_1m.db --save-baseline
+    python benchmarks/run_benchmarks.py benchmarks/data/synthetic_1m.db
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sqlite3
+import sys
+import time
+import traceback
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Source tables each analysis reads, used for rows/sec
+ANALYSIS_TABLES = {
+    'customer_segment': ['CUSTOMERS', 'CUSTOMERS_EXTRA'],
+    'omnichannel': ['CUSTOMERS', 'CUSTOMERS_EXTRA', 'TRANSACTIONS', 'TRANSACTIONS_EXTRA'],
+    'true_cac': ['CUSTOMERS', 'CUSTOMERS_EXTRA', 'CUSTOMER_TOUCHPOINTS', 'CUSTOMER_TOUCHPOINTS_EXTRA', 'MARKETING_SPEND'],
+    'export': ['TRANSACTIONS'],
+    'attribution': ['CUSTOMERS', 'CUSTOMERS_EXTRA', 'CUSTOMER_TOUCHPOINTS', 'CUSTOMER_TOUCHPOINTS_EXTRA'],
+}
+
+# Query exported once per format by the export benchmark
+EXPORT_QUERY = "SELECT * FROM TRANSACTIONS"
+
+# Differences below this many seconds are treated as noise
+NOISE_SECONDS = 0.05
+
+def _stages(analysis):
+    """The (stage name, callable) pairs timed for an analysis; later stages reuse cached data"""
+    if analysis == 'customer_segment':
+        from utils.customer_segment import get_customer_segment_analysis, get_segment_channel_aggregates
+        return [
+            ('aggregate', get_segment_channel_aggregates),
+            ('analysis', get_customer_segment_analysis),
+        ]
+
+    if analysis == 'omnichannel':
+        from data_handler import get_customers_df
+        from utils.omnichannel_analysis import CUSTOMER_COLUMNS, get_channels_per_customer, get_omnichannel_analysis
+        return [
+            ('load', lambda: (get_customers_df(CUSTOMER_COLUMNS), get_channels_per_customer())),
+            ('analysis', get_omnichannel_analysis),
+        ]
+
+    if analysis == 'true_cac':
+        from data_handler import get_datasets
+        from utils.true_customer_acquisition_cost import (
+            CUSTOMER_COLUMNS, SPEND_COLUMNS, TOUCHPOINT_COLUMNS, get_final_df
+        )
+        return [
+            ('load', lambda: get_datasets({
+                'customers': CUSTOMER_COLUMNS,
+                'touchpoints': TOUCHPOINT_COLUMNS,
+                'marketing_spend': SPEND_COLUMNS,
+            })),
+            ('analysis', get_final_df),
+        ]
+
+    if analysis == 'export':
+        from data_handler import EXPORT_FORMATS, export_query
+        # Written to the null device so the stages time reading and serializing, not the disk
+        return [
+            (export_format, lambda export_format=export_format: export_query(EXPORT_QUERY, os.devnull, export_format))
+            for export_format in EXPORT_FORMATS
+        ]
+
+    if analysis == 'attribution':
+        from utils.attribution import build_attribution_credits
+        return [('credit', build_attribution_credits)]
+
+    raise KeyError(analysis)
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def _measure(database_path, analysis, results):
+    """
+    Run one analysis in this (fresh) process and put its measurements on the queue,
+    or {'error': traceback} if it failed
+    """
+    try:
+        import data_handler
+        data_handler.set_connection_factory(lambda: sqlite3.connect(database_path, check_same_thread=False))
+
+        stages = {}
+        for stage_name, run in _stages(analysis):
+            start = time.perf_counter()
+            run()
+            stages[stage_name] = time.perf_counter() - start
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+        return
+
+    results.put({'seconds': sum(stages.values()), 'stages': stages, 'peak_rss_mb': _peak_rss_mb()})
+
+def _wait_for_measurement(process, results, poll_seconds=1.0):
+    """The measurement the process puts on the queue, or an error if it dies without one"""
+    while True:
+        try:
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            if not process.is_alive():
+                try:
+                    return results.get_nowait()
+                except queue.Empty:
+                    return {'error': f"Process exited with code {process.exitcode} before reporting"}
+
+def _table_rows(database_path):
+    with sqlite3.connect(database_path) as connection:
+        tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        return {table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+
+def run_benchmarks(database_path, analyses=None, failures=None):
+    """
+    Measure each analysis against the database at database_path.
+
+    An analysis that fails or crashes is left out of the measurements, and its error
+    is put in failures (a dict) when given, so the other analyses still run.
+
+    Returns:
+        dict: Analysis -> seconds, rows, rows_per_second, peak_rss_mb and per-stage
+            seconds and rows_per_second
+    """
+    table_rows = _table_rows(database_path)
+    context = multiprocessing.get_context('spawn')
+    measurements = {}
+
+    for analysis in analyses or ANALYSIS_TABLES:
+        results = context.Queue()
+        process = context.Process(target=_measure, args=(database_path, analysis, results))
+        process.start()
+        measurement = _wait_for_measurement(process, results)
+        process.join()
+        if 'error' in measurement:
+            if failures is not None:
+                failures[analysis] = measurement['error']
+            continue
+
+        rows = sum(table_rows.get(table, 0) for table in ANALYSIS_TABLES[analysis])
+        measurements[analysis] = {
+            'seconds': measurement['seconds'],
+            'rows': rows,
+            'rows_per_second': rows / measurement['seconds'] if measurement['seconds'] else None,
+            'peak_rss_mb': measurement['peak_rss_mb'],
+            'stages': {
+                stage: {'seconds': seconds, 'rows_per_second': rows / seconds if seconds else None}
+                for stage, seconds in measurement['stages'].items()
+            },
+        }
+
+    return measurements
+
+def find_regressions(measurements, baseline, tolerance):
+    """List every wall time or peak RSS that grew by more than tolerance over the baseline"""
+    regressions = []
+
+    def check(name, current, previous, unit, slack=0.0):
+        if previous is not None and current > previous * (1 + tolerance) + slack:
+            regressions.append(f"{name}: {current:.2f}{unit} vs baseline {previous:.2f}{unit}")
+
+    for analysis, measurement in measurements.items():
+        previous = baseline.get(analysis)
+        if previous is None:
+            continue
+        check(f"{analysis} wall time", measurement['seconds'], previous['seconds'], 's', NOISE_SECONDS)
+        check(f"{analysis} peak RSS", measurement['peak_rss_mb'], previous['peak_rss_mb'], ' MB')
+        for stage, stage_measurement in measurement['stages'].items():
+            previous_stage = previous['stages'].get(stage)
+            if previous_stage is not None:
+                check(f"{analysis}.{stage} wall time", stage_measurement['seconds'], previous_stage['seconds'], 's', NOISE_SECONDS)
+
+    return regressions
+
+def _print_measurements(measurements):
+    print(f"{'analysis':<28}{'seconds':>10}{'rows/sec':>14}{'peak RSS MB':>14}")
+    for analysis, measurement in measurements.items():
+        print(f"{analysis:<28}{measurement['seconds']:>10.3f}{measurement['rows_per_second'] or 0:>14,.0f}{measurement['peak_rss_mb']:>14.1f}")
+        for stage, stage_measurement in measurement['stages'].items():
+            print(f"  {stage:<26}{stage_measurement['seconds']:>10.3f}{stage_measurement['rows_per_second'] or 0:>14,.0f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the analyses against a synthetic stand-in database")
+    parser.add_argument("database", help="SQLite database written by benchmarks/synthetic_data.py")
+    parser.add_argument("--analyses", nargs="+", choices=ANALYSIS_TABLES, help="Analyses to run (default: all)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file")
+    parser.add_argument("--label", help="Baseline entry to compare with (default: database file name)")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed growth over the baseline (0.25 = 25%%)")
+    parser.add_argument("--output", help="Also write this run's measurements to a JSON file")
+    args = parser.parse_args(argv)
+
+    label = args.label or os.path.splitext(os.path.basename(args.database))[0]
+    failures = {}
+    measurements = run_benchmarks(args.database, args.analyses, failures)
+    _print_measurements(measurements)
+    for analysis, error in failures.items():
+        print(f"FAILED {analysis}:\n{error}")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({label: measurements}, output_file, indent=2)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    if failures:
+        return 1
+
+    if args.save_baseline:
+        baselines[label] = measurements
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2)
+        print(f"Saved baseline '{label}' to {args.baseline}")
+        return 0
+
+    if label not in baselines:
+        print(f"No baseline '{label}' in {args.baseline}; run with --save-baseline to create one")
+        return 0
+
+    regressions = find_regressions(measurements, baselines[label], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        return 1
+    print(f"No regressions against baseline '{label}'")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
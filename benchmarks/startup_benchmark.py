@@ -0,0 +1,191 @@
+"""
+Benchmark app start-up: module import times and each page's time to first render.
+
+Every measurement runs in a fresh process. Imports are timed best of --repeat and
+checked against IMPORT_BUDGET_MS; none of them may load a DEFERRED_MODULES entry,
+which are only imported on first use. Each page is then rendered with streamlit's
+AppTest the way app.py runs it, against a synthetic stand-in database, twice: cold
+(empty cube and query cache directories, like a new autoscaled instance) and after a
+restart (the directories the cold run left behind). Time to first render covers
+importing the app's modules and the first script run; streamlit itself is imported
+beforehand.
+
+Usage:
+    python benchmarks/synthetic_data.py --size 1m
+    python benchmarks/startup_benchmark.py benchmarks/data/synthetic_1m.db
+    python benchmarks/startup_benchmark.py benchmarks/data/synthetic_1m.db --budget-scale 1.5
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+# Import time allowed per module in a fresh interpreter, including what it imports.
+# pandas accounts for about 450 ms of each and streamlit for about 400 ms.
+IMPORT_BUDGET_MS = {
+    'data_handler': 750,
+    'data_refresh': 750,
+    'utils.analytics_cube': 750,
+    'utils.filter_index': 800,
+    'utils.customer_segment': 800,
+    'utils.omnichannel_analysis': 800,
+    'utils.true_customer_acquisition_cost': 800,
+    'utils.page_components': 1250,
+}
+
+# Heavy modules that importing the app must not load
+DEFERRED_MODULES = ['snowflake.connector', 'plotly.express']
+
+PAGES = [
+    'pages/customer_segment_page.py',
+    'pages/onmichannel_analysis_page.py',
+    'pages/true_acquisition_cost_page.py',
+]
+
+# Seconds a page may take to render before AppTest gives up
+RENDER_TIMEOUT_SECONDS = 900
+
+def _time_import(module, results):
+    """Import module in this (fresh) process and report the time and deferred modules loaded"""
+    start = time.perf_counter()
+    importlib.import_module(module)
+    results.put({
+        'ms': (time.perf_counter() - start) * 1000,
+        'deferred_loaded': [name for name in DEFERRED_MODULES if name in sys.modules],
+    })
+
+def _render(database_path, page, results):
+    """Render page in this (fresh) process and report the time it took"""
+    from streamlit.testing.v1 import AppTest
+
+    start = time.perf_counter()
+    import data_handler
+    from data_refresh import foreground_work, start_refresh_worker
+    data_handler.set_connection_factory(lambda: sqlite3.connect(database_path, check_same_thread=False))
+    # AppTest runs files under pages/ directly rather than through app.py's
+    # navigation, so set up what app.py does around each page run here
+    app = AppTest.from_file(os.path.join(ROOT, page), default_timeout=RENDER_TIMEOUT_SECONDS)
+    start_refresh_worker()
+    with foreground_work():
+        app.run()
+    results.put({
+        'seconds': time.perf_counter() - start,
+        'errors': [str(element.value) for element in list(app.exception) + list(app.error)],
+    })
+    # Exit without interpreter shutdown, which would fail the deferred builds still running
+    results.close()
+    results.join_thread()
+    os._exit(0)
+
+def _in_fresh_process(target, *args):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=target, args=(*args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def measure_imports(repeat=3):
+    """
+    Time importing each module of IMPORT_BUDGET_MS in a fresh process.
+
+    Returns:
+        dict: Module -> ms (best of repeat) and deferred_loaded (DEFERRED_MODULES it loaded)
+    """
+    measurements = {}
+    for module in IMPORT_BUDGET_MS:
+        runs = [_in_fresh_process(_time_import, module) for _ in range(repeat)]
+        measurements[module] = {
+            'ms': min(run['ms'] for run in runs),
+            'deferred_loaded': runs[0]['deferred_loaded'],
+        }
+    return measurements
+
+def measure_first_renders(database_path, pages=None):
+    """
+    Time each page's first render cold and after a restart.
+
+    The page's cube directory (and query cache directory, when QUERY_CACHE_DIR is set)
+    start empty for the cold render and are kept for the restart render.
+
+    Returns:
+        dict: Page -> cold and restart, each with seconds and errors
+    """
+    measurements = {}
+    for page in pages or PAGES:
+        with tempfile.TemporaryDirectory() as directory:
+            environment = {'CUBE_DIR': os.path.join(directory, "cube")}
+            if os.getenv("QUERY_CACHE_DIR"):
+                environment['QUERY_CACHE_DIR'] = os.path.join(directory, "query_cache")
+            previous = {name: os.environ.get(name) for name in environment}
+            os.environ.update(environment)
+            try:
+                measurements[page] = {
+                    run: _in_fresh_process(_render, database_path, page) for run in ('cold', 'restart')
+                }
+            finally:
+                for name, value in previous.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+    return measurements
+
+def find_violations(imports, renders, budget_scale=1.0):
+    """List imports over budget or loading deferred modules, and pages that failed to render"""
+    violations = []
+    for module, measurement in imports.items():
+        budget = IMPORT_BUDGET_MS[module] * budget_scale
+        if measurement['ms'] > budget:
+            violations.append(f"import {module}: {measurement['ms']:.0f} ms vs budget {budget:.0f} ms")
+        for deferred in measurement['deferred_loaded']:
+            violations.append(f"import {module} loads {deferred}, which should only be imported on first use")
+    for page, runs in renders.items():
+        for run, measurement in runs.items():
+            for error in measurement['errors']:
+                violations.append(f"{page} ({run}): {error}")
+    return violations
+
+def _print_measurements(imports, renders, budget_scale):
+    print(f"{'module':<40}{'import ms':>10}{'budget ms':>11}")
+    for module, measurement in imports.items():
+        print(f"{module:<40}{measurement['ms']:>10.0f}{IMPORT_BUDGET_MS[module] * budget_scale:>11.0f}")
+    print()
+    print(f"{'page':<40}{'cold s':>10}{'restart s':>11}")
+    for page, runs in renders.items():
+        print(f"{page:<40}{runs['cold']['seconds']:>10.2f}{runs['restart']['seconds']:>11.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure import times and each page's time to first render")
+    parser.add_argument("database", help="SQLite database written by benchmarks/synthetic_data.py")
+    parser.add_argument("--pages", nargs="+", choices=PAGES, help="Pages to render (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Imports timed per module; the fastest counts")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="Multiply every import budget, e.g. on slower hosts")
+    parser.add_argument("--skip-renders", action="store_true", help="Only check the import budget")
+    parser.add_argument("--output", help="Also write the measurements to a JSON file")
+    args = parser.parse_args(argv)
+
+    imports = measure_imports(args.repeat)
+    renders = {} if args.skip_renders else measure_first_renders(args.database, args.pages)
+    _print_measurements(imports, renders, args.budget_scale)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({'imports': imports, 'first_renders': renders}, output_file, indent=2)
+
+    violations = find_violations(imports, renders, args.budget_scale)
+    for violation in violations:
+        print(f"FAILED {violation}")
+    return 1 if violations else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
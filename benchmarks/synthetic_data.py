@@ -0,0 +1,170 @@
+"""
+Generate seeded synthetic CUSTOMERS, TRANSACTIONS, CUSTOMER_TOUCHPOINTS and
+MARKETING_SPEND tables (plus their _EXTRA twins) into a local SQLite database that
+stands in for Snowflake.
+
+Usage:
+    python benchmarks/synthetic_data.py --size 1m
+    python benchmarks/synthetic_data.py --size 10m --overlap 0.3 --seed 7 --output /tmp/synthetic_10m.db
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_handler import ACQUISITION_CHANNELS, SEGMENT_ORDER, TOUCHPOINT_CHANNELS
+
+# Number of TRANSACTIONS rows for each named size; the other tables scale from it
+SIZES = {'100k': 100_000, '1m': 1_000_000, '10m': 10_000_000, '100m': 100_000_000}
+
+CHUNK_ROWS = 1_000_000
+DATE_RANGE_START = pd.Timestamp('2023-01-01')
+DATE_RANGE_SECONDS = 2 * 365 * 24 * 3600
+
+# Raw transaction channel spellings, including the inconsistent ones the omnichannel
+# analysis normalizes
+TRANSACTION_CHANNELS = ['Online', 'In-Store', 'Mobile App', 'online ', ' In-store', 'Marketplace']
+SEGMENT_WEIGHTS = [0.25, 0.2, 0.3, 0.17, 0.08]
+SEGMENT_MEAN_LTV = [120.0, 250.0, 600.0, 1500.0, 5000.0]
+
+def table_row_counts(transactions, extra_fraction):
+    """Rows per base table for a given TRANSACTIONS size and the matching _EXTRA sizes"""
+    base = {
+        'CUSTOMERS': max(transactions // 10, 100),
+        'TRANSACTIONS': transactions,
+        'CUSTOMER_TOUCHPOINTS': transactions,
+        'MARKETING_SPEND': max(transactions // 1000, 100),
+    }
+    extra = {
+        f"{table}_EXTRA": int(rows * extra_fraction)
+        for table, rows in base.items() if table != 'MARKETING_SPEND'
+    }
+    return base, extra
+
+def _dates(rng, n):
+    seconds = rng.integers(0, DATE_RANGE_SECONDS, n)
+    return (DATE_RANGE_START + pd.to_timedelta(seconds, unit='s')).strftime('%Y-%m-%d %H:%M:%S')
+
+def _customers(rng, ids, n_customers):
+    segment_index = rng.choice(len(SEGMENT_ORDER), len(ids), p=SEGMENT_WEIGHTS)
+    mean_ltv = np.array(SEGMENT_MEAN_LTV)[segment_index]
+    return pd.DataFrame({
+        'customer_id': ids,
+        'customer_segment': np.array(SEGMENT_ORDER, dtype=object)[segment_index],
+        'acquisition_channel': rng.choice(np.array(ACQUISITION_CHANNELS, dtype=object), len(ids)),
+        'lifetime_value': rng.gamma(2.0, mean_ltv / 2.0).round(2),
+        'signup_date': _dates(rng, len(ids)),
+    })
+
+def _transactions(rng, ids, n_customers):
+    return pd.DataFrame({
+        'transaction_id': ids,
+        'customer_id': rng.integers(1, n_customers + 1, len(ids)),
+        'channel': rng.choice(np.array(TRANSACTION_CHANNELS, dtype=object), len(ids), p=[0.4, 0.3, 0.15, 0.05, 0.05, 0.05]),
+        'amount': rng.gamma(2.0, 40.0, len(ids)).round(2),
+        'transaction_date': _dates(rng, len(ids)),
+    })
+
+def _touchpoints(rng, ids, n_customers):
+    return pd.DataFrame({
+        'touchpoint_id': ids,
+        'customer_id': rng.integers(1, n_customers + 1, len(ids)),
+        'channel': rng.choice(np.array(TOUCHPOINT_CHANNELS, dtype=object), len(ids)),
+        'converted_flag': rng.random(len(ids)) < 0.15,
+        'touchpoint_date': _dates(rng, len(ids)),
+    })
+
+def _marketing_spend(rng, ids, n_customers):
+    return pd.DataFrame({
+        'spend_id': ids,
+        'channel': rng.choice(np.array(ACQUISITION_CHANNELS, dtype=object), len(ids)),
+        'spend_amount': rng.gamma(2.0, 750.0, len(ids)).round(2),
+        'spend_date': _dates(rng, len(ids)),
+    })
+
+GENERATORS = {
+    'CUSTOMERS': _customers,
+    'TRANSACTIONS': _transactions,
+    'CUSTOMER_TOUCHPOINTS': _touchpoints,
+    'MARKETING_SPEND': _marketing_spend,
+}
+
+def _extra_ids(rng, n_base, n_extra, overlap):
+    """
+    Ids for an _EXTRA table: a share reuses base ids, the rest continue after them.
+    At most every base id is reused, however large overlap * n_extra is.
+    """
+    n_shared = min(int(n_extra * overlap), n_base)
+    shared = rng.choice(n_base, n_shared, replace=False) + 1
+    new = np.arange(n_base + 1, n_base + 1 + n_extra - n_shared)
+    return np.concatenate([shared, new])
+
+def _write_table(connection, table, ids, make_frame, seed, table_number, n_customers):
+    """Write a table in fixed-size chunks so memory stays bounded at any size"""
+    connection.execute(f"DROP TABLE IF EXISTS {table}")
+    for chunk_number, start in enumerate(range(0, len(ids), CHUNK_ROWS)):
+        rng = np.random.default_rng([seed, table_number, chunk_number])
+        frame = make_frame(rng, ids[start:start + CHUNK_ROWS], n_customers)
+        frame.to_sql(table, connection, index=False, if_exists='append')
+
+def generate(path, transactions, overlap=0.2, extra_fraction=0.25, seed=42):
+    """
+    Generate every table into the SQLite database at path.
+
+    Args:
+        transactions (int): Rows in TRANSACTIONS; the other tables scale from it
+        overlap (float): Share of each _EXTRA table's rows whose key also exists in the base table
+        extra_fraction (float): Size of each _EXTRA table relative to its base table
+        seed (int): Seed for every random draw, so the same arguments give the same data
+
+    Returns:
+        dict: Table name -> row count
+    """
+    base_counts, extra_counts = table_row_counts(transactions, extra_fraction)
+    n_customers = base_counts['CUSTOMERS'] + extra_counts['CUSTOMERS_EXTRA']
+    rng = np.random.default_rng(seed)
+    row_counts = {}
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with sqlite3.connect(path) as connection:
+        for table_number, (table, make_frame) in enumerate(GENERATORS.items()):
+            base_ids = np.arange(1, base_counts[table] + 1)
+            _write_table(connection, table, base_ids, make_frame, seed, 2 * table_number, n_customers)
+            row_counts[table] = len(base_ids)
+
+            extra_table = f"{table}_EXTRA"
+            if extra_table in extra_counts:
+                extra_ids = _extra_ids(rng, base_counts[table], extra_counts[extra_table], overlap)
+                _write_table(connection, extra_table, extra_ids, make_frame, seed, 2 * table_number + 1, n_customers)
+                row_counts[extra_table] = len(extra_ids)
+
+    return row_counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic stand-in database for benchmarks")
+    parser.add_argument("--size", choices=SIZES, default='100k', help="Number of TRANSACTIONS rows")
+    parser.add_argument("--overlap", type=float, default=0.2, help="Share of _EXTRA keys that repeat base keys")
+    parser.add_argument("--extra-fraction", type=float, default=0.25, help="_EXTRA table size relative to the base table")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="SQLite file to write (default: benchmarks/data/synthetic_<size>.db)")
+    args = parser.parse_args(argv)
+    if not 0 <= args.overlap <= 1:
+        parser.error(f"--overlap must be between 0 and 1, got {args.overlap}")
+    if args.extra_fraction < 0:
+        parser.error(f"--extra-fraction must not be negative, got {args.extra_fraction}")
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", f"synthetic_{args.size}.db")
+    start = time.perf_counter()
+    row_counts = generate(output, SIZES[args.size], args.overlap, args.extra_fraction, args.seed)
+    for table, rows in row_counts.items():
+        print(f"{table}: {rows:,} rows")
+    print(f"Wrote {output} in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,26 @@
-import snowflake.connector
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import asyncio
+import contextvars
 import decimal
+import hashlib
+import io
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 import os
 
+import tracing
+from query_cache import QueryResultCache
+
 load_dotenv()
 
 snowflake_user = os.getenv("username")
@@ -14,98 +30,926 @@ snowflake_warehouse = os.getenv("warehouse")
 snowflake_database = os.getenv("database")
 snowflake_schema = os.getenv("schema")
 
-conn = snowflake.connector.connect(
-    user=snowflake_user,
-    password=snowflake_password,
-    account=snowflake_account,
-    warehouse=snowflake_warehouse,
-    database=snowflake_database,
-    schema=snowflake_schema
-)
+# Dataset cache settings: entries expire after the TTL and the least recently used
+# entries are evicted once the cached frames exceed the memory cap
+dataset_cache_ttl_seconds = float(os.getenv("DATASET_CACHE_TTL_SECONDS", 600))
+dataset_cache_max_bytes = int(os.getenv("DATASET_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# Directory of local table snapshots written by data_sync.py; when a table has a
+# snapshot there, the loaders read it instead of querying Snowflake
+snapshot_dir = os.getenv("SNAPSHOT_DIR")
+
+# Directory of the on-disk query result cache shared by every app process (unset
+# disables it), its size cap, and how often the source tables' versions are re-read
+query_cache_dir = os.getenv("QUERY_CACHE_DIR")
+query_cache_max_bytes = int(os.getenv("QUERY_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+query_cache_version_seconds = float(os.getenv("QUERY_CACHE_VERSION_SECONDS", 60))
+
+# Fixed data-version token for the query cache, e.g. a load id; when unset the
+# token is derived from the tables' LAST_ALTERED times
+data_version = os.getenv("DATA_VERSION")
+
+# Fail fast when a loaded frame would exceed this many bytes (0 disables the check)
+strict_frame_max_bytes = int(os.getenv("STRICT_FRAME_MAX_BYTES", 0))
+
+# Rows per chunk when streaming query results from cursors without Arrow batches
+stream_batch_rows = int(os.getenv("STREAM_BATCH_ROWS", 500_000))
+
+# Rows per chunk for the streaming exports (iter_records, iter_ndjson, iter_csv and
+# export_query), smaller so a serialized chunk stays small too
+export_batch_rows = int(os.getenv("EXPORT_BATCH_ROWS", 100_000))
+
+# Connection pool settings
+snowflake_pool_size = int(os.getenv("SNOWFLAKE_POOL_SIZE", 4))
+snowflake_pool_timeout_seconds = float(os.getenv("SNOWFLAKE_POOL_TIMEOUT_SECONDS", 60))
+snowflake_health_check_seconds = float(os.getenv("SNOWFLAKE_HEALTH_CHECK_SECONDS", 300))
+
+# Snowflake error codes meaning the session or its token expired and a new login is needed
+SESSION_EXPIRED_ERRNOS = {390111, 390112, 390114}
+
+def _connect():
+    # The connector takes about a second to import, so it is only loaded to connect
+    import snowflake.connector
+    return snowflake.connector.connect(
+        user=snowflake_user,
+        password=snowflake_password,
+        account=snowflake_account,
+        warehouse=snowflake_warehouse,
+        database=snowflake_database,
+        schema=snowflake_schema
+    )
+
+def _is_session_expired(error):
+    # A Snowflake error means the connector is already imported, so look it up instead of importing it
+    errors = sys.modules.get('snowflake.connector.errors')
+    return errors is not None and isinstance(error, errors.Error) and getattr(error, 'errno', None) in SESSION_EXPIRED_ERRNOS
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections, created on demand up to size.
+
+    Idle connections are health checked before reuse, and a connection whose
+    session expired is closed and replaced instead of being returned to the pool.
+    """
+
+    def __init__(self, factory, size, timeout_seconds, health_check_seconds):
+        self.factory = factory
+        self.size = size
+        self.timeout_seconds = timeout_seconds
+        self.health_check_seconds = health_check_seconds
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the with block"""
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception as error:
+            if _is_session_expired(error):
+                self._discard(conn)
+            else:
+                self._release(conn)
+            raise
+        else:
+            self._release(conn)
+
+    def close(self):
+        """Close idle connections; connections still in use are closed when returned"""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout_seconds
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    if self._closed:
+                        raise RuntimeError("Connection pool is closed")
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return self.factory()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No database connection available after {self.timeout_seconds}s")
+                try:
+                    conn, last_used = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def _is_healthy(self, conn, last_used):
+        is_closed = getattr(conn, 'is_closed', None)
+        if callable(is_closed) and is_closed():
+            return False
+        # Only ping the server for connections that sat idle long enough to have expired
+        is_valid = getattr(conn, 'is_valid', None)
+        if callable(is_valid) and time.monotonic() - last_used > self.health_check_seconds:
+            return is_valid()
+        return True
+
+    def _release(self, conn):
+        with self._lock:
+            closed = self._closed
+        if closed:
+            self._discard(conn)
+        else:
+            self._idle.put((conn, time.monotonic()))
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass  # The connection is being thrown away either way
+
+_pool = None
+_pool_lock = threading.Lock()
+_connection_factory = _connect
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(_connection_factory, snowflake_pool_size, snowflake_pool_timeout_seconds, snowflake_health_check_seconds)
+        return _pool
+
+def set_connection_factory(factory=None):
+    """
+    Open connections with factory() instead of Snowflake, e.g. to run against a local
+    stand-in database exposing the same tables. Pass None to go back to Snowflake.
+    Drains the current pool and clears the dataset cache.
+    """
+    global _connection_factory
+    close_connection()
+    _connection_factory = factory or _connect
+    dataset_cache.invalidate()
+    forget_data_version()
+    with _registry_lock:
+        _table_columns.clear()
+
+@contextmanager
+def get_connection():
+    """Borrow a pooled Snowflake connection, e.g. `with get_connection() as conn:`"""
+    with _get_pool().connection() as conn:
+        yield conn
+
+def _run_with_cursor(work):
+    """Run work(cursor) on a pooled connection, reconnecting once if the session expired"""
+    for attempt in range(2):
+        try:
+            with get_connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    return work(cursor)
+                finally:
+                    cursor.close()
+        except Exception as error:
+            if attempt == 0 and _is_session_expired(error):
+                continue
+            raise
 
 def fetch_data(query):
     """Returns raw tuples"""
-    cursor = conn.cursor()
-    try:
+    def work(cursor):
+        start = time.perf_counter()
         cursor.execute(query)
-        results = cursor.fetchall()
-        return results
-    finally:
-        cursor.close()
+        executed = time.perf_counter()
+        rows = cursor.fetchall()
+        tracing.record_query(
+            query, len(rows), 0, executed - start, time.perf_counter() - executed,
+            query_id=getattr(cursor, 'sfqid', None)
+        )
+        return rows
+    return _run_with_cursor(work)
+
+query_result_cache = QueryResultCache(query_cache_dir, query_cache_max_bytes) if query_cache_dir else None
+
+_data_version = {'token': None, 'read_at': None}
+_data_version_lock = threading.Lock()
+
+def get_data_version():
+    """
+    Token that changes whenever the source data changes; part of every query cache key.
+
+    DATA_VERSION fixes it when set. Otherwise it is a hash of every table's LAST_ALTERED
+    time in the schema, re-read at most every QUERY_CACHE_VERSION_SECONDS.
+
+    Returns:
+        str: The token, or None when the tables' versions cannot be read (the disk
+            cache is then bypassed rather than risk serving stale results)
+    """
+    if data_version:
+        return data_version
+    with _data_version_lock:
+        read_at = _data_version['read_at']
+        if read_at is not None and time.monotonic() - read_at < query_cache_version_seconds:
+            return _data_version['token']
 
-def fetch_data_as_dataframe(query):
-    """Fetch data and return as pandas DataFrame with proper column names"""
-    cursor = conn.cursor()
+    def work(cursor):
+        cursor.execute(
+            "SELECT TABLE_NAME, LAST_ALTERED FROM INFORMATION_SCHEMA.TABLES "
+            "WHERE TABLE_SCHEMA = CURRENT_SCHEMA() ORDER BY TABLE_NAME"
+        )
+        return cursor.fetchall()
     try:
-        cursor.execute(query)
+        rows = _run_with_cursor(work)
+        token = hashlib.sha1(repr((snowflake_account, snowflake_database, snowflake_schema, rows)).encode()).hexdigest()
+    except Exception:
+        token = None  # e.g. a stand-in database without INFORMATION_SCHEMA
+    with _data_version_lock:
+        _data_version.update(token=token, read_at=time.monotonic())
+    return token
+
+def forget_data_version():
+    """Re-read the data version on the next query instead of waiting for it to expire"""
+    with _data_version_lock:
+        _data_version['read_at'] = None
+
+def _query_cache_version():
+    """Data version to key disk cache entries with, or None when the disk cache is off"""
+    if query_result_cache is None:
+        return None
+    return get_data_version()
+
+def get_query_cache_stats():
+    """Get hit/miss counters, bytes read and written and size of the on-disk query cache (None when off)"""
+    return query_result_cache.stats() if query_result_cache is not None else None
+
+def fetch_data_as_dataframe(query, use_arrow=False):
+    """
+    Fetch data and return as pandas DataFrame with proper column names.
+
+    Args:
+        query (str): SQL query to run
+        use_arrow (bool): Read result batches as Arrow record batches and convert them
+            straight into typed pandas columns instead of building Python tuples
+
+    Returns:
+        pd.DataFrame: Query results with Snowflake column names
+    """
+    timings = {}
+    df, _ = _fetch_dataframe_with_description(query, use_arrow, timings=timings)
+    _record_query(query, df, timings)
+    return df
+
+def _fetch_dataframe_with_description(query, use_arrow, timeout=None, timings=None):
+    """
+    Fetch a DataFrame along with the cursor description that describes its column types.
+    When timings is a dict it receives execute_seconds, fetch_seconds and query_id.
+    """
+    def work(cursor):
+        start = time.perf_counter()
+        if timeout is None:
+            cursor.execute(query)
+        else:
+            # Snowflake cancels the query server-side once the timeout passes
+            cursor.execute(query, timeout=timeout)
+        executed = time.perf_counter()
+        description = cursor.description
         # Get column names from cursor description
-        columns = [desc[0] for desc in cursor.description]
-        # Fetch all results
-        results = cursor.fetchall()
-        # Create DataFrame with proper column names
-        df = pd.DataFrame(results, columns=columns)
-        return df
-    finally:
-        cursor.close()
+        columns = [desc[0] for desc in description]
+        # DB-API cursors other than Snowflake's have no Arrow batches, so they use tuples
+        if use_arrow and hasattr(cursor, 'fetch_arrow_batches'):
+            df = _fetch_arrow_dataframe(cursor, columns)
+        else:
+            # Fetch all results
+            results = cursor.fetchall()
+            # Create DataFrame with proper column names
+            df = pd.DataFrame(results, columns=columns)
+        if timings is not None:
+            timings.update(
+                execute_seconds=executed - start,
+                fetch_seconds=time.perf_counter() - executed,
+                query_id=getattr(cursor, 'sfqid', None),
+            )
+        return df, description
+    return _run_with_cursor(work)
+
+def _record_query(query, df, timings, conversion_seconds=0.0):
+    tracing.record_query(
+        query,
+        rows=len(df),
+        bytes=int(df.memory_usage(index=False).sum()),
+        conversion_seconds=conversion_seconds,
+        **timings
+    )
+
+def _fetch_arrow_dataframe(cursor, columns):
+    """Build a DataFrame from the cursor's Arrow result batches without per-row Python objects"""
+    batches = [batch for batch in cursor.fetch_arrow_batches() if batch.num_rows > 0]
+    if not batches:
+        return pd.DataFrame(columns=columns)
 
-def convert_snowflake_types(df):
+    return _arrow_to_pandas(pa.concat_tables(batches))
+
+def _arrow_to_pandas(table):
+    """Convert an Arrow table to pandas, casting decimals to int64/float64 first"""
+    # Decimal columns would come through as decimal.Decimal objects, so cast them first
+    for index, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type):
+            if field.type.scale == 0 and field.type.precision <= 18:
+                target_type = pa.int64()
+            else:
+                target_type = pa.float64()
+            table = table.set_column(index, field.name, table.column(index).cast(target_type))
+
+    # self_destruct releases each Arrow column once converted to keep peak memory down
+    return table.to_pandas(date_as_object=False, split_blocks=True, self_destruct=True)
+
+def convert_snowflake_types(df, description=None, report=None):
     """
     Convert Snowflake-specific data types in dataframe to pandas-compatible types.
+
+    When the cursor description is given, each column is converted according to its
+    declared Snowflake type (NUMBER scale/precision, REAL, DATE, TIMESTAMP, BOOLEAN).
+    Without it, object columns fall back to a guess based on their first non-null value.
+    Columns are converted in place; the same DataFrame is returned.
+
+    Args:
+        df (pd.DataFrame): DataFrame to convert
+        description (list): cursor.description of the query that produced df
+        report (list): Optional list that receives one dict per column with the
+            Snowflake type, resulting dtype, conversion seconds and column bytes
+
+    Returns:
+        pd.DataFrame: The converted DataFrame
     """
+    if description is not None and len(description) == len(df.columns):
+        if any(desc[1] is not None for desc in description):
+            from snowflake.connector.constants import FIELD_ID_TO_NAME
+        for col, desc in zip(df.columns, description):
+            snowflake_type = FIELD_ID_TO_NAME[desc[1]] if desc[1] is not None else None
+            start = time.perf_counter()
+            converted = _convert_column(df[col], snowflake_type, desc[4], desc[5])
+            if converted is not None:
+                df[col] = converted
+            _report_conversion(report, df, col, snowflake_type, start)
+        return df
 
-    df_converted = df.copy()
-    
-    for col in df_converted.columns:
-        if df_converted[col].dtype == 'object':
-            # Get a sample of non-null values to check type
-            sample_values = df_converted[col].dropna()
-            if len(sample_values) > 0:
-                first_value = sample_values.iloc[0]
+    for col in df.columns:
+        start = time.perf_counter()
+        if df[col].dtype == 'object':
+            first_index = df[col].first_valid_index()
+            if first_index is not None:
+                first_value = df[col].loc[first_index]
                 
                 # Convert decimal.Decimal to float
                 if isinstance(first_value, decimal.Decimal):
-                    df_converted[col] = pd.to_numeric(df_converted[col], errors='coerce')
+                    df[col] = pd.to_numeric(df[col], errors='coerce')
                 
                 elif isinstance(first_value, str):
                     # Only try to convert if it looks like a common date format
-                    if (len(str(first_value)) >= 8 and 
-                        any(char in str(first_value) for char in ['/', '-']) and 
-                        any(char.isdigit() for char in str(first_value))):
+                    if (len(first_value) >= 8 and 
+                        any(char in first_value for char in ['/', '-']) and 
+                        any(char.isdigit() for char in first_value)):
                         try:
-                            df_converted[col] = pd.to_datetime(df_converted[col], errors='coerce')
-                        except:
+                            df[col] = pd.to_datetime(df[col], errors='coerce')
+                        except (ValueError, TypeError):
                             pass  # Keep as string if conversion fails
+        _report_conversion(report, df, col, None, start)
     
-    return df_converted
+    return df
+
+def _convert_column(series, snowflake_type, precision, scale):
+    """Return the column converted for its Snowflake type, or None when it is already usable"""
+    if snowflake_type == 'FIXED':
+        if series.dtype.kind in 'iu' or (series.dtype.kind == 'f' and scale):
+            return None
+        if scale == 0 and not series.isna().any():
+            try:
+                return series.astype('int64')
+            except (OverflowError, TypeError, ValueError):
+                pass  # Values beyond int64 fall back to float
+        return pd.to_numeric(series, errors='coerce').astype('float64')
+
+    if snowflake_type == 'REAL':
+        return None if series.dtype.kind == 'f' else pd.to_numeric(series, errors='coerce')
 
-def standardize_column_names(df):
+    if snowflake_type == 'DATE' or (snowflake_type or '').startswith('TIMESTAMP'):
+        return None if series.dtype.kind == 'M' else pd.to_datetime(series, errors='coerce')
+
+    if snowflake_type == 'BOOLEAN':
+        if series.dtype.kind == 'b':
+            return None
+        return series.astype('boolean') if series.isna().any() else series.astype(bool)
+
+    return None
+
+def _report_conversion(report, df, col, snowflake_type, start):
+    """Append one column's conversion timing and size to the report list"""
+    if report is None:
+        return
+    report.append({
+        'column': col,
+        'snowflake_type': snowflake_type,
+        'dtype': str(df[col].dtype),
+        'seconds': time.perf_counter() - start,
+        'bytes': int(df[col].memory_usage(index=False, deep=True)),
+    })
+
+def standardize_column_names(df, description=None, report=None):
     """
     Standardize Snowflake column names to lowercase for easier analysis.
-    Also converts decimal columns to float for pandas compatibility.
+    Also converts Snowflake types to pandas types, using the cursor description when given.
+    The DataFrame is modified in place rather than copied.
     
     Args:
         df (pd.DataFrame): DataFrame with Snowflake uppercase column names
+        description (list): cursor.description of the query that produced df
+        report (list): Optional list collecting per-column conversion timings and bytes
         
     Returns:
         pd.DataFrame: DataFrame with lowercase column names and proper data types
     """
-    df_standardized = df.copy()
-    
     # Convert all column names to lowercase
-    df_standardized.columns = df_standardized.columns.str.lower()
+    df.columns = df.columns.str.lower()
     
     # Convert Snowflake data types to types usable in pandas
-    df_standardized = convert_snowflake_types(df_standardized)
-    
-    return df_standardized
+    return convert_snowflake_types(df, description=description, report=report)
 
-def fetch_data_as_dataframe_standardized(query):
+def fetch_data_as_dataframe_standardized(query, use_arrow=True, report=None, timeout=None):
     """
     Fetch data and return as pandas DataFrame with standardized (lowercase) column names.
     This is the recommended function to use for analysis.
+
+    Results are read through the Arrow columnar path by default; pass use_arrow=False
+    to build the frame from fetchall() tuples instead. Pass a list as report to collect
+    per-column conversion timings and bytes, and timeout to cancel long-running queries.
+    Results are served from the disk query cache when it is on, except when a report
+    is requested.
     """
-    df = fetch_data_as_dataframe(query)
-    return standardize_column_names(df)
+    version = _query_cache_version() if report is None else None
+    if version is not None:
+        df = query_result_cache.get(query, version)
+        if df is not None:
+            return df
+
+    timings = {}
+    df, description = _fetch_dataframe_with_description(query, use_arrow, timeout=timeout, timings=timings)
+    start = time.perf_counter()
+    standardize_column_names(df, description=description, report=report)
+    _record_query(query, df, timings, conversion_seconds=time.perf_counter() - start)
+    if version is not None:
+        query_result_cache.put(query, version, df)
+    return df
+
+def iter_dataframe_batches(query, batch_rows=None, result_info=None):
+    """
+    Stream a query's results as a sequence of standardized DataFrames.
+
+    Only one chunk is held in memory at a time, so callers can aggregate results
+    larger than memory. Snowflake results arrive as its Arrow result batches; other
+    DB-API cursors are read with fetchmany(batch_rows). The connection stays borrowed
+    until the generator is exhausted or closed. With the disk query cache on, a cached
+    result is replayed batch by batch, and a result streamed to the end is cached.
+
+    Args:
+        query (str): SQL query to run
+        batch_rows (int): Rows per chunk for cursors without Arrow batches
+            (defaults to STREAM_BATCH_ROWS)
+        result_info (dict): Receives the cursor description under 'description' once
+            the query has run, or a cached result's Arrow schema under 'schema'
+
+    Yields:
+        pd.DataFrame: Chunk with lowercase column names and converted types
+    """
+    batch_rows = batch_rows or stream_batch_rows
+    version = _query_cache_version()
+    if version is not None:
+        batches = query_result_cache.read_batches(query, version)
+        if batches is not None:
+            if result_info is not None and batches:
+                result_info['schema'] = batches[0].schema
+            for batch in batches:
+                yield batch.to_pandas(date_as_object=False, split_blocks=True)
+            return
+
+    entry = query_result_cache.writer(query, version) if version is not None else None
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            start = time.perf_counter()
+            cursor.execute(query)
+            execute_seconds = time.perf_counter() - start
+            description = cursor.description
+            columns = [desc[0] for desc in description]
+            if result_info is not None:
+                result_info['description'] = description
+
+            if hasattr(cursor, 'fetch_arrow_batches'):
+                chunks = (_arrow_to_pandas(batch) for batch in cursor.fetch_arrow_batches() if batch.num_rows > 0)
+            else:
+                chunks = iter(lambda: cursor.fetchmany(batch_rows), [])
+                chunks = (pd.DataFrame(rows, columns=columns) for rows in chunks)
+
+            rows = 0
+            nbytes = 0
+            for chunk in chunks:
+                standardize_column_names(chunk, description=description)
+                rows += len(chunk)
+                nbytes += int(chunk.memory_usage(index=False).sum())
+                if entry is not None:
+                    entry.write(chunk)
+                yield chunk
+
+            tracing.record_query(
+                query, rows=rows, bytes=nbytes, execute_seconds=execute_seconds,
+                fetch_seconds=time.perf_counter() - start - execute_seconds,
+                query_id=getattr(cursor, 'sfqid', None)
+            )
+            if entry is not None:
+                entry.commit()
+        finally:
+            cursor.close()
+            if entry is not None:
+                entry.abort()
+
+# QueryHandle.status() values
+QUERY_RUNNING = 'running'
+QUERY_SUCCEEDED = 'succeeded'
+QUERY_FAILED = 'failed'
+QUERY_CANCELLED = 'cancelled'
+QUERY_TIMED_OUT = 'timed_out'
+
+class QueryCancelledError(Exception):
+    """Raised when waiting on a query that was cancelled, or submitting under a cancelled QueryScope"""
+
+class QueryScope:
+    """
+    Group of queries that can be cancelled together, e.g. every query of one Streamlit run.
+
+    Queries submitted inside `with query_scope(scope):` (including from threads started
+    with tracing.propagate) register with it. Once the scope is cancelled its running
+    queries are cancelled and new submissions raise QueryCancelledError.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.cancelled = False
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def register(self, handle):
+        with self._lock:
+            if self.cancelled:
+                handle.cancel()
+                raise QueryCancelledError(f"Query scope '{self.name}' was cancelled")
+            # Forget queries already seen to finish so long-lived scopes stay small
+            self._handles = [other for other in self._handles if other._state == QUERY_RUNNING]
+            self._handles.append(handle)
+
+    def cancel(self):
+        """Cancel every running query in the scope; returns how many were cancelled"""
+        with self._lock:
+            self.cancelled = True
+            handles, self._handles = self._handles, []
+        return sum(handle.cancel() for handle in handles)
+
+_current_query_scope = contextvars.ContextVar("current_query_scope", default=None)
+
+@contextmanager
+def query_scope(scope):
+    """Register every query submitted inside the block with scope"""
+    token = _current_query_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_query_scope.reset(token)
+
+class QueryHandle:
+    """
+    A query submitted with submit_query() that runs in Snowflake while the caller continues.
+
+    Status values are the QUERY_* constants. Polling status() past the handle's timeout
+    cancels the query and marks it timed out.
+    """
+
+    def __init__(self, query, timeout=None):
+        self.query = query
+        self.query_id = None
+        self.timeout = timeout
+        self.submitted_at = time.perf_counter()
+        self.finished_at = None
+        self._state = QUERY_RUNNING
+
+    def _submit(self):
+        def work(cursor):
+            cursor.execute_async(self.query)
+            return cursor.sfqid
+        self.query_id = _run_with_cursor(work)
+
+    def status(self):
+        """Poll the query's status: running, succeeded, failed, cancelled or timed_out"""
+        if self._state != QUERY_RUNNING:
+            return self._state
+        from snowflake.connector.constants import QueryStatus
+        with get_connection() as conn:
+            status = conn.get_query_status(self.query_id)
+            if conn.is_still_running(status):
+                if self._timed_out():
+                    self._cancel_running(QUERY_TIMED_OUT)
+            elif status == QueryStatus.SUCCESS:
+                self._finish(QUERY_SUCCEEDED)
+            elif status in (QueryStatus.ABORTING, QueryStatus.ABORTED):
+                self._finish(QUERY_CANCELLED)
+            else:
+                self._finish(QUERY_FAILED)
+        return self._state
+
+    def done(self):
+        return self.status() != QUERY_RUNNING
+
+    def cancel(self):
+        """Cancel the query if it is still running; returns whether it was"""
+        if self._state != QUERY_RUNNING:
+            return False
+        return self._cancel_running(QUERY_CANCELLED)
+
+    def _cancel_running(self, state):
+        def work(cursor):
+            cursor.execute(f"SELECT SYSTEM$CANCEL_QUERY('{self.query_id}')")
+        _run_with_cursor(work)
+        self._finish(state)
+        return True
+
+    def _finish(self, state):
+        if self._state == QUERY_RUNNING:
+            self._state = state
+            self.finished_at = time.perf_counter()
+
+    def _timed_out(self):
+        return self.timeout is not None and time.perf_counter() - self.submitted_at > self.timeout
+
+    def wait(self, poll_interval=0.05, max_poll_interval=1.0):
+        """Block until the query finishes, polling with a growing interval; returns the status"""
+        while not self.done():
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 1.5, max_poll_interval)
+        return self._state
+
+    def result(self, use_arrow=True):
+        """
+        Wait for the query and return its results as a standardized DataFrame.
+
+        Raises:
+            TimeoutError: If the query ran past its timeout and was cancelled
+            QueryCancelledError: If the query was cancelled
+            snowflake.connector.errors.Error: If the query failed
+        """
+        self.wait()
+        self._raise_for_state()
+
+        def work(cursor):
+            cursor.get_results_from_sfqid(self.query_id)
+            fetch_start = time.perf_counter()
+            columns = [desc[0] for desc in cursor.description]
+            if use_arrow:
+                df = _fetch_arrow_dataframe(cursor, columns)
+            else:
+                df = pd.DataFrame(cursor.fetchall(), columns=columns)
+            return df, cursor.description, time.perf_counter() - fetch_start
+        df, description, fetch_seconds = _run_with_cursor(work)
+        return self._standardize(df, description, fetch_seconds)
+
+    def _raise_for_state(self):
+        if self._state == QUERY_TIMED_OUT:
+            raise TimeoutError(f"Query {self._label()} did not finish within {self.timeout}s")
+        if self._state == QUERY_CANCELLED:
+            raise QueryCancelledError(f"Query {self._label()} was cancelled")
+        if self._state == QUERY_FAILED:
+            with get_connection() as conn:
+                conn.get_query_status_throw_if_error(self.query_id)
+
+    def _label(self):
+        return self.query_id or tracing.sql_hash(self.query)
+
+    def _standardize(self, df, description, fetch_seconds):
+        start = time.perf_counter()
+        standardize_column_names(df, description=description)
+        _record_query(self.query, df, {
+            'execute_seconds': (self.finished_at or start) - self.submitted_at,
+            'fetch_seconds': fetch_seconds,
+            'query_id': self.query_id,
+        }, conversion_seconds=time.perf_counter() - start)
+        return df
+
+    async def result_async(self, use_arrow=True, poll_interval=0.05, max_poll_interval=1.0):
+        """Like result(), but waits with asyncio.sleep so the event loop keeps running"""
+        while not await asyncio.to_thread(self.done):
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 1.5, max_poll_interval)
+        return await asyncio.to_thread(self.result, use_arrow)
+
+class _ThreadQueryHandle(QueryHandle):
+    """
+    Stand-in for DB-API connections without async submission (e.g. sqlite3): the query
+    runs on a worker thread and cancel() interrupts its connection when it supports it.
+    """
+
+    def _submit(self):
+        self._connection = None
+        self._future = _get_query_executor().submit(tracing.propagate(self._run))
+
+    def _run(self):
+        def work(cursor):
+            self._connection = getattr(cursor, 'connection', None)
+            try:
+                cursor.execute(self.query)
+                executed = time.perf_counter()
+                columns = [desc[0] for desc in cursor.description]
+                df = pd.DataFrame(cursor.fetchall(), columns=columns)
+                return df, cursor.description, time.perf_counter() - executed
+            finally:
+                self._connection = None
+        return _run_with_cursor(work)
+
+    def status(self):
+        if self._state == QUERY_RUNNING:
+            if self._future.done():
+                self._finish(QUERY_FAILED if self._future.exception() is not None else QUERY_SUCCEEDED)
+            elif self._timed_out():
+                self._cancel_running(QUERY_TIMED_OUT)
+        return self._state
+
+    def _cancel_running(self, state):
+        if not self._future.cancel() and hasattr(self._connection, 'interrupt'):
+            self._connection.interrupt()
+        self._finish(state)
+        return True
+
+    def result(self, use_arrow=True):
+        self.wait()
+        if self._state == QUERY_FAILED:
+            raise self._future.exception()
+        self._raise_for_state()
+        df, description, fetch_seconds = self._future.result()
+        return self._standardize(df, description, fetch_seconds)
+
+_query_executor = None
+_query_executor_lock = threading.Lock()
+
+def _get_query_executor():
+    global _query_executor
+    with _query_executor_lock:
+        if _query_executor is None:
+            _query_executor = ThreadPoolExecutor(max_workers=snowflake_pool_size, thread_name_prefix="query")
+        return _query_executor
+
+def submit_query(query, timeout=None):
+    """
+    Start a query without waiting for it and return its QueryHandle.
+
+    Snowflake runs the query asynchronously (execute_async) so no connection is held
+    while it runs; other DB-API connections run it on a worker thread. The handle is
+    registered with the active query_scope(), if any.
+
+    Args:
+        query (str): SQL query to run
+        timeout (float): Seconds after which polling the handle cancels the query
+
+    Returns:
+        QueryHandle: Handle for status(), cancel(), result() and result_async()
+    """
+    scope = _current_query_scope.get()
+    if scope is not None and scope.cancelled:
+        raise QueryCancelledError(f"Query scope '{scope.name}' was cancelled")
+
+    with get_connection() as conn:
+        supports_async = hasattr(conn, 'get_query_status')
+    handle = QueryHandle(query, timeout) if supports_async else _ThreadQueryHandle(query, timeout)
+    handle._submit()
+    if scope is not None:
+        scope.register(handle)
+    return handle
+
+async def fetch_dataframe_async(query, timeout=None):
+    """Run a query from asyncio code and return its standardized DataFrame"""
+    handle = await asyncio.to_thread(submit_query, query, timeout)
+    try:
+        return await handle.result_async()
+    except asyncio.CancelledError:
+        # The awaiting task was cancelled, so stop the query too
+        await asyncio.to_thread(handle.cancel)
+        raise
+
+class QueryBatchError(Exception):
+    """
+    Raised by fetch_dataframes when one or more queries in the batch failed or timed out.
+
+    Attributes:
+        errors (dict): Query name -> exception for every failed query
+        results (dict): Query name -> DataFrame for the queries that succeeded
+    """
+
+    def __init__(self, errors, results):
+        self.errors = errors
+        self.results = results
+        details = ", ".join(f"{name}: {error!r}" for name, error in errors.items())
+        super().__init__(f"{len(errors)} of {len(errors) + len(results)} queries failed ({details})")
+
+def fetch_dataframes(queries, max_workers=None, timeout=None):
+    """
+    Run independent queries concurrently and return their standardized DataFrames.
+
+    Every query is submitted up front with submit_query(), so they all run in the
+    warehouse at once and are cancelled along with the active query_scope(). Queries
+    answered by the disk query cache are not submitted at all.
+
+    Args:
+        queries (dict): Name -> SQL query
+        max_workers (int): Number of results fetched at once (defaults to the pool size)
+        timeout (float): Seconds each query may run before it is cancelled and reported
+            as timed out
+
+    Returns:
+        dict: Name -> DataFrame with standardized column names, in the order given
+
+    Raises:
+        QueryBatchError: If any query failed or timed out, with the per-query errors.
+            When a query cannot be submitted, those already submitted are cancelled
+            and the rest are not run (both reported as QueryCancelledError).
+    """
+    if not queries:
+        return {}
+
+    version = _query_cache_version()
+    cached = {}
+    if version is not None:
+        for name, query in queries.items():
+            df = query_result_cache.get(query, version)
+            if df is not None:
+                cached[name] = df
+
+    handles = {}
+    errors = {}
+    for name, query in queries.items():
+        if name in cached:
+            continue
+        try:
+            handles[name] = submit_query(query, timeout=timeout)
+        except Exception as error:
+            errors[name] = error
+            break
+    if errors:
+        # Don't leave the queries already submitted running in the warehouse
+        _cancel_quietly(handles.values())
+        failed = next(iter(errors))
+        errors = {
+            name: errors.get(name) or QueryCancelledError(f"Cancelled because {failed} could not be submitted")
+            for name in queries if name not in cached
+        }
+        raise QueryBatchError(errors, {name: cached[name] for name in queries if name in cached})
+
+    workers = max_workers or max(min(len(handles), snowflake_pool_size), 1)
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch") as executor:
+        futures = {name: executor.submit(tracing.propagate(handle.result)) for name, handle in handles.items()}
+        for name, query in queries.items():
+            if name in cached:
+                results[name] = cached[name]
+                continue
+            try:
+                results[name] = futures[name].result()
+            except Exception as error:
+                errors[name] = error
+                continue
+            if version is not None:
+                query_result_cache.put(query, version, results[name])
+
+    if errors:
+        raise QueryBatchError(errors, results)
+    return results
+
+def _cancel_quietly(handles):
+    """Cancel the handles still running, ignoring failures to cancel"""
+    for handle in handles:
+        try:
+            handle.cancel()
+        except Exception as error:
+            print(f"Could not cancel query {handle.query_id}: {error}")
 
 def fetch_data_as_json(query):
     """Fetch data and return as JSON string"""
@@ -117,31 +961,592 @@ def fetch_data_as_dict(query):
     df = fetch_data_as_dataframe(query)
     return df.to_dict('records')
 
-def get_customers_df():
+# Formats export_query() can write
+EXPORT_FORMATS = ('ndjson', 'csv', 'parquet')
+
+def iter_records(query, batch_rows=None):
+    """
+    Stream a query's results as one dictionary per row.
+
+    The streaming counterpart of fetch_data_as_dict: rows come from
+    iter_dataframe_batches(), so only one result batch is in memory at a time and
+    column names are standardized (lowercase).
+    """
+    for chunk in iter_dataframe_batches(query, batch_rows or export_batch_rows):
+        yield from chunk.to_dict('records')
+
+def iter_ndjson(query, batch_rows=None):
+    """
+    Stream a query's results as newline-delimited JSON, one text chunk per result batch.
+
+    The streaming counterpart of fetch_data_as_json, with one record per line,
+    standardized column names and ISO 8601 dates.
+    """
+    for chunk in iter_dataframe_batches(query, batch_rows or export_batch_rows):
+        yield _ndjson_text(chunk)
+
+def iter_csv(query, batch_rows=None):
+    """Stream a query's results as CSV text, one chunk per result batch; the first chunk has the header"""
+    header = True
+    for chunk in iter_dataframe_batches(query, batch_rows or export_batch_rows):
+        yield chunk.to_csv(index=False, header=header)
+        header = False
+
+def _ndjson_text(chunk):
+    return chunk.to_json(orient='records', lines=True, date_format='iso')
+
+def export_query(query, sink, format='ndjson', batch_rows=None):
+    """
+    Write a query's results to a file one result batch at a time.
+
+    Memory use is bounded by one result batch however large the result is. Parquet
+    output gets one row group per batch, with the schema taken from the columns'
+    declared types (see _export_schema). An empty result writes an empty NDJSON/CSV
+    file or a Parquet file with the result's columns and no rows.
+    The export is recorded as an export.<format> span with its rows and rows/sec.
+
+    Args:
+        query (str): SQL query to run
+        sink (str or file): Path to write, or an open file; NDJSON and CSV accept
+            text or binary files (written as UTF-8), Parquet needs a binary one
+        format (str): One of EXPORT_FORMATS
+        batch_rows (int): Rows per batch for cursors without Arrow batches
+            (defaults to EXPORT_BATCH_ROWS)
+
+    Returns:
+        dict: rows, bytes written, seconds and rows_per_second
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {format!r}; expected one of {EXPORT_FORMATS}")
+
+    with tracing.span(f'export.{format}') as attributes:
+        start = time.perf_counter()
+        if isinstance(sink, (str, os.PathLike)):
+            with open(sink, 'wb') as stream:
+                rows, nbytes = _write_export(query, _CountingSink(stream), format, batch_rows)
+        else:
+            rows, nbytes = _write_export(query, _CountingSink(sink), format, batch_rows)
+        seconds = time.perf_counter() - start
+        stats = {
+            'rows': rows,
+            'bytes': nbytes,
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds > 0 else 0.0,
+        }
+        attributes.update(stats)
+    return stats
+
+def _write_export(query, sink, format, batch_rows):
+    """Write every batch of query to sink; returns (rows, bytes written)"""
+    rows = 0
+    parquet_writer = None
+    result_info = {}
+    try:
+        for chunk in iter_dataframe_batches(query, batch_rows or export_batch_rows, result_info=result_info):
+            if format == 'parquet':
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(sink, _export_schema(result_info, chunk))
+                parquet_writer.write_table(_export_table(chunk, parquet_writer.schema))
+            elif format == 'csv':
+                sink.write_text(chunk.to_csv(index=False, header=rows == 0))
+            else:
+                sink.write_text(_ndjson_text(chunk))
+            rows += len(chunk)
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+    if format == 'parquet' and parquet_writer is None:
+        pq.write_table(_export_schema(result_info).empty_table(), sink)
+    sink.flush()
+    return rows, sink.bytes_written
+
+def _declared_arrow_type(description_entry):
+    """
+    Arrow type of the pandas column a Snowflake column converts to (see
+    _convert_column), or None when the cursor declares no type
+    """
+    if description_entry[1] is None:
+        return None
+    from snowflake.connector.constants import FIELD_ID_TO_NAME
+    return snowflake_arrow_type(FIELD_ID_TO_NAME.get(description_entry[1]), description_entry[5])
+
+def snowflake_arrow_type(snowflake_type, scale):
+    """
+    Arrow type for a Snowflake column, as _convert_column converts it: whole numbers
+    (scale 0, any precision, e.g. NUMBER(38,0) ids) are int64, with batches where the
+    converted column holds NaN written as nulls; None for types without a mapping.
+    """
+    if snowflake_type == 'FIXED':
+        return pa.int64() if not scale else pa.float64()
+    if snowflake_type == 'REAL':
+        return pa.float64()
+    if snowflake_type in ('DATE', 'TIMESTAMP', 'TIMESTAMP_NTZ'):
+        return pa.timestamp('ns')
+    if snowflake_type in ('TIMESTAMP_LTZ', 'TIMESTAMP_TZ'):
+        return pa.timestamp('ns', tz='UTC')
+    if snowflake_type == 'BOOLEAN':
+        return pa.bool_()
+    if snowflake_type == 'TEXT':
+        return pa.string()
+    if snowflake_type == 'BINARY':
+        return pa.binary()
+    return None
+
+def _export_schema(result_info, chunk=None):
+    """
+    Arrow schema a Parquet export is written with.
+
+    Types come from the cursor description (or a cached result's schema) rather than
+    from the first batch, where a column with only nulls would be typed null and a
+    later batch with values could not be written. Columns without a declared type
+    are inferred from chunk, and written as strings when there is nothing to infer
+    them from.
+    """
+    if result_info.get('schema') is not None:
+        return result_info['schema']
+
+    fields = []
+    for index, description_entry in enumerate(result_info.get('description') or []):
+        arrow_type = _declared_arrow_type(description_entry)
+        if arrow_type is None and chunk is not None:
+            arrow_type = pa.Array.from_pandas(chunk.iloc[:, index]).type
+        if arrow_type is None or pa.types.is_null(arrow_type):
+            arrow_type = pa.string()
+        fields.append(pa.field(description_entry[0].lower(), arrow_type))
+    return pa.schema(fields)
+
+def _export_table(chunk, schema):
+    """A batch as an Arrow table of the export's schema"""
+    try:
+        return pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # Values of an untyped column first seen as all-null are written as text
+        string_columns = [field.name for field in schema if pa.types.is_string(field.type)]
+        chunk = chunk.astype({column: 'string' for column in string_columns})
+        return pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+
+class _CountingSink:
+    """File wrapper counting the bytes written, for text or binary files"""
+
+    closed = False
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.text = isinstance(stream, io.TextIOBase)
+        self.bytes_written = 0
+
+    def write(self, data):
+        if self.text:
+            raise TypeError("Parquet exports need a binary file, e.g. open(path, 'wb')")
+        self.stream.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def write_text(self, text):
+        if self.text:
+            self.stream.write(text)
+            self.bytes_written += len(text.encode())
+        else:
+            self.write(text.encode())
+
+    def flush(self):
+        self.stream.flush()
+
+# Keys already reloaded by the active DatasetCache.refreshing() block
+_refreshed_keys = contextvars.ContextVar("refreshed_keys", default=None)
+
+class DatasetCache:
+    """
+    Process-wide cache of loaded DataFrames, shared by every Streamlit session.
+
+    Entries are keyed by the set of source tables and the column projection, expire
+    after ttl_seconds and are evicted least-recently-used once their combined size
+    exceeds max_bytes. Cached frames are handed out as shallow copies, so callers may
+    add or replace columns but must not modify values in place.
+    """
+
+    def __init__(self, ttl_seconds, max_bytes):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def get_or_load(self, tables, columns, loader):
+        """Return the cached frame for (tables, columns), calling loader() on a miss"""
+        key = (tuple(tables), tuple(columns) if columns is not None else None)
+        refreshed = _refreshed_keys.get()
+        if refreshed is not None and key not in refreshed:
+            return self._reload(key, tables, loader, refreshed)
+
+        frame = self._get(key)
+        if frame is not None:
+            return frame.copy(deep=False)
+
+        # Only one session loads a given key; the others wait and then read the cache
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock, tracing.span('dataset_cache_load', tables=list(tables)) as attributes:
+            frame = self._get(key, count=False)
+            attributes['loaded'] = frame is None
+            if frame is None:
+                frame = loader()
+                self._put(key, frame)
+        return frame.copy(deep=False)
+
+    @contextmanager
+    def refreshing(self):
+        """
+        Reload each entry read inside the block once instead of serving it from the cache.
+
+        Other readers keep getting the existing frame until the reloaded one replaces it.
+        Work submitted to threads with tracing.propagate takes part in the same refresh.
+        The data version is re-read first, so reloads skip disk cache entries of data
+        that changed since.
+        """
+        forget_data_version()
+        token = _refreshed_keys.set(set())
+        try:
+            yield
+        finally:
+            _refreshed_keys.reset(token)
+
+    def _reload(self, key, tables, loader, refreshed):
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock, tracing.span('dataset_cache_refresh', tables=list(tables)):
+            # Another thread of the same refresh may have reloaded it while this one waited
+            frame = self._get(key, count=False) if key in refreshed else None
+            if frame is None:
+                frame = loader()
+                self._put(key, frame)
+                refreshed.add(key)
+        return frame.copy(deep=False)
+
+    def invalidate(self, table=None):
+        """Drop every entry built from table, or all entries when table is None"""
+        with self._lock:
+            for key in list(self._entries):
+                if table is None or table.upper() in key[0]:
+                    self._remove(key)
+
+    def stats(self):
+        """Return hit/miss counters and current cache size"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+            }
+
+    def _get(self, key, count=True):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry['loaded_at'] > self.ttl_seconds:
+                self._remove(key)
+                entry = None
+            if count:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry['frame']
+
+    def _put(self, key, frame):
+        nbytes = int(frame.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_bytes:
+            return  # Too large to cache at all
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {'frame': frame, 'bytes': nbytes, 'loaded_at': time.monotonic()}
+            self._total_bytes += nbytes
+            while self._total_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry['bytes']
+
+dataset_cache = DatasetCache(dataset_cache_ttl_seconds, dataset_cache_max_bytes)
+
+def invalidate(table=None):
+    """Invalidate cached datasets built from table (e.g. 'CUSTOMERS'), or everything if None"""
+    dataset_cache.invalidate(table)
+    forget_data_version()
+
+def get_cache_stats():
+    """Get hit/miss counters and size of the shared dataset cache"""
+    return dataset_cache.stats()
+
+# Known values of the low-cardinality string columns, in display order
+SEGMENT_ORDER = ['Dormant', 'New', 'Occasional', 'Frequent', 'High-Value']
+ACQUISITION_CHANNELS = ['Direct', 'Email', 'Facebook', 'Google', 'Instagram', 'Referral', 'Social Media', 'TikTok']
+TOUCHPOINT_CHANNELS = ['Direct', 'Email', 'Facebook', 'Google', 'Instagram', 'TikTok', 'Walk-in']
+
+# Datasets the loaders know how to build: the source tables in priority order, the
+# key used to keep the first row when a row appears in more than one table, the
+# categorical columns with their vocabulary (values outside it are appended) and
+# float columns that may be stored as float32. The only float columns are money
+# (lifetime_value, amount, spend_amount): cent values are rarely exact in float32 and
+# they get summed, so they stay float64 and aggregates are unchanged.
+DATASETS = {
+    'customers': {
+        'tables': ('CUSTOMERS', 'CUSTOMERS_EXTRA'),
+        'key': 'customer_id',
+        'categories': {'customer_segment': SEGMENT_ORDER, 'acquisition_channel': ACQUISITION_CHANNELS},
+        'float32': [],
+    },
+    'transactions': {
+        'tables': ('TRANSACTIONS', 'TRANSACTIONS_EXTRA'),
+        'key': 'transaction_id',
+        'categories': {'channel': []},
+        'float32': [],
+    },
+    'touchpoints': {
+        'tables': ('CUSTOMER_TOUCHPOINTS', 'CUSTOMER_TOUCHPOINTS_EXTRA'),
+        'key': 'touchpoint_id',
+        'categories': {'channel': TOUCHPOINT_CHANNELS},
+        'float32': [],
+    },
+    'marketing_spend': {
+        'tables': ('MARKETING_SPEND',),
+        'key': 'spend_id',
+        'categories': {'channel': ACQUISITION_CHANNELS},
+        'float32': [],
+    },
+}
+
+# Columns each analysis has declared it reads, per dataset
+_required_columns = {name: set() for name in DATASETS}
+_table_columns = {}
+_registry_lock = threading.Lock()
+
+def require_columns(dataset, columns):
+    """
+    Declare columns an analysis reads from a dataset.
+
+    Projected loads fetch the union of every declared column in a single query, so
+    analyses that share a dataset share one cached fetch.
+    """
+    with _registry_lock:
+        _required_columns[dataset].update(column.lower() for column in columns)
+
+def get_dataset(name, columns=None):
+    """
+    Get a dataset from DATASETS as a DataFrame with standardized column names.
+
+    Args:
+        name (str): Dataset name, e.g. 'customers'
+        columns (list): Columns to return; None selects every column
+
+    Returns:
+        pd.DataFrame: Combined rows of the dataset's tables, first row kept per key
+    """
+    dataset = DATASETS[name]
+    tables = dataset['tables']
+    if columns is None:
+        return dataset_cache.get_or_load(tables, None, lambda: _load_combined_tables(dataset))
+
+    columns = [column.lower() for column in columns]
+    with _registry_lock:
+        superset = _required_columns[name] | set(columns) | {dataset['key']}
+    available = _get_table_columns(tables[0])
+    projection = [column for column in available if column in superset]
+    missing = [column for column in columns if column not in available]
+    if missing:
+        raise KeyError(f"{tables[0]} has no column(s) {missing}")
+
+    frame = dataset_cache.get_or_load(
+        tables, projection, lambda: _load_combined_tables(dataset, projection)
+    )
+    # Select without copying so callers only see the columns they asked for
+    return pd.DataFrame({column: frame[column] for column in columns}, copy=False)
+
+def get_datasets(requests):
+    """
+    Get several datasets at once, loading the ones not yet cached concurrently.
+
+    Args:
+        requests (dict): Dataset name -> list of columns (or None for every column)
+
+    Returns:
+        dict: Dataset name -> DataFrame
+    """
+    with ThreadPoolExecutor(max_workers=max(len(requests), 1), thread_name_prefix="dataset") as executor:
+        futures = {
+            name: executor.submit(tracing.propagate(get_dataset), name, columns)
+            for name, columns in requests.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+def _get_table_columns(table):
+    """Get a table's standardized column names, probing the table once per process"""
+    with _registry_lock:
+        columns = _table_columns.get(table)
+    if columns is None:
+        parts = get_snapshot_parts(table)
+        if parts:
+            columns = pq.read_schema(parts[0]).names
+        else:
+            columns = fetch_data_as_dataframe_standardized(f"SELECT * FROM {table} LIMIT 0").columns.tolist()
+        with _registry_lock:
+            _table_columns[table] = columns
+    return columns
+
+def get_customers_df(columns=None):
     """Get customers data as DataFrame with standardized column names - combines CUSTOMERS and CUSTOMERS_EXTRA"""
-    customers = fetch_data_as_dataframe_standardized("SELECT * FROM CUSTOMERS")
-    customers_extra = fetch_data_as_dataframe_standardized("SELECT * FROM CUSTOMERS_EXTRA")
-    
-    combined_customers = pd.concat([customers, customers_extra], ignore_index=True)
-    
-    combined_customers = combined_customers.drop_duplicates(subset=['customer_id'], keep='first')
-    
-    return combined_customers
+    return get_dataset('customers', columns)
 
-def get_transactions_df():
+def get_transactions_df(columns=None):
     """Get transactions data as DataFrame with standardized column names - combines TRANSACTIONS and TRANSACTIONS_EXTRA"""
-    transactions = fetch_data_as_dataframe_standardized("SELECT * FROM TRANSACTIONS")
-    transactions_extra = fetch_data_as_dataframe_standardized("SELECT * FROM TRANSACTIONS_EXTRA")
+    return get_dataset('transactions', columns)
+
+def _load_combined_tables(dataset, columns=None):
+    """Fetch a base table and its _EXTRA twin concurrently, keeping the first row per key"""
+    tables = dataset['tables']
+    key = dataset['key']
+    select_list = ", ".join(columns) if columns else "*"
+    with tracing.span('fetch_tables', tables=list(tables)):
+        frames = {table: read_snapshot_table(table, columns) for table in tables}
+        frames.update(fetch_dataframes({
+            table: f"SELECT {select_list} FROM {table}" for table, frame in frames.items() if frame is None
+        }))
     
-    combined_transactions = pd.concat([transactions, transactions_extra], ignore_index=True)
+    # Compact each table before combining so the full object-dtype frame never exists twice
+    with tracing.span('compact_frames', tables=list(tables)):
+        parts = [compact_frame(frames.pop(table), dataset['categories'], dataset['float32']) for table in tables]
+        _align_categories(parts)
+        check_frame_size(sum(memory_report(part)['bytes'].sum() for part in parts), ", ".join(tables))
     
-    if 'transaction_id' in combined_transactions.columns:
-        combined_transactions = combined_transactions.drop_duplicates(subset=['transaction_id'], keep='first')
+    with tracing.span('drop_duplicates', tables=list(tables)):
+        combined = pd.concat(parts, ignore_index=True)
+        
+        if key in combined.columns:
+            combined = combined.drop_duplicates(subset=[key], keep='first')
     
-    return combined_transactions
+    return combined
+
+class FrameTooLargeError(MemoryError):
+    """Raised in strict mode when a loaded frame exceeds STRICT_FRAME_MAX_BYTES"""
+
+def check_frame_size(nbytes, description):
+    """Raise FrameTooLargeError if strict mode is on and nbytes is over the limit"""
+    if strict_frame_max_bytes and nbytes > strict_frame_max_bytes:
+        raise FrameTooLargeError(
+            f"{description} needs {nbytes / 1024 ** 2:,.1f} MiB, over the "
+            f"STRICT_FRAME_MAX_BYTES limit of {strict_frame_max_bytes / 1024 ** 2:,.1f} MiB"
+        )
+
+def compact_frame(df, categories=None, float32_columns=()):
+    """
+    Convert a frame to compact dtypes in place.
+
+    String columns listed in categories become categoricals whose categories are the
+    given vocabulary followed by any other values present. int64 columns that fit are
+    stored as int32, and float32_columns become float32 when that loses no precision.
+
+    Returns:
+        pd.DataFrame: The same frame
+    """
+    for col, vocabulary in (categories or {}).items():
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            known_values = set(vocabulary)
+            extra_values = sorted(
+                value for value in pd.unique(df[col]) if pd.notna(value) and value not in known_values
+            )
+            df[col] = pd.Categorical(df[col], categories=list(vocabulary) + extra_values)
+
+    for col in df.columns:
+        if df[col].dtype == 'int64' and len(df) > 0:
+            int32_info = np.iinfo(np.int32)
+            if int32_info.min <= df[col].min() and df[col].max() <= int32_info.max:
+                df[col] = df[col].astype('int32')
+
+    for col in float32_columns:
+        if col in df.columns and df[col].dtype == 'float64':
+            downcast = df[col].astype('float32')
+            if np.array_equal(downcast.astype('float64').to_numpy(), df[col].to_numpy(), equal_nan=True):
+                df[col] = downcast
+
+    return df
+
+def _align_categories(frames):
+    """Give categorical columns the same categories in every frame so pd.concat keeps them categorical"""
+    for col in frames[0].columns:
+        if not isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            continue
+        categories = list(frames[0][col].cat.categories)
+        for frame in frames[1:]:
+            if col in frame.columns and isinstance(frame[col].dtype, pd.CategoricalDtype):
+                categories += [value for value in frame[col].cat.categories if value not in set(categories)]
+        for frame in frames:
+            if col in frame.columns and isinstance(frame[col].dtype, pd.CategoricalDtype):
+                frame[col] = frame[col].cat.set_categories(categories)
+            elif col in frame.columns:
+                frame[col] = pd.Categorical(frame[col], categories=categories)
+
+def memory_report(df):
+    """
+    Report the memory used by each column of a frame.
+
+    Returns:
+        pd.DataFrame: One row per column with dtype, bytes and bytes per row
+    """
+    column_bytes = df.memory_usage(index=False, deep=True)
+    return pd.DataFrame({
+        'column': column_bytes.index,
+        'dtype': [str(df[col].dtype) for col in column_bytes.index],
+        'bytes': column_bytes.to_numpy(),
+        'bytes_per_row': column_bytes.to_numpy() / max(len(df), 1),
+    })
+
+def get_snapshot_parts(table):
+    """Get the Parquet part files of a table's local snapshot in write order (empty if none)"""
+    if not snapshot_dir:
+        return []
+    table_dir = os.path.join(snapshot_dir, table)
+    if not os.path.isdir(table_dir):
+        return []
+    return [
+        os.path.join(table_dir, name)
+        for name in sorted(os.listdir(table_dir))
+        if name.startswith('part-') and name.endswith('.parquet')
+    ]
+
+def read_snapshot_table(table, columns=None):
+    """
+    Read a table from its local snapshot, or return None when it has not been synced.
+
+    Parts are read in the order they were written, so rows synced earlier come first.
+    """
+    parts = get_snapshot_parts(table)
+    if not parts:
+        return None
+    tables = [pq.read_table(part, columns=columns) for part in parts]
+    combined = pa.concat_tables(tables, promote_options='permissive')
+    return combined.to_pandas(split_blocks=True, self_destruct=True)
 
 def close_connection():
-    conn.close()
+    """Drain the connection pool; a new pool is created on the next query"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
 
 
 if __name__ == "__main__":
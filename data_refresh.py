@@ -0,0 +1,242 @@
+"""
+Stale-while-revalidate refresh of datasets and analysis results.
+
+Analyses register a loader under a name; get_refreshed(name) returns the latest built
+value, building it on first use. A background worker rebuilds every built value before
+the dataset cache would expire it and swaps the new value in atomically, so readers
+keep getting the previous version while the refresh runs and no page pays a cold load
+after the first one. Background work waits while a page run or a build a reader is
+waiting on is in progress, but for at most REFRESH_MAX_DEFER_SECONDS, so overlapping
+page runs from many sessions cannot hold refreshes off indefinitely.
+
+Usage:
+    register_refresh('customer_segment', get_customer_segment_analysis)
+    start_refresh_worker()
+    results = get_refreshed('customer_segment')
+    index = get_refreshed_if_ready('filter_index')  # None while it is first being built
+    refresh_status('customer_segment')['refreshed_at']
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import data_handler
+import tracing
+
+# Seconds between refreshes; defaults to half the dataset cache TTL so each value is
+# rebuilt well before its cached inputs expire
+refresh_interval_seconds = float(os.getenv(
+    "REFRESH_INTERVAL_SECONDS", data_handler.dataset_cache_ttl_seconds / 2
+))
+
+# Longest background builds and refreshes wait for foreground work to finish
+refresh_max_defer_seconds = float(os.getenv("REFRESH_MAX_DEFER_SECONDS", 10))
+
+class RefreshScheduler:
+    """
+    Keeps the latest value of each registered loader and rebuilds them in the background.
+
+    Values are shared by every Streamlit session and must be treated as read-only.
+    """
+
+    def __init__(self, interval_seconds, max_defer_seconds=None):
+        self.interval_seconds = interval_seconds
+        self.max_defer_seconds = refresh_max_defer_seconds if max_defer_seconds is None else max_defer_seconds
+        self._loaders = {}
+        self._entries = {}
+        self._next_refresh = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+        # Notified whenever work a reader is waiting on finishes
+        self._idle = threading.Condition(self._lock)
+        self._load_locks = {}
+        self._foreground = 0
+        self._background_builds = set()
+        self._thread = None
+        self._stop = threading.Event()
+        # Set when a value's next refresh time changes, so the worker re-plans its sleep
+        self._wake = threading.Event()
+
+    def register(self, name, loader, interval_seconds=None):
+        """Register loader() to be kept fresh under name, every interval_seconds (default: the scheduler's)"""
+        with self._lock:
+            self._loaders[name] = (loader, interval_seconds or self.interval_seconds)
+            self._load_locks.setdefault(name, threading.Lock())
+
+    def get(self, name):
+        """Return the latest value for name, loading it now if it was never built"""
+        with self._lock:
+            entry = self._entries.get(name)
+            load_lock = self._load_locks[name]
+        if entry is not None:
+            return entry['value']
+
+        with load_lock, self.foreground():
+            with self._lock:
+                entry = self._entries.get(name)
+            if entry is None:
+                entry = self._build(name)
+        return entry['value']
+
+    @contextmanager
+    def foreground(self):
+        """Mark work a reader is waiting on, e.g. a page run; background builds and refreshes wait for it"""
+        with self._lock:
+            self._foreground += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._foreground -= 1
+                self._idle.notify_all()
+
+    def _wait_for_foreground(self):
+        """Wait until no foreground work is running, or max_defer_seconds have passed"""
+        with self._idle:
+            self._idle.wait_for(lambda: self._foreground == 0, timeout=self.max_defer_seconds)
+
+    def get_if_ready(self, name):
+        """
+        Return the latest value for name without waiting for it.
+
+        A value that was never built is built on a background thread instead, and None
+        is returned until it is ready, so pages can render without it in the meantime.
+        The build starts once no foreground() work is running, or after
+        max_defer_seconds at the latest.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                return entry['value']
+            if name in self._background_builds:
+                return None
+            self._background_builds.add(name)
+        threading.Thread(target=self._build_in_background, args=(name,), name=f"build-{name}", daemon=True).start()
+        return None
+
+    def _build_in_background(self, name):
+        self._wait_for_foreground()
+        try:
+            with self._load_locks[name]:
+                with self._lock:
+                    built = name in self._entries
+                if not built:
+                    self._build(name)
+        except Exception as error:
+            with self._lock:
+                self._errors[name] = repr(error)
+            print(f"Build of {name} failed: {error}")
+        finally:
+            with self._lock:
+                self._background_builds.discard(name)
+
+    def refresh(self, names=None):
+        """
+        Rebuild the named values (default: all) and swap them in.
+
+        Dataset cache entries read while rebuilding are reloaded once per call rather
+        than served from the cache, and replace the cached frames when ready.
+        """
+        names = list(self._loaders) if names is None else names
+        with data_handler.dataset_cache.refreshing():
+            for name in names:
+                with self._load_locks[name]:
+                    try:
+                        self._build(name)
+                    except Exception as error:
+                        # Keep serving the previous value and record why the refresh failed
+                        with self._lock:
+                            self._next_refresh[name] = time.monotonic() + self._loaders[name][1]
+                            self._errors[name] = repr(error)
+                        print(f"Refresh of {name} failed: {error}")
+
+    def _build(self, name):
+        loader, _ = self._loaders[name]
+        start = time.perf_counter()
+        with tracing.span('refresh', dataset=name):
+            value = loader()
+        entry = {
+            'value': value,
+            'refreshed_at': datetime.now(timezone.utc),
+            'refresh_seconds': time.perf_counter() - start,
+        }
+        with self._lock:
+            entry['version'] = self._entries.get(name, {}).get('version', 0) + 1
+            self._entries[name] = entry
+            self._next_refresh[name] = time.monotonic() + self._loaders[name][1]
+            self._errors.pop(name, None)
+        self._wake.set()
+        return entry
+
+    def status(self, name=None):
+        """
+        Freshness of one value, or of every registered value when name is None.
+
+        Returns:
+            dict: refreshed_at (UTC datetime or None), refresh_seconds, version and the
+                last refresh error, if the most recent refresh failed
+        """
+        with self._lock:
+            if name is None:
+                return {registered: self._status(registered) for registered in self._loaders}
+            return self._status(name)
+
+    def _status(self, name):
+        entry = self._entries.get(name, {})
+        return {
+            'refreshed_at': entry.get('refreshed_at'),
+            'refresh_seconds': entry.get('refresh_seconds'),
+            'version': entry.get('version', 0),
+            'error': self._errors.get(name),
+        }
+
+    def start(self):
+        """Start the background worker if it is not running yet"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="refresh", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                # Values nobody has asked for yet are built on first use, not at start-up
+                due = [name for name, next_refresh in self._next_refresh.items() if next_refresh <= now]
+                upcoming = list(self._next_refresh.values())
+            if due:
+                self._wait_for_foreground()
+                self.refresh(due)
+                continue
+            self._wake.wait(max(min(upcoming, default=now + 1.0) - now, 0.1))
+            self._wake.clear()
+
+scheduler = RefreshScheduler(refresh_interval_seconds)
+
+def register_refresh(name, loader, interval_seconds=None):
+    scheduler.register(name, loader, interval_seconds)
+
+def get_refreshed(name):
+    return scheduler.get(name)
+
+def get_refreshed_if_ready(name):
+    return scheduler.get_if_ready(name)
+
+def foreground_work():
+    return scheduler.foreground()
+
+def refresh_status(name=None):
+    return scheduler.status(name)
+
+def start_refresh_worker():
+    scheduler.start()
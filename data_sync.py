@@ -0,0 +1,184 @@
+"""
+Incrementally sync Snowflake tables into local Parquet snapshots.
+
+Each table is stored as a directory of Parquet part files under the snapshot directory,
+plus a watermark per table in sync_state.json. A sync only pulls rows at or past the
+stored watermark, drops rows whose key is already in the snapshot (keep-first, like
+get_customers_df and get_transactions_df) and appends the rest as a new part.
+With SNAPSHOT_DIR set, the data_handler loaders read these snapshots instead of Snowflake.
+
+Usage:
+    python data_sync.py                          # sync every table
+    python data_sync.py --tables TRANSACTIONS TRANSACTIONS_EXTRA
+    python data_sync.py --watermark TRANSACTIONS=transaction_date
+    python data_sync.py --full                   # rebuild snapshots from scratch
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import data_handler
+from data_handler import DATASETS, fetch_data_as_dataframe_standardized, get_snapshot_parts, invalidate
+
+DEFAULT_SNAPSHOT_DIR = "snapshots"
+STATE_FILE = "sync_state.json"
+
+def _table_key(table):
+    """Get the dedupe key of the dataset a table belongs to"""
+    for dataset in DATASETS.values():
+        if table in dataset['tables']:
+            return dataset['key']
+    raise KeyError(f"{table} is not part of any dataset in data_handler.DATASETS")
+
+def all_tables():
+    return [table for dataset in DATASETS.values() for table in dataset['tables']]
+
+def load_state(directory):
+    path = os.path.join(directory, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as state_file:
+        return json.load(state_file)
+
+def _save_state(directory, state):
+    path = os.path.join(directory, STATE_FILE)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(temporary_path, path)
+
+def _sql_literal(value):
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _json_value(value):
+    """Convert a watermark to a JSON value, keeping numbers numeric"""
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, (int, float)):
+        return value
+    return str(pd.Timestamp(value)) if isinstance(value, (datetime, pd.Timestamp)) else str(value)
+
+def _write_part(table_dir, frame, part_number):
+    """Write a part file atomically so readers never see a partial file"""
+    path = os.path.join(table_dir, f"part-{part_number:06d}.parquet")
+    temporary_path = path + ".tmp"
+    pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), temporary_path)
+    os.replace(temporary_path, path)
+    return path
+
+def sync_table(table, watermark_column=None, full=False):
+    """
+    Pull new rows of a table into its local snapshot.
+
+    Args:
+        table (str): Table name, e.g. 'TRANSACTIONS'
+        watermark_column (str): Column whose stored maximum marks what has been synced;
+            defaults to the previous sync's column, then to the table's key
+        full (bool): Discard the snapshot and fetch the whole table
+
+    Returns:
+        dict: Rows fetched, rows added, total rows, new watermark and seconds taken
+    """
+    start = time.perf_counter()
+    directory = data_handler.snapshot_dir
+    table_dir = os.path.join(directory, table)
+    os.makedirs(table_dir, exist_ok=True)
+
+    key = _table_key(table)
+    state = load_state(directory)
+    table_state = state.get(table, {})
+    watermark_column = (watermark_column or table_state.get('watermark_column') or key).lower()
+    parts = get_snapshot_parts(table)
+
+    incremental = (
+        not full and parts
+        and table_state.get('watermark_column') == watermark_column
+        and table_state.get('watermark') is not None
+    )
+    if incremental:
+        # >= re-reads rows sharing the boundary value; the key check below drops them again
+        query = f"SELECT * FROM {table} WHERE {watermark_column} >= {_sql_literal(table_state['watermark'])}"
+    else:
+        query = f"SELECT * FROM {table}"
+
+    new_rows = fetch_data_as_dataframe_standardized(query)
+    fetched = len(new_rows)
+
+    if key in new_rows.columns:
+        new_rows = new_rows.drop_duplicates(subset=[key], keep='first')
+        if incremental:
+            existing_keys = pa.concat_tables(
+                [pq.read_table(part, columns=[key]) for part in parts], promote_options='permissive'
+            ).column(key).to_pandas()
+            new_rows = new_rows[~new_rows[key].isin(existing_keys)]
+
+    total_rows = table_state.get('rows', 0) if incremental else 0
+    next_part = int(os.path.basename(parts[-1])[len('part-'):-len('.parquet')]) + 1 if parts else 1
+
+    if len(new_rows) > 0 or not incremental:
+        _write_part(table_dir, new_rows, next_part)
+    if not incremental:
+        # The fresh full part is in place, so the old ones can go
+        for part in parts:
+            os.remove(part)
+
+    watermark = table_state.get('watermark') if incremental else None
+    if len(new_rows) > 0:
+        new_maximum = _json_value(new_rows[watermark_column].max())
+        watermark = new_maximum if watermark is None else max(watermark, new_maximum)
+
+    state[table] = {
+        'watermark_column': watermark_column,
+        'watermark': watermark,
+        'rows': total_rows + len(new_rows),
+        'synced_at': datetime.now(timezone.utc).isoformat(),
+    }
+    _save_state(directory, state)
+    invalidate(table)
+
+    return {
+        'table': table,
+        'fetched': fetched,
+        'added': len(new_rows),
+        'total_rows': state[table]['rows'],
+        'watermark': watermark,
+        'seconds': time.perf_counter() - start,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally sync Snowflake tables into local Parquet snapshots")
+    parser.add_argument("--tables", nargs="+", default=all_tables(), help="Tables to sync (default: all)")
+    parser.add_argument("--watermark", action="append", default=[], metavar="TABLE=COLUMN",
+                        help="Watermark column for a table, e.g. TRANSACTIONS=transaction_date")
+    parser.add_argument("--full", action="store_true", help="Rebuild the snapshots from scratch")
+    parser.add_argument("--snapshot-dir", default=data_handler.snapshot_dir or DEFAULT_SNAPSHOT_DIR)
+    args = parser.parse_args(argv)
+
+    watermark_columns = {}
+    for item in args.watermark:
+        table, column = item.split("=", 1)
+        watermark_columns[table.upper()] = column
+    data_handler.snapshot_dir = args.snapshot_dir
+    os.makedirs(args.snapshot_dir, exist_ok=True)
+
+    try:
+        for table in args.tables:
+            result = sync_table(table.upper(), watermark_columns.get(table.upper()), full=args.full)
+            print(
+                f"{result['table']}: fetched {result['fetched']:,}, added {result['added']:,}, "
+                f"total {result['total_rows']:,} rows, watermark {result['watermark']} "
+                f"({result['seconds']:.1f}s)"
+            )
+    finally:
+        data_handler.close_connection()
+
+if __name__ == "__main__":
+    main()
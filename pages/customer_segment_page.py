@@ -1,8 +1,25 @@
 import streamlit as st
+from data_refresh import get_refreshed
+from tracing import trace
 from utils.customer_segment import get_customer_segment_analysis
+from utils.filter_index import get_filter_index
+from utils.page_components import render_diagnostics, render_filters, render_freshness
 
+page_trace = None
+filters = None
 try:
-    segment_analysis_results = get_customer_segment_analysis()
+    with trace('customer_segment_page') as page_trace:
+        filter_index = get_filter_index(wait=False)
+        filters = render_filters(
+            'customer_segment', filter_index, "Acquisition channels", lambda index: index.acquisition_channels,
+            note="A date range keeps the customers with a transaction in it."
+        )
+        if filters is None:
+            segment_analysis_results = get_refreshed('customer_segment')
+        else:
+            segment_analysis_results = get_customer_segment_analysis(
+                cube={'segment_channel': filter_index.segment_channel(**filters)}
+            )
     
     total_customers_across_segments = segment_analysis_results['segment_counts']['customer_count'].sum()
     
@@ -12,6 +29,7 @@ except Exception as error:
 
 st.header(f"Customer Segment Analysis (N={total_customers_across_segments})")
 st.write("Analysis of customer demographics and lifetime value across different customer segments and acquisition channels")
+render_freshness('customer_segment' if filters is None else 'filter_index')
 
 channel_insights = segment_analysis_results['channel_insights']
 
@@ -45,3 +63,5 @@ with tab2:
     display_df['avg_ltv'] = display_df['avg_ltv'].apply(lambda x: f"${x:,.2f}")
     display_df['total_customers'] = display_df['total_customers'].apply(lambda x: f"{x:,}")
     st.dataframe(display_df, use_container_width=True)
+
+render_diagnostics(page_trace)
@@ -1,15 +1,42 @@
 import streamlit as st
+from data_refresh import get_refreshed, get_refreshed_if_ready
+from tracing import trace
+from utils.filter_index import get_filter_index
 from utils.omnichannel_analysis import get_omnichannel_analysis
+from utils.page_components import render_diagnostics, render_filters, render_freshness, render_paginated_dataframe
+from utils.quantile_sketch import DEFAULT_K, normalized_rank_error
 
 st.header("Omnichannel vs Single-Channel Analysis")
 st.write("Analysis of customer lifetime value comparing omnichannel customers (using 2+ channels) vs single-channel customers")
 
+page_trace = None
+filters = None
 try:
     # Get the analysis results (summary, detailed_df, bar_chart, box_plot)
-    omnichannel_summary, detailed_customer_dataframe, bar_chart_figure, box_plot_figure = get_omnichannel_analysis()
+    with trace('omnichannel_page') as page_trace:
+        filter_index = get_filter_index(wait=False)
+        filters = render_filters(
+            'omnichannel', filter_index, "Transaction channels", lambda index: list(index.transaction_channels),
+            note="Channels used are counted over the transactions in the date range on the selected channels."
+        )
+        if filters is None:
+            omnichannel_summary, bar_chart_figure, box_plot_figure = get_refreshed('omnichannel')
+            # None while the customer detail is first loaded in the background
+            detailed_customer_dataframe = get_refreshed_if_ready('omnichannel_customers')
+        else:
+            filtered_customers, cohort_ltv_sketches = filter_index.omnichannel(**filters)
+            omnichannel_summary, detailed_customer_dataframe, bar_chart_figure, box_plot_figure = get_omnichannel_analysis(
+                cube={'cohort_ltv_sketches': cohort_ltv_sketches}, customers=filtered_customers
+            )
+    render_freshness('omnichannel' if filters is None else 'filter_index')
     
     st.subheader("Summary Statistics")
     st.dataframe(omnichannel_summary)
+    st.caption(
+        f"Medians and box plot quartiles are estimated from quantile sketches: each lies within "
+        f"{normalized_rank_error():.1%} of the customers of the exact value's rank, and groups of up to "
+        f"{DEFAULT_K} customers are exact. Counts and means are exact."
+    )
     
     # Calculate and display insights
     if len(omnichannel_summary) >= 2:
@@ -33,7 +60,10 @@ try:
     
     # Detailed data in expandable section
     with st.expander("View Detailed Customer Data"):
-        st.dataframe(detailed_customer_dataframe, use_container_width=True)
+        if detailed_customer_dataframe is None:
+            st.write("The customer details are still loading; they appear on the next interaction once ready.")
+        else:
+            render_paginated_dataframe(detailed_customer_dataframe, key='omnichannel_detail')
         
 except Exception as error:
     st.error(f"Error loading omnichannel analysis: {error}")
@@ -42,4 +72,6 @@ except Exception as error:
     # Show debug information
     with st.expander("Debug Information"):
         import traceback
-        st.code(traceback.format_exc())
\ No newline at end of file
+        st.code(traceback.format_exc())
+
+render_diagnostics(page_trace)
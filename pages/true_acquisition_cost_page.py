@@ -1,14 +1,63 @@
 import streamlit as st
-import plotly.express as px
-import plotly.graph_objects as go
-from utils.true_customer_acquisition_cost import get_final_df
+from data_refresh import get_refreshed
+from tracing import trace
+from utils.analytics_cube import get_cube
+from utils.attribution import ATTRIBUTION_MODELS, credits_by_channel, get_attribution_credits
+from utils.cac_scenarios import CAC_INPUT_NAMES, CacScenarioModel, get_sensitivity_figure, sensitivity_bands
+from utils.filter_index import get_filter_index
+from utils.page_components import render_diagnostics, render_filters, render_freshness
+from utils.true_customer_acquisition_cost import get_cac_figures, get_final_df
 
 st.header("True Customer Acquisition Cost")
 st.write("Comprehensive analysis of customer acquisition costs including direct spend, indirect costs, and true CAC by channel")
 
+page_trace = None
+filters = None
 try:
-    acquisition_cost_dataframe = get_final_df()
+    with trace('true_acquisition_cost_page') as page_trace:
+        filter_index = get_filter_index(wait=False)
+        filters = render_filters(
+            'true_cac', filter_index, "Channels", lambda index: index.cac_channels(),
+            note="Spend follows the date range only; segments apply to customers and touchpoints. "
+                 "Indirect costs are always shared across every channel."
+        )
+        attribution = st.selectbox(
+            "Conversion credit", [None, *ATTRIBUTION_MODELS],
+            format_func=lambda model: "Converted on a mapped channel" if model is None else ATTRIBUTION_MODELS[model],
+            key="true_cac_attribution",
+            help="How converted customers are counted per acquisition channel. The attribution models "
+                 "split each conversion over the customer's touchpoints up to it."
+        )
+        credits = None
+        if attribution is not None:
+            if filters is not None:
+                st.caption("Attribution models cover all data; filtered views count customers converted on a mapped channel.")
+                attribution = None
+            else:
+                credits = get_attribution_credits(wait=False)
+                if credits is None:
+                    st.info("Attribution credits are still being computed; showing customers converted on a mapped channel for now.")
+                    attribution = None
+
+        if filters is None:
+            cube = get_cube()
+            cac_inputs = {name: cube[f"cac_{name}"] for name in CAC_INPUT_NAMES}
+            if attribution is None:
+                acquisition_cost_dataframe = get_refreshed('true_cac')
+            else:
+                acquisition_cost_dataframe = get_final_df(attribution=attribution, credits=credits)
+                cac_inputs['converted'] = acquisition_cost_dataframe[['channel', 'converted_customers']]
+        else:
+            cac_inputs = filter_index.cac_inputs(**filters)
+            acquisition_cost_dataframe = get_final_df(cube={
+                f"cac_{name}": table for name, table in cac_inputs.items()
+            })
+            if acquisition_cost_dataframe is not None and filters['channels']:
+                acquisition_cost_dataframe = acquisition_cost_dataframe[
+                    acquisition_cost_dataframe['channel'].isin(filters['channels'])
+                ].reset_index(drop=True)
     if acquisition_cost_dataframe is not None and not acquisition_cost_dataframe.empty:
+        render_freshness('true_cac' if filters is None else 'filter_index')
         
         col1, col2, col3, col4 = st.columns(4)
         with col1:
@@ -25,64 +74,40 @@ try:
             st.metric("Converted Customers", f"{number_of_converted_customers:,.0f}")
             
 
-        tab1, tab2, tab3 = st.tabs(["Cost by Channel", "True Customer Acquisition Cost by Channel", "Customers Acquired by Channel"])
+        tab1, tab2, tab3, tab4 = st.tabs(["Cost by Channel", "True Customer Acquisition Cost by Channel", "Customers Acquired by Channel", "Sensitivity"])
 
+        figures = get_cac_figures(acquisition_cost_dataframe)
         with tab1:
-            cost_breakdown_fig = go.Figure()
-            
-            cost_breakdown_fig.add_trace(go.Bar(
-                name='Direct Spend',
-                x=acquisition_cost_dataframe['channel'],
-                y=acquisition_cost_dataframe['total_direct_spend']
-            ))
-            cost_breakdown_fig.add_trace(go.Bar(
-                name='Staff Cost',
-                x=acquisition_cost_dataframe['channel'],
-                y=acquisition_cost_dataframe['staff_cost']
-            ))
-            cost_breakdown_fig.add_trace(go.Bar(
-                name='Technology Cost',
-                x=acquisition_cost_dataframe['channel'],
-                y=acquisition_cost_dataframe['technology_cost']
-            ))
-            cost_breakdown_fig.add_trace(go.Bar(
-                name='Returns Processing',
-                x=acquisition_cost_dataframe['channel'],
-                y=acquisition_cost_dataframe['returns_processing_cost']
-            ))
-            cost_breakdown_fig.add_trace(go.Bar(
-                name='Indirect Cost',
-                x=acquisition_cost_dataframe['channel'],
-                y=acquisition_cost_dataframe['indirect_cost']
-            ))
-            
-            cost_breakdown_fig.update_layout(
-                barmode='stack',
-                xaxis_title='Channel',
-                yaxis_title='Cost ($)',
-                height=500
-            )
-            st.plotly_chart(cost_breakdown_fig, use_container_width=True)
+            st.plotly_chart(figures['cost_breakdown'], use_container_width=True)
         
         with tab2:
-            cac_fig = px.bar(
-                acquisition_cost_dataframe,
-                x='channel',
-                y='true_cac',
-                labels={'true_cac': 'True CAC ($)', 'channel': 'Channel'}
-            )
-            cac_fig.update_layout(height=400)
-            st.plotly_chart(cac_fig, use_container_width=True)
+            st.plotly_chart(figures['true_cac'], use_container_width=True)
             
         with tab3:
-            customers_fig = px.bar(
-                acquisition_cost_dataframe,
-                x='channel',
-                y='customers_acquired',
-                labels={'customers_acquired': 'Customers', 'channel': 'Channel'}
+            st.plotly_chart(figures['customers_acquired'], use_container_width=True)
+
+        with tab4:
+            st.write("How far true CAC moves when costs vary: each scenario draws every channel's direct spend and overhead, and the indirect cost total, independently within the ranges below.")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                spend_range = st.slider("Direct spend ±%", 0, 50, 20, step=5, key="true_cac_spend_range")
+            with col2:
+                indirect_range = st.slider("Indirect cost ±%", 0, 50, 20, step=5, key="true_cac_indirect_range")
+            with col3:
+                overhead_range = st.slider("Staff, technology and returns ±%", 0, 50, 20, step=5, key="true_cac_overhead_range")
+
+            bands = sensitivity_bands(
+                CacScenarioModel(cac_inputs),
+                spend_range=spend_range / 100, indirect_range=indirect_range / 100, overhead_range=overhead_range / 100
+            )
+            if filters is not None and filters['channels']:
+                bands = bands[bands['channel'].isin(filters['channels'])].reset_index(drop=True)
+            st.plotly_chart(get_sensitivity_figure(bands), use_container_width=True)
+            st.caption("Bars show the current true CAC; whiskers span the 5th to 95th percentile of the scenarios.")
+            st.dataframe(
+                bands.rename(columns={'true_cac': 'True CAC', 'low': '5th percentile', 'median': 'Median', 'high': '95th percentile'}),
+                use_container_width=True, hide_index=True
             )
-            customers_fig.update_layout(height=400)
-            st.plotly_chart(customers_fig, use_container_width=True)
         
         with st.expander("Acquisition cost table"):
             display_df = acquisition_cost_dataframe.copy()
@@ -92,7 +117,13 @@ try:
                     display_df[col] = display_df[col].apply(lambda x: f"${x:,.2f}")
             
             st.dataframe(display_df, use_container_width=True)
+
+        if credits is not None:
+            with st.expander("Conversions credited by touchpoint channel"):
+                st.dataframe(credits_by_channel(credits).round(1), use_container_width=True)
             
 except Exception as error:
     st.error(f"Error loading customer acquisition cost data: {error}")
-    st.write("Please check your data source and try again.")
\ No newline at end of file
+    st.write("Please check your data source and try again.")
+
+render_diagnostics(page_trace)
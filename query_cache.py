@@ -0,0 +1,218 @@
+"""
+Persistent on-disk cache of query results, shared by every app process on the host.
+
+Results are stored as uncompressed Arrow IPC files named after a hash of the
+normalized SQL and a data-version token, so a restarted or newly deployed app starts
+warm and a change to the source data (a new token) never serves old results. Hits are
+memory-mapped: numeric columns are handed to pandas without copying, and several
+worker processes reading the same entry share its pages in the OS page cache.
+
+Entries are written to a temporary file and renamed into place, so readers never see
+a partial file. Reading an entry bumps its modification time, and once the directory
+grows past max_bytes the least recently used entries are deleted.
+
+Usage:
+    cache = QueryResultCache("query_cache", max_bytes=10 * 1024 ** 3)
+    df = cache.get(sql, version)
+    if df is None:
+        df = run_query(sql)
+        cache.put(sql, version, df)
+    cache.stats()
+"""
+import hashlib
+import os
+import threading
+import uuid
+
+import pyarrow as pa
+
+import tracing
+
+ENTRY_SUFFIX = ".arrow"
+
+class QueryResultCache:
+    """
+    Arrow IPC files under directory, keyed by normalized SQL and data version.
+
+    The hit/miss/byte counters are per process; entries and bytes are read from the
+    directory, so they include what other processes wrote.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, query, version):
+        """File an entry for query at version is stored in"""
+        key = hashlib.sha1(f"{version}\n{tracing.normalize_sql(query)}".encode()).hexdigest()
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, query, version):
+        """Return the cached result as a DataFrame, or None on a miss"""
+        table = self._read(query, version)
+        if table is None:
+            return None
+        return table.to_pandas(date_as_object=False, split_blocks=True)
+
+    def read_batches(self, query, version):
+        """Return the cached result as a list of Arrow record batches in write order, or None on a miss"""
+        table = self._read(query, version)
+        if table is None:
+            return None
+        return table.to_batches()
+
+    def put(self, query, version, df):
+        """Store a query result; failures to write only skip caching it"""
+        writer = self.writer(query, version)
+        try:
+            writer.write(df)
+            writer.commit()
+        finally:
+            writer.abort()
+
+    def writer(self, query, version):
+        """Start an entry written one DataFrame chunk at a time; it becomes visible on commit()"""
+        return _EntryWriter(self, self.path(query, version))
+
+    def clear(self):
+        """Delete every entry"""
+        for path, _, _ in self._entries():
+            _remove(path)
+
+    def stats(self):
+        """Return hit/miss/write counters, bytes read and written, and the size on disk"""
+        entries = self._entries()
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self.writes,
+                'evictions': self.evictions,
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+            }
+
+    def _read(self, query, version):
+        path = self.path(query, version)
+        try:
+            source = pa.memory_map(path)
+            table = pa.ipc.open_file(source).read_all()
+        except (FileNotFoundError, pa.ArrowInvalid):
+            # Missing, or evicted/replaced by another process while being opened
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(path)  # Mark as recently used for LRU eviction
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+            self.bytes_read += source.size()
+        return table
+
+    def _committed(self, nbytes):
+        with self._lock:
+            self.writes += 1
+            self.bytes_written += nbytes
+        self._evict()
+
+    def _evict(self):
+        """Delete least recently used entries until the directory fits in max_bytes"""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if _remove(path):
+                with self._lock:
+                    self.evictions += 1
+            total -= size
+
+    def _entries(self):
+        """(path, bytes, last used) of every committed entry"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(ENTRY_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+class _EntryWriter:
+    """
+    Writes an entry to a temporary file and renames it into place on commit().
+
+    The first chunk fixes the schema. A chunk that cannot be written (e.g. a column
+    whose type differs from the first chunk's) abandons the entry instead of raising.
+    """
+
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        self.temporary_path = os.path.join(cache.directory, f".{uuid.uuid4().hex}.tmp")
+        self._sink = None
+        self._writer = None
+        self._failed = False
+
+    def write(self, df):
+        if self._failed:
+            return
+        try:
+            batch = pa.RecordBatch.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._sink = pa.OSFile(self.temporary_path, "wb")
+                self._writer = pa.ipc.new_file(self._sink, batch.schema)
+            self._writer.write_batch(batch)
+        except (pa.ArrowException, OSError, ValueError, TypeError):
+            self.abort()
+            self._failed = True
+
+    def commit(self):
+        """Publish the entry; returns whether it was written"""
+        if self._failed or self._writer is None:
+            return False
+        try:
+            self._close()
+            nbytes = os.path.getsize(self.temporary_path)
+            if nbytes > self.cache.max_bytes:
+                return False  # Too large to cache at all; abort() deletes it
+            os.replace(self.temporary_path, self.path)
+        except OSError:
+            return False
+        self.cache._committed(nbytes)
+        return True
+
+    def abort(self):
+        """Drop an uncommitted entry; a no-op after commit()"""
+        self._close()
+        _remove(self.temporary_path)
+
+    def _close(self):
+        writer, sink = self._writer, self._sink
+        self._writer = self._sink = None
+        if writer is not None:
+            writer.close()
+        if sink is not None:
+            sink.close()
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
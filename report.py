@@ -0,0 +1,302 @@
+"""
+Generate the dashboards' tables and charts without the Streamlit UI, e.g. for the weekly email.
+
+Each report variant is a date window and/or a set of customer segments, answered the
+same way the pages answer their sidebar filters: from the filter index, or from the
+analytics cube when the variant has no filters. Every (variant, analysis) pair runs as
+one task in a process pool that writes its tables as CSV and its Plotly figures as
+standalone HTML (and PNG with --png, which needs the kaleido package). The datasets
+are loaded once before the pool starts; forked workers share them copy-on-write.
+
+Output layout: <output dir>/<variant>/<analysis>/<table>.csv and <figure>.html, plus
+manifest.json listing every file written and how long each task took.
+
+Usage:
+    python report.py                                   # unfiltered, into reports/<today>/
+    python report.py --split month --start 2024-01-01 --end 2024-06-30
+    python report.py --window 2024-01-01:2024-03-31 --window 2024-04-01:2024-06-30 --segments New,Frequent --segments High-Value
+    python report.py --analyses true_cac --png --workers 8 --output-dir reports/weekly
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+import pandas as pd
+
+ANALYSES = ['customer_segment', 'omnichannel', 'true_cac']
+
+# Window lengths for --split, as pandas period frequencies
+SPLITS = {'week': 'W', 'month': 'M', 'quarter': 'Q', 'year': 'Y'}
+
+DEFAULT_OUTPUT_ROOT = "reports"
+
+# What the workers read: the filter index (when a variant is filtered), the cube and
+# the unfiltered omnichannel customers. Set in the parent before the pool starts.
+_shared = {}
+
+def _set_shared(shared):
+    _shared.update(shared)
+
+def build_variants(windows=(), segment_sets=(), split=None, start=None, end=None, date_range=None):
+    """
+    Every combination of the requested date windows and segment sets.
+
+    Args:
+        windows (list): (start, end) date pairs
+        segment_sets (list): Lists of segment names
+        split (str): Also cut [start, end] into SPLITS windows, e.g. 'month'
+        start (date): First day for split (default: first date in date_range)
+        end (date): Last day for split (default: last date in date_range)
+        date_range (tuple): The data's (first, last) date
+
+    Returns:
+        list: Variants as dicts with name, start, end and segments (None when unfiltered)
+    """
+    windows = list(windows)
+    if split:
+        if date_range is None and (start is None or end is None):
+            raise ValueError("--split needs --start and --end when the data has no dates")
+        start = start or date_range[0]
+        end = end or date_range[1]
+        for period in pd.period_range(start, end, freq=SPLITS[split]):
+            windows.append((max(period.start_time.date(), start), min(period.end_time.date(), end)))
+
+    variants = []
+    for window, segments in itertools.product(windows or [None], segment_sets or [None]):
+        name_parts = []
+        if window is not None:
+            name_parts.append(f"{window[0]:%Y-%m-%d}_to_{window[1]:%Y-%m-%d}")
+        if segments is not None:
+            name_parts.append("segments-" + "+".join(segment.replace(" ", "-") for segment in segments))
+        variants.append({
+            'name': "__".join(name_parts) or "all",
+            'start': window[0] if window else None,
+            'end': window[1] if window else None,
+            'segments': list(segments) if segments else None,
+        })
+    return variants
+
+def _filters(variant):
+    """The FilterIndex arguments for a variant, or None when it is unfiltered"""
+    if variant['start'] is None and variant['end'] is None and variant['segments'] is None:
+        return None
+    return {'start': variant['start'], 'end': variant['end'], 'segments': variant['segments'], 'channels': None}
+
+def run_analysis(analysis, filters):
+    """
+    Run one analysis the way its page does, unfiltered or for the given filters.
+
+    Returns:
+        tuple: (tables, figures), each a dict of name -> DataFrame / Plotly figure
+    """
+    index = _shared.get('filter_index')
+
+    if analysis == 'customer_segment':
+        from utils.customer_segment import get_customer_segment_analysis
+        cube = _shared['cube'] if filters is None else {'segment_channel': index.segment_channel(**filters)}
+        results = get_customer_segment_analysis(cube=cube)
+        tables = {name: results[name] for name in ('count_pivot', 'ltv_summary', 'segment_counts')}
+        tables.update({f"channel_insights_{name}": table for name, table in results['channel_insights'].items()})
+        return tables, {'count_chart': results['count_chart'], 'ltv_bar_chart': results['ltv_bar_chart']}
+
+    if analysis == 'omnichannel':
+        from utils.omnichannel_analysis import get_omnichannel_analysis
+        if filters is None:
+            cube, customers = _shared['cube'], _shared['omnichannel_customers']
+        else:
+            customers, cohort_ltv_sketches = index.omnichannel(**filters)
+            cube = {'cohort_ltv_sketches': cohort_ltv_sketches}
+        summary, customers, bar_chart, box_plot = get_omnichannel_analysis(cube=cube, customers=customers)
+        return {'summary': summary, 'customers': customers}, {'ltv_by_cohort': bar_chart, 'ltv_distribution': box_plot}
+
+    if analysis == 'true_cac':
+        from utils.true_customer_acquisition_cost import get_cac_figures, get_final_df
+        if filters is None:
+            cube = _shared['cube']
+        else:
+            cube = {f"cac_{name}": table for name, table in index.cac_inputs(**filters).items()}
+        final_df = get_final_df(cube=cube)
+        if final_df is None:
+            raise RuntimeError("the True CAC analysis failed; see the error printed above")
+        return {'true_cac': final_df}, get_cac_figures(final_df) if not final_df.empty else {}
+
+    raise KeyError(analysis)
+
+def _write_outputs(directory, tables, figures, png=False):
+    """Write tables as CSV and figures as HTML (and PNG); returns the paths written"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, table in tables.items():
+        path = os.path.join(directory, f"{name}.csv")
+        # Keep meaningful indexes such as the cohort or segment, drop plain row numbers
+        table.to_csv(path, index=not isinstance(table.index, pd.RangeIndex))
+        paths.append(path)
+    for name, figure in figures.items():
+        path = os.path.join(directory, f"{name}.html")
+        figure.write_html(path, include_plotlyjs='cdn')
+        paths.append(path)
+        if png:
+            path = os.path.join(directory, f"{name}.png")
+            figure.write_image(path)
+            paths.append(path)
+    return paths
+
+def _run_task(variant, analysis, output_dir, png):
+    start = time.perf_counter()
+    tables, figures = run_analysis(analysis, _filters(variant))
+    paths = _write_outputs(os.path.join(output_dir, variant['name'], analysis), tables, figures, png)
+    return {
+        'variant': variant['name'],
+        'analysis': analysis,
+        'files': [os.path.relpath(path, output_dir) for path in paths],
+        'seconds': time.perf_counter() - start,
+    }
+
+def load_shared(variants, analyses):
+    """Load everything the tasks read, once, before the workers start"""
+    shared = {}
+    filtered = any(_filters(variant) is not None for variant in variants)
+    unfiltered = any(_filters(variant) is None for variant in variants)
+    if filtered:
+        from utils.filter_index import get_filter_index
+        shared['filter_index'] = get_filter_index()
+    if unfiltered:
+        from utils.analytics_cube import get_cube
+        shared['cube'] = get_cube()
+        if 'omnichannel' in analyses:
+            from utils.omnichannel_analysis import get_omnichannel_customers
+            shared['omnichannel_customers'] = get_omnichannel_customers()
+    return shared
+
+def generate_reports(variants, analyses, output_dir, workers=None, png=False, shared=None):
+    """
+    Run every (variant, analysis) task and write its outputs under output_dir.
+
+    Args:
+        variants (list): From build_variants()
+        analyses (list): Names from ANALYSES
+        output_dir (str): Directory receiving one subdirectory per variant
+        workers (int): Worker processes (default: one per core); 1 runs in this process
+        png (bool): Also write each figure as PNG (needs kaleido)
+        shared (dict): What load_shared() returns, if already loaded
+
+    Returns:
+        list: One dict per task with variant, analysis, files and seconds, or error
+    """
+    _set_shared(shared if shared is not None else load_shared(variants, analyses))
+    tasks = [(variant, analysis) for variant in variants for analysis in analyses]
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+
+    results = []
+    if workers <= 1:
+        for variant, analysis in tasks:
+            results.append(_run_task_safely(variant, analysis, output_dir, png))
+        return results
+
+    # Forked workers inherit the loaded data without copying it; other platforms
+    # receive a pickled copy through the initializer
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context(method),
+        initializer=_set_shared, initargs=(_shared,)
+    ) as executor:
+        futures = {
+            executor.submit(_run_task_safely, variant, analysis, output_dir, png): (variant, analysis)
+            for variant, analysis in tasks
+        }
+        for future in as_completed(futures):
+            results.append(future.result())
+    order = {(variant['name'], analysis): position for position, (variant, analysis) in enumerate(tasks)}
+    return sorted(results, key=lambda result: order[(result['variant'], result['analysis'])])
+
+def _run_task_safely(variant, analysis, output_dir, png):
+    """Run a task, reporting a failure instead of raising so the other tasks still finish"""
+    try:
+        return _run_task(variant, analysis, output_dir, png)
+    except Exception as error:
+        return {'variant': variant['name'], 'analysis': analysis, 'files': [], 'error': repr(error)}
+
+def _parse_window(value):
+    try:
+        start, end = (date.fromisoformat(part) for part in value.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected START:END as YYYY-MM-DD:YYYY-MM-DD, got {value!r}")
+    if end < start:
+        raise argparse.ArgumentTypeError(f"window {value!r} ends before it starts")
+    return start, end
+
+def _parse_segments(value):
+    return [segment.strip() for segment in value.split(",") if segment.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the dashboards' tables and charts for date windows and segments")
+    parser.add_argument("--window", action="append", type=_parse_window, default=[],
+                        help="Date window START:END (inclusive); repeat for several")
+    parser.add_argument("--split", choices=SPLITS, help="Also report every week/month/quarter/year from --start to --end")
+    parser.add_argument("--start", type=date.fromisoformat, help="First day for --split (default: first date in the data)")
+    parser.add_argument("--end", type=date.fromisoformat, help="Last day for --split (default: last date in the data)")
+    parser.add_argument("--segments", action="append", type=_parse_segments, default=[],
+                        help="Comma-separated customer segments to report together; repeat for several sets")
+    parser.add_argument("--analyses", nargs="+", choices=ANALYSES, default=ANALYSES, help="Analyses to run (default: all)")
+    parser.add_argument("--output-dir", help=f"Output directory (default: {DEFAULT_OUTPUT_ROOT}/<today>)")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per core)")
+    parser.add_argument("--png", action="store_true", help="Also write figures as PNG (needs kaleido)")
+    args = parser.parse_args(argv)
+
+    if args.png and importlib.util.find_spec("kaleido") is None:
+        parser.error("--png needs the kaleido package: pip install kaleido")
+
+    start = time.perf_counter()
+    date_range = None
+    if args.split and (args.start is None or args.end is None):
+        from utils.filter_index import get_filter_index
+        date_range = get_filter_index().date_range()
+    try:
+        variants = build_variants(args.window, args.segments, args.split, args.start, args.end, date_range)
+    except ValueError as error:
+        parser.error(str(error))
+
+    output_dir = args.output_dir or os.path.join(DEFAULT_OUTPUT_ROOT, date.today().isoformat())
+    shared = load_shared(variants, args.analyses)
+    loaded = time.perf_counter()
+
+    index = shared.get('filter_index')
+    if index is not None:
+        unknown = sorted({segment for variant in variants for segment in variant['segments'] or []} - set(index.segments))
+        if unknown:
+            parser.error(f"unknown segment(s) {unknown}; the data has {list(index.segments)}")
+
+    results = generate_reports(variants, args.analyses, output_dir, args.workers, args.png, shared)
+    finished = time.perf_counter()
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "manifest.json"), "w") as manifest_file:
+        json.dump({
+            'generated_at': pd.Timestamp.now(tz='UTC').isoformat(),
+            'variants': [
+                {**variant, 'start': variant['start'] and variant['start'].isoformat(),
+                 'end': variant['end'] and variant['end'].isoformat()}
+                for variant in variants
+            ],
+            'load_seconds': loaded - start,
+            'report_seconds': finished - loaded,
+            'tasks': results,
+        }, manifest_file, indent=2)
+
+    failures = [result for result in results if 'error' in result]
+    for result in failures:
+        print(f"FAILED {result['variant']}/{result['analysis']}: {result['error']}")
+    print(
+        f"Wrote {sum(len(result['files']) for result in results)} files for {len(variants)} variant(s) x "
+        f"{len(args.analyses)} analyses to {output_dir} (load {loaded - start:.1f}s, reports {finished - loaded:.1f}s)"
+    )
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
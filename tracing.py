@@ -0,0 +1,222 @@
+"""
+Lightweight tracing for queries and analysis stages.
+
+Every query run through data_handler is recorded with a hash of its SQL, the Snowflake
+query id, execute/fetch/conversion seconds, rows and bytes. Analyses wrap their stages
+in span() blocks. Records go to an in-memory ring buffer (and to TRACE_JSONL_PATH when
+set), into the trace() that is active when they happen, and into running totals that
+prometheus_text() exposes for monitoring.
+
+Usage:
+    with tracing.trace("customer_segment_page") as page_trace:
+        results = get_customer_segment_analysis()
+    page_trace.queries, page_trace.spans
+"""
+import contextvars
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Number of recent query and span records kept in memory
+trace_buffer_size = int(os.getenv("TRACE_BUFFER_SIZE", 10000))
+
+# Append every record to this JSON lines file as it happens (unset disables it)
+trace_jsonl_path = os.getenv("TRACE_JSONL_PATH")
+
+METRIC_PREFIX = "eic"
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+_records = deque(maxlen=trace_buffer_size)
+_query_totals = {}
+_span_totals = {}
+_lock = threading.Lock()
+
+class Trace:
+    """Records collected while a trace() block is active, including those from worker threads"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.time()
+        self.seconds = None
+        self.queries = []
+        self.spans = []
+
+    def records(self):
+        return sorted(self.queries + self.spans, key=lambda record: record['timestamp'])
+
+    def to_jsonl(self):
+        return "".join(json.dumps(record, default=str) + "\n" for record in self.records())
+
+def normalize_sql(sql):
+    """Query text with runs of whitespace collapsed, so formatting does not change its identity"""
+    return re.sub(r"\s+", " ", sql).strip()
+
+def sql_hash(sql):
+    """Short stable hash of a query, ignoring whitespace differences"""
+    return hashlib.sha1(normalize_sql(sql).encode()).hexdigest()[:12]
+
+@contextmanager
+def trace(name):
+    """Collect every query and span recorded inside the block into a Trace"""
+    collected = Trace(name)
+    token = _current_trace.set(collected)
+    start = time.perf_counter()
+    try:
+        with span(name):
+            yield collected
+    finally:
+        collected.seconds = time.perf_counter() - start
+        _current_trace.reset(token)
+
+@contextmanager
+def span(name, **attributes):
+    """Time the block as a named stage nested under the currently open span"""
+    parent = _current_span.get()
+    token = _current_span.set(name)
+    timestamp = time.time()
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        seconds = time.perf_counter() - start
+        _current_span.reset(token)
+        _record('spans', {
+            'type': 'span',
+            'name': name,
+            'parent': parent,
+            'timestamp': timestamp,
+            'seconds': seconds,
+            'thread': threading.current_thread().name,
+            **attributes,
+        })
+        with _lock:
+            totals = _span_totals.setdefault(name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+def traced(name):
+    """Decorator that runs the function inside span(name)"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def propagate(function):
+    """
+    Bind function to the caller's trace and span so work submitted to a thread pool
+    is recorded under them. Call once per submit.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+def record_query(sql, rows, bytes, execute_seconds, fetch_seconds, conversion_seconds=0.0, query_id=None):
+    """
+    Record one query.
+
+    Args:
+        sql (str): Query text; only its hash and the first 200 characters are kept
+        rows (int): Rows returned
+        bytes (int): In-memory size of the returned frame (object payloads not counted)
+        execute_seconds (float): Time in cursor.execute, i.e. server time as seen by the client
+        fetch_seconds (float): Time fetching and building the result
+        conversion_seconds (float): Time converting Snowflake types and column names
+        query_id (str): Snowflake query id, for looking the query up in QUERY_HISTORY
+    """
+    digest = sql_hash(sql)
+    _record('queries', {
+        'type': 'query',
+        'sql_hash': digest,
+        'sql': sql[:200],
+        'query_id': query_id,
+        'span': _current_span.get(),
+        'timestamp': time.time() - execute_seconds - fetch_seconds - conversion_seconds,
+        'execute_seconds': execute_seconds,
+        'fetch_seconds': fetch_seconds,
+        'conversion_seconds': conversion_seconds,
+        'rows': rows,
+        'bytes': bytes,
+        'thread': threading.current_thread().name,
+    })
+    with _lock:
+        totals = _query_totals.setdefault(digest, {
+            'count': 0, 'execute': 0.0, 'fetch': 0.0, 'conversion': 0.0, 'rows': 0, 'bytes': 0
+        })
+        totals['count'] += 1
+        totals['execute'] += execute_seconds
+        totals['fetch'] += fetch_seconds
+        totals['conversion'] += conversion_seconds
+        totals['rows'] += rows
+        totals['bytes'] += bytes
+
+def _record(kind, record):
+    active = _current_trace.get()
+    if active is not None:
+        getattr(active, kind).append(record)
+        record['trace'] = active.name
+    _records.append(record)
+    if trace_jsonl_path:
+        line = json.dumps(record, default=str) + "\n"
+        with _lock, open(trace_jsonl_path, "a") as jsonl_file:
+            jsonl_file.write(line)
+
+def recent_records():
+    """The most recent query and span records, oldest first"""
+    return list(_records)
+
+def export_jsonl(path, records=None):
+    """Write records (default: the recent ones) to path as JSON lines; returns the count"""
+    records = recent_records() if records is None else records
+    with open(path, "w") as jsonl_file:
+        for record in records:
+            jsonl_file.write(json.dumps(record, default=str) + "\n")
+    return len(records)
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+def prometheus_text():
+    """Running query and span totals since process start in the Prometheus text format"""
+    with _lock:
+        queries = {digest: dict(totals) for digest, totals in _query_totals.items()}
+        spans = {name: list(totals) for name, totals in _span_totals.items()}
+
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+        lines.extend(f"{METRIC_PREFIX}_{name}{labels} {value}" for labels, value in samples)
+
+    metric("queries_total", "counter", "Queries run, by SQL hash.",
+           [(_labels(sql_hash=digest), totals['count']) for digest, totals in queries.items()])
+    metric("query_seconds_total", "counter", "Seconds spent per query phase, by SQL hash.",
+           [(_labels(sql_hash=digest, phase=phase), totals[phase])
+            for digest, totals in queries.items() for phase in ('execute', 'fetch', 'conversion')])
+    metric("query_rows_total", "counter", "Rows returned, by SQL hash.",
+           [(_labels(sql_hash=digest), totals['rows']) for digest, totals in queries.items()])
+    metric("query_bytes_total", "counter", "Bytes of returned frames, by SQL hash.",
+           [(_labels(sql_hash=digest), totals['bytes']) for digest, totals in queries.items()])
+    metric("spans_total", "counter", "Completed spans, by name.",
+           [(_labels(span=name), totals[0]) for name, totals in spans.items()])
+    metric("span_seconds_total", "counter", "Seconds spent in spans, by name.",
+           [(_labels(span=name), totals[1]) for name, totals in spans.items()])
+
+    return "\n".join(lines) + "\n"
+
+def reset():
+    """Clear the recent records and the running totals"""
+    with _lock:
+        _records.clear()
+        _query_totals.clear()
+        _span_totals.clear()
@@ -0,0 +1,89 @@
+from data_handler import dataset_cache, fetch_data_as_dataframe_standardized
+
+# SQL templates for the measures an aggregation can push down
+AGGREGATE_FUNCTIONS = {
+    'rows': 'COUNT(*)',
+    'count': 'COUNT({column})',
+    'sum': 'SUM({column})',
+}
+
+def deduplicated_union_sql(tables, key, columns):
+    """
+    Build SQL for the UNION ALL of tables keeping only the first row per key.
+
+    This is the warehouse equivalent of pd.concat(...).drop_duplicates(subset=[key], keep='first')
+    in the data_handler loaders: rows from earlier tables win over rows from later ones.
+    Duplicate keys within a single table have no defined order in SQL, just as they have
+    no defined fetch order in the pandas path.
+
+    Args:
+        tables (list): Table names in priority order, e.g. ['CUSTOMERS', 'CUSTOMERS_EXTRA']
+        key (str): Column identifying a row, e.g. 'customer_id'
+        columns (list): Columns to keep
+
+    Returns:
+        str: SQL query
+    """
+    column_list = ", ".join(columns)
+    union = "\n        UNION ALL\n        ".join(
+        f"SELECT {column_list}, {position} AS source_order FROM {table}"
+        for position, table in enumerate(tables)
+    )
+    return f"""SELECT {column_list} FROM (
+    SELECT {column_list}, ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY source_order) AS row_rank
+    FROM (
+        {union}
+    ) unioned
+) ranked
+WHERE row_rank = 1"""
+
+def compile_grouped_aggregation(source_sql, group_by, measures):
+    """
+    Build SQL that groups the rows of source_sql and computes additive measures.
+
+    NULL group keys are kept as their own groups so that client-side roll-ups can
+    reproduce pandas' dropna behaviour for whichever keys they group on.
+
+    Args:
+        source_sql (str): Query producing the rows to aggregate
+        group_by (list): Columns to group on
+        measures (dict): Output name -> (function, column), with function one of
+            'rows' (COUNT(*)), 'count' (non-null count) or 'sum'
+
+    Returns:
+        str: SQL query
+    """
+    select_list = list(group_by)
+    for name, (function, column) in measures.items():
+        select_list.append(f"{AGGREGATE_FUNCTIONS[function].format(column=column)} AS {name}")
+
+    return f"""SELECT {', '.join(select_list)}
+FROM (
+{source_sql}
+) deduplicated
+GROUP BY {', '.join(group_by)}"""
+
+def fetch_grouped_aggregation(tables, key, group_by, measures):
+    """
+    Run a grouped aggregation over the deduplicated union of tables in the warehouse.
+
+    Only the small aggregated result is transferred. Results are kept in the shared
+    dataset cache and are invalidated along with the source tables.
+
+    Returns:
+        pd.DataFrame: One row per group with the group_by columns and one column per measure;
+            'sum' measures over groups with no values are 0, as in pandas
+    """
+    source_columns = list(dict.fromkeys(
+        [key] + list(group_by) + [column for _, column in measures.values() if column is not None]
+    ))
+    sql = compile_grouped_aggregation(deduplicated_union_sql(tables, key, source_columns), group_by, measures)
+
+    def load():
+        aggregated = fetch_data_as_dataframe_standardized(sql)
+        for name, (function, _) in measures.items():
+            if function == 'sum':
+                aggregated[name] = aggregated[name].astype('float64').fillna(0)
+        return aggregated
+
+    return dataset_cache.get_or_load(tables, [sql], load)
@@ -0,0 +1,173 @@
+"""
+Analytics cube: the small pre-aggregated tables every page is answered from.
+
+The cube is built once per data refresh from the raw datasets and persisted as
+Parquet under CUBE_DIR, so a restarted app serves pages from the last cube straight
+away. Each table keeps only additive measures or mergeable quantile sketches, so slicing
+it reproduces what the analyses computed from raw rows, with quantiles within the
+sketches' error bound.
+
+Tables:
+    segment_channel: customer_segment, acquisition_channel, n_rows, n_ids, ltv_sum, ltv_n
+    cohort_ltv_sketches: cohort, customer_segment, n, sketch (lifetime value quantile sketches)
+    cac_acquisition: channel, customers_acquired
+    cac_spend: channel, total_direct_spend
+    cac_sessions: channel, count (converted touchpoints)
+    cac_converted: channel, converted_customers
+    cac_conversion_sets: acquisition_channel, converted_channels, customers
+"""
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, pruning still keeps a grace period
+    fcntl = None
+
+import pandas as pd
+
+from data_refresh import get_refreshed, refresh_interval_seconds, register_refresh
+from tracing import traced
+
+# Directory holding the persisted cube versions and the pointer to the current one
+CUBE_DIR = os.getenv(
+    "CUBE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cube")
+)
+CURRENT_FILE = "current.json"
+LOCK_FILE = ".lock"
+
+# Versions kept besides the current one, and the age below which no version is removed,
+# so readers of a previous pointer and other processes still writing their version
+# are never pulled from under
+cube_keep_versions = int(os.getenv("CUBE_KEEP_VERSIONS", 2))
+cube_version_grace_seconds = float(os.getenv("CUBE_VERSION_GRACE_SECONDS", 600))
+
+CUBE_TABLES = [
+    'segment_channel', 'cohort_ltv_sketches',
+    'cac_acquisition', 'cac_spend', 'cac_sessions', 'cac_converted', 'cac_conversion_sets',
+]
+
+@traced('analytics_cube.build')
+def build_cube():
+    """Aggregate the raw datasets into the cube tables"""
+    # Imported here because the analyses read the cube through get_cube()
+    from utils.customer_segment import fetch_segment_channel_aggregates
+    from utils.omnichannel_analysis import get_cohort_ltv_sketches
+    from utils.true_customer_acquisition_cost import fetch_cac_inputs
+
+    cube = {
+        'segment_channel': fetch_segment_channel_aggregates(),
+        'cohort_ltv_sketches': get_cohort_ltv_sketches(),
+    }
+    cube.update({f"cac_{name}": table for name, table in fetch_cac_inputs().items()})
+    return cube
+
+@contextmanager
+def _cube_lock(directory):
+    """Exclusive lock on the cube directory, held by one process at a time"""
+    with open(os.path.join(directory, LOCK_FILE), "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _prune_versions(directory, current_version):
+    """
+    Remove old versions: all but the current one and the newest cube_keep_versions
+    others, and none modified within cube_version_grace_seconds.
+    """
+    versions = sorted(
+        (entry for entry in os.listdir(directory)
+         if entry != current_version and os.path.isdir(os.path.join(directory, entry))),
+        reverse=True
+    )
+    now = time.time()
+    for version in versions[cube_keep_versions:]:
+        path = os.path.join(directory, version)
+        try:
+            if now - os.path.getmtime(path) < cube_version_grace_seconds:
+                continue
+        except FileNotFoundError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+
+def save_cube(cube, directory=None):
+    """
+    Persist the cube as a new version and point current.json at it.
+
+    The pointer is replaced atomically, so readers see either the previous or the
+    new cube in full. Old versions are pruned under a lock shared by every process
+    writing to the directory, keeping recent ones (see _prune_versions) for readers
+    still loading them and for other processes still writing theirs.
+    """
+    directory = directory or CUBE_DIR
+    os.makedirs(directory, exist_ok=True)
+    # The process id keeps versions written at the same moment by two processes apart
+    version = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')}-{os.getpid()}"
+    version_dir = os.path.join(directory, version)
+    os.makedirs(version_dir)
+    for name, table in cube.items():
+        table.to_parquet(os.path.join(version_dir, f"{name}.parquet"), index=False)
+
+    with _cube_lock(directory):
+        pointer = os.path.join(directory, CURRENT_FILE)
+        with open(f"{pointer}.{os.getpid()}.tmp", "w") as pointer_file:
+            json.dump({'version': version, 'built_at': time.time()}, pointer_file)
+        os.replace(f"{pointer}.{os.getpid()}.tmp", pointer)
+        _prune_versions(directory, version)
+    return version_dir
+
+def load_cube(directory=None, max_age_seconds=None):
+    """
+    Read the current persisted cube.
+
+    Returns:
+        dict: Table name -> DataFrame, or None when there is no cube, it is missing a
+            table or it is older than max_age_seconds
+    """
+    directory = directory or CUBE_DIR
+    pointer = os.path.join(directory, CURRENT_FILE)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as pointer_file:
+        current = json.load(pointer_file)
+    if max_age_seconds is not None and time.time() - current['built_at'] > max_age_seconds:
+        return None
+
+    version_dir = os.path.join(directory, current['version'])
+    paths = {name: os.path.join(version_dir, f"{name}.parquet") for name in CUBE_TABLES}
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+    try:
+        return {name: pd.read_parquet(path) for name, path in paths.items()}
+    except FileNotFoundError:
+        return None  # Replaced by a newer version while reading
+
+_loaded_from_disk = False
+
+def _refresh_cube():
+    """Start from the persisted cube when it is recent enough, otherwise rebuild and persist it"""
+    global _loaded_from_disk
+    if not _loaded_from_disk:
+        _loaded_from_disk = True
+        cube = load_cube(max_age_seconds=refresh_interval_seconds)
+        if cube is not None:
+            return cube
+
+    cube = build_cube()
+    save_cube(cube)
+    return cube
+
+register_refresh('analytics_cube', _refresh_cube)
+
+def get_cube():
+    """The current cube tables; shared by every session, so treat them as read-only"""
+    return get_refreshed('analytics_cube')
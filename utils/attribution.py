@@ -0,0 +1,350 @@
+"""
+Multi-touch attribution of conversions to touchpoint channels.
+
+A customer's journey is their touchpoints in time order (ties in load order, missing
+dates first) up to and including their first converted touchpoint. Customers who
+never converted have no journey. Each journey hands out one conversion of credit
+under every model:
+    first_touch: all of it to the first touchpoint
+    last_touch: all of it to the converting touchpoint
+    linear: an equal share to every touchpoint
+    time_decay: shares halving every TIME_DECAY_HALF_LIFE_DAYS before the conversion
+    position_based: POSITION_BASED_ENDS each to the first and the converting
+        touchpoint, the rest split evenly over the ones between (half each for
+        two-touchpoint journeys)
+
+Touchpoints are streamed from CUSTOMER_TOUCHPOINTS and CUSTOMER_TOUCHPOINTS_EXTRA
+(deduplicated, first table wins) in chunks and spilled to ATTRIBUTION_PARTITIONS Arrow
+files by a hash of customer_id, so every journey lands whole in one partition. The
+partitions are read back as many at a time as fit in ATTRIBUTION_MEMORY_BYTES, sorted
+by customer and time, and credited with vectorized group operations. A partition too
+big for the budget on its own is spilled again into smaller ones with another hash.
+Memory therefore follows the chunk size and the budget rather than the table size.
+
+The result is small: credits per model, acquisition channel and touchpoint channel.
+attributed_converted_counts() turns a model's credits into the converted customer
+counts of get_final_df() through the acquisition-to-touchpoint mapping: a customer's
+credit counts for their acquisition channel on the touchpoint channels mapped to it.
+
+Usage:
+    credits = get_attribution_credits()
+    final_df = get_final_df(attribution='time_decay', credits=credits)
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from data_handler import get_dataset, require_columns
+from data_refresh import get_refreshed, get_refreshed_if_ready, register_refresh
+from tracing import span, traced
+from utils.filter_index import TOUCHPOINT_DATE_COLUMN, nanoseconds, stream_dataset
+
+ATTRIBUTION_MODELS = {
+    'first_touch': 'First touch',
+    'last_touch': 'Last touch',
+    'linear': 'Linear',
+    'time_decay': 'Time decay',
+    'position_based': 'Position based',
+}
+
+CUSTOMER_COLUMNS = ['customer_id', 'acquisition_channel']
+TOUCHPOINT_COLUMNS = ['customer_id', 'channel', 'converted_flag', TOUCHPOINT_DATE_COLUMN]
+
+require_columns('customers', CUSTOMER_COLUMNS)
+require_columns('touchpoints', TOUCHPOINT_COLUMNS)
+
+# Hash partitions touchpoints are spilled to, memory for crediting them, and where
+# the spill files go (default: the system temporary directory)
+attribution_partitions = int(os.getenv("ATTRIBUTION_PARTITIONS", 64))
+attribution_memory_bytes = int(os.getenv("ATTRIBUTION_MEMORY_BYTES", 512 * 1024 ** 2))
+attribution_spill_dir = os.getenv("ATTRIBUTION_SPILL_DIR")
+
+time_decay_half_life_days = float(os.getenv("TIME_DECAY_HALF_LIFE_DAYS", 7))
+position_based_ends = float(os.getenv("POSITION_BASED_ENDS", 0.4))
+
+# Peak bytes per touchpoint while a partition is credited: its columns, the sort
+# order, the journey positions and one credit per model
+BYTES_PER_TOUCHPOINT = 160
+
+# Times an oversized partition is split again; a single customer's journey can't be
+MAX_SPILL_DEPTH = 3
+
+NANOSECONDS_PER_DAY = 86_400 * 10 ** 9
+MISSING_TIME = np.iinfo(np.int64).min
+
+def credit_journeys(customers, times, converted, half_life_days=None, ends=None):
+    """
+    Credit the touchpoints of every journey under each model.
+
+    Args:
+        customers (np.ndarray): Customer code of each touchpoint, sorted ascending
+        times (np.ndarray): int64 nanoseconds, ascending within each customer
+        converted (np.ndarray): Converted flag of each touchpoint
+
+    Returns:
+        tuple: (rows, credits) - positions of the touchpoints that are part of a
+            journey, and model -> credit of each of those rows; every journey's
+            credits sum to 1 under each model
+    """
+    half_life_days = time_decay_half_life_days if half_life_days is None else half_life_days
+    ends = position_based_ends if ends is None else ends
+
+    new_customer = np.r_[True, customers[1:] != customers[:-1]] if len(customers) else np.empty(0, dtype=bool)
+    starts = np.flatnonzero(new_customer)
+    journey_of = np.cumsum(new_customer) - 1
+
+    # Each customer's first converted touchpoint ends their journey (-1: none)
+    converted_rows = np.flatnonzero(converted)
+    converting, first = np.unique(journey_of[converted_rows], return_index=True)
+    last_rows = np.full(len(starts), -1)
+    last_rows[converting] = converted_rows[first]
+
+    rows = np.flatnonzero(np.arange(len(customers)) <= last_rows[journey_of])
+    journeys = journey_of[rows]
+    position = rows - starts[journeys]
+    length = (last_rows - starts + 1)[journeys]
+    is_first = position == 0
+    is_last = position == length - 1
+
+    # Older touchpoints weigh less; missing dates count as at the conversion
+    conversion_times = times[last_rows[journeys]]
+    missing = (times[rows] == MISSING_TIME) | (conversion_times == MISSING_TIME)
+    age_days = np.where(missing, 0.0, (conversion_times.astype('float64') - times[rows]) / NANOSECONDS_PER_DAY)
+    decay = np.exp2(-age_days / half_life_days)
+
+    credits = {
+        'first_touch': is_first.astype('float64'),
+        'last_touch': is_last.astype('float64'),
+        'linear': 1.0 / length,
+        'time_decay': decay / np.bincount(journeys, weights=decay, minlength=len(starts))[journeys],
+        'position_based': np.select(
+            [length == 1, length == 2, is_first | is_last],
+            [1.0, 0.5, ends],
+            (1 - 2 * ends) / np.maximum(length - 2, 1)
+        ),
+    }
+    return rows, credits
+
+def _customer_keys(series):
+    """Customer ids in one dtype across chunks, so equal ids always hash alike"""
+    values = series.to_numpy()
+    if values.dtype.kind in 'iuf':
+        return values.astype(np.int64)
+    return values.astype(str).astype(object)
+
+def _encode_touchpoints(batches, vocabulary):
+    """
+    Reduce raw touchpoint chunks to Arrow tables of customer_id, channel code, time
+    and converted flag; touchpoints without a customer or channel are ignored.
+
+    Args:
+        vocabulary (dict): Channel -> code, extended as new channels appear
+    """
+    for batch in batches:
+        batch = batch[batch['customer_id'].notna() & batch['channel'].notna()]
+        if len(batch) == 0:
+            continue
+        codes, channels = pd.factorize(batch['channel'])
+        channel_codes = np.array([vocabulary.setdefault(channel, len(vocabulary)) for channel in channels], dtype=np.int32)
+        yield pa.table({
+            'customer_id': _customer_keys(batch['customer_id']),
+            'channel': channel_codes[codes],
+            'time': nanoseconds(batch[TOUCHPOINT_DATE_COLUMN]),
+            'converted': (batch['converted_flag'] == True).to_numpy(),
+        })
+
+def _partition_of(customer_ids, n_partitions, depth=0):
+    """
+    Partition of each customer id at a spill depth.
+
+    Each depth salts the hash differently, so a partition spilled again spreads over
+    new partitions. (hash_array's hash_key only applies to strings, not numeric ids,
+    so the salted 64-bit hash is hashed again instead.)
+    """
+    hashes = pd.util.hash_array(customer_ids)
+    if depth:
+        hashes = pd.util.hash_array(hashes ^ np.uint64(depth * 0x9E3779B97F4A7C15 % 2 ** 64))
+    return hashes % np.uint64(n_partitions)
+
+def _spill(tables, directory, n_partitions, depth=0, prefix="partition"):
+    """
+    Append each table's (or record batch's) rows to the partition file of their
+    customer_id's hash.
+
+    Returns:
+        list: (path, rows) of every partition written to
+    """
+    writers = {}
+    rows = {}
+    try:
+        for table in tables:
+            partitions = _partition_of(table['customer_id'].to_numpy(zero_copy_only=False), n_partitions, depth)
+            order = np.argsort(partitions, kind='stable')
+            bounds = np.searchsorted(partitions[order], np.arange(n_partitions + 1))
+            table = table.take(order)
+            for partition in np.flatnonzero(np.diff(bounds)):
+                if partition not in writers:
+                    path = os.path.join(directory, f"{prefix}-{partition}.arrow")
+                    writers[partition] = (path, pa.ipc.new_stream(pa.OSFile(path, 'wb'), table.schema))
+                    rows[partition] = 0
+                count = bounds[partition + 1] - bounds[partition]
+                writers[partition][1].write(table.slice(bounds[partition], count))
+                rows[partition] += int(count)
+    finally:
+        for _, writer in writers.values():
+            writer.close()
+    return [(writers[partition][0], rows[partition]) for partition in sorted(writers)]
+
+def _read_partition(path):
+    with pa.OSFile(path, 'rb') as source:
+        return pa.ipc.open_stream(source).read_all()
+
+class _CreditTotals:
+    """Credits summed per model, acquisition channel code and touchpoint channel code"""
+
+    def __init__(self, customers):
+        self.customer_keys = pd.Index(_customer_keys(customers['customer_id']))
+        acquisition_codes, self.acquisition_channels = pd.factorize(customers['acquisition_channel'])
+        self.acquisition_codes = np.append(acquisition_codes, -1)  # Last slot: unknown customers
+        self.totals = {}
+
+    def add(self, table):
+        """Credit the journeys in a table of whole journeys"""
+        customer_ids = table['customer_id'].to_numpy(zero_copy_only=False)
+        customer_codes, unique_ids = pd.factorize(customer_ids)
+        times = table['time'].to_numpy()
+        order = np.lexsort((times, customer_codes))
+        rows, credits = credit_journeys(customer_codes[order], times[order], table['converted'].to_numpy(zero_copy_only=False)[order])
+        rows = order[rows]
+
+        # Customers missing from the customers table have no acquisition channel to credit
+        acquisition_of = self.acquisition_codes[self.customer_keys.get_indexer(unique_ids)]
+        acquisition = acquisition_of[customer_codes[rows]]
+        known = acquisition >= 0
+        channels = table['channel'].to_numpy()[rows][known]
+        width = int(channels.max(initial=0)) + 1
+        keys = acquisition[known].astype(np.int64) * width + channels
+        for model, model_credits in credits.items():
+            sums = np.bincount(keys, weights=model_credits[known])
+            for key in np.flatnonzero(sums):
+                group = (model, key // width, key % width)
+                self.totals[group] = self.totals.get(group, 0.0) + sums[key]
+
+    def frame(self, vocabulary):
+        channels = {code: channel for channel, code in vocabulary.items()}
+        rows = [
+            (model, self.acquisition_channels[acquisition], channels[channel], credit)
+            for (model, acquisition, channel), credit in self.totals.items()
+        ]
+        frame = pd.DataFrame(rows, columns=['model', 'acquisition_channel', 'channel', 'credit']).astype(
+            {'model': object, 'acquisition_channel': object, 'channel': object, 'credit': 'float64'}
+        )
+        return frame.sort_values(['model', 'acquisition_channel', 'channel'], ignore_index=True)
+
+def _credit_partitions(partitions, totals, directory, n_partitions, memory_bytes, depth):
+    """Credit spilled partitions in groups that fit the memory budget"""
+    group, group_rows = [], 0
+
+    def flush():
+        if group:
+            totals.add(pa.concat_tables([_read_partition(path) for path in group]))
+            for path in group:
+                os.remove(path)
+        group.clear()
+
+    for path, rows in partitions:
+        if rows * BYTES_PER_TOUCHPOINT > memory_bytes and depth < MAX_SPILL_DEPTH:
+            with span('attribution.respill'):
+                with pa.OSFile(path, 'rb') as source:
+                    smaller = _spill(pa.ipc.open_stream(source), directory, n_partitions, depth + 1, prefix=os.path.basename(path)[:-len(".arrow")])
+                os.remove(path)
+            _credit_partitions(smaller, totals, directory, n_partitions, memory_bytes, depth + 1)
+            continue
+        if group and (group_rows + rows) * BYTES_PER_TOUCHPOINT > memory_bytes:
+            flush()
+            group_rows = 0
+        group.append(path)
+        group_rows += rows
+    flush()
+
+@traced('attribution.compute')
+def compute_attribution(touchpoint_batches, customers, n_partitions=None, memory_bytes=None, spill_dir=None):
+    """
+    Credit every customer's journey under each attribution model.
+
+    Args:
+        touchpoint_batches (iterable): DataFrame chunks with TOUCHPOINT_COLUMNS
+        customers (pd.DataFrame): customer_id, acquisition_channel (deduplicated)
+        n_partitions (int): Hash partitions (default: ATTRIBUTION_PARTITIONS)
+        memory_bytes (int): Budget for crediting (default: ATTRIBUTION_MEMORY_BYTES)
+        spill_dir (str): Parent of the spill directory (default: ATTRIBUTION_SPILL_DIR)
+
+    Returns:
+        pd.DataFrame: model, acquisition_channel, channel, credit for every nonzero credit
+    """
+    n_partitions = n_partitions or attribution_partitions
+    memory_bytes = memory_bytes or attribution_memory_bytes
+    vocabulary = {}
+    totals = _CreditTotals(customers)
+    with tempfile.TemporaryDirectory(prefix="attribution-", dir=spill_dir or attribution_spill_dir) as directory:
+        with span('attribution.spill'):
+            partitions = _spill(_encode_touchpoints(touchpoint_batches, vocabulary), directory, n_partitions)
+        with span('attribution.credit'):
+            _credit_partitions(partitions, totals, directory, n_partitions, memory_bytes, depth=0)
+    return totals.frame(vocabulary)
+
+def build_attribution_credits():
+    """Stream the touchpoints and credit them under every model"""
+    with span('attribution.load'):
+        customers = get_dataset('customers', CUSTOMER_COLUMNS)
+    return compute_attribution(stream_dataset('touchpoints', TOUCHPOINT_COLUMNS), customers)
+
+register_refresh('cac_attribution', build_attribution_credits)
+
+def get_attribution_credits(wait=True):
+    """
+    The current attribution credits (see compute_attribution); shared by every
+    session, so treat them as read-only.
+
+    With wait=False, returns None instead of blocking while they are first computed
+    in the background.
+    """
+    return get_refreshed('cac_attribution') if wait else get_refreshed_if_ready('cac_attribution')
+
+def attributed_converted_counts(credits, model, acquisition_to_touchpoint_mapping):
+    """
+    Converted customers per acquisition channel as credited by model.
+
+    Returns:
+        pd.DataFrame: channel, converted_customers (fractional credit) for every
+            mapped acquisition channel, like get_converted_customer_counts()
+    """
+    mapping = pd.DataFrame(
+        [
+            (acquisition_channel, touchpoint_channel)
+            for acquisition_channel, touchpoint_channels in acquisition_to_touchpoint_mapping.items()
+            for touchpoint_channel in set(touchpoint_channels)
+        ],
+        columns=['acquisition_channel', 'channel']
+    )
+    counts = (
+        credits[credits['model'] == model]
+        .merge(mapping, on=['acquisition_channel', 'channel'])
+        .groupby('acquisition_channel')['credit'].sum()
+        .reindex(list(acquisition_to_touchpoint_mapping), fill_value=0.0)
+    )
+    return pd.DataFrame({'channel': counts.index, 'converted_customers': counts.to_numpy()})
+
+def credits_by_channel(credits):
+    """Conversions credited to each touchpoint channel, one column per model"""
+    table = credits.pivot_table(index='channel', columns='model', values='credit', aggfunc='sum', fill_value=0.0)
+    table = table.reindex(columns=[model for model in ATTRIBUTION_MODELS if model in table.columns])
+    return table.rename(columns=ATTRIBUTION_MODELS)
+
+# For testing
+if __name__ == "__main__":
+    credits = get_attribution_credits()
+    print(credits_by_channel(credits))
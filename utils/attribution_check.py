@@ -0,0 +1,73 @@
+"""
+Check that attribution spills split oversized partitions and that the credits do not
+depend on how the touchpoints were partitioned, using synthetic touchpoints.
+
+Run with: python -m utils.attribution_check
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from utils.attribution import BYTES_PER_TOUCHPOINT, _spill, compute_attribution
+from utils.filter_index import TOUCHPOINT_DATE_COLUMN
+
+CHANNELS = ['Direct', 'Email', 'Facebook', 'Google', 'Instagram', 'TikTok', 'Walk-in']
+
+def synthetic_touchpoints(n_touchpoints=200_000, n_customers=20_000, seed=0):
+    """Touchpoints and customers with int64 ids, as Snowflake NUMBER columns load"""
+    rng = np.random.default_rng(seed)
+    touchpoints = pd.DataFrame({
+        'customer_id': rng.integers(1, n_customers + 1, n_touchpoints).astype(np.int64),
+        'channel': rng.choice(np.array(CHANNELS, dtype=object), n_touchpoints),
+        'converted_flag': rng.random(n_touchpoints) < 0.1,
+        TOUCHPOINT_DATE_COLUMN: pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365 * 86_400, n_touchpoints), unit='s'),
+    })
+    customers = pd.DataFrame({
+        'customer_id': np.arange(1, n_customers + 1, dtype=np.int64),
+        'acquisition_channel': rng.choice(np.array(CHANNELS, dtype=object), n_customers),
+    })
+    return touchpoints, customers
+
+def check_respill_shrinks(touchpoints, n_partitions=2):
+    """Spilling a partition again must spread it over smaller partitions"""
+    table = pa.Table.from_pandas(touchpoints[['customer_id']], preserve_index=False)
+    with tempfile.TemporaryDirectory() as directory:
+        partitions = _spill([table], directory, n_partitions)
+        for depth in range(1, 4):
+            path, rows = max(partitions, key=lambda partition: partition[1])
+            with pa.OSFile(path, 'rb') as source:
+                partitions = _spill(pa.ipc.open_stream(source), directory, n_partitions, depth, prefix=f"check-{depth}")
+            largest = max(partition_rows for _, partition_rows in partitions)
+            assert largest < 0.75 * rows, f"depth {depth}: {rows} rows re-spilled into partitions of {[r for _, r in partitions]}"
+            print(f"respill depth {depth}: OK ({rows} rows -> {[r for _, r in partitions]})")
+
+def check_partition_invariance(touchpoints, customers):
+    """Credits with a budget forcing re-spills match those from one partition"""
+    chunk_rows = len(touchpoints) // 4 + 1
+    chunks = [touchpoints.iloc[start:start + chunk_rows] for start in range(0, len(touchpoints), chunk_rows)]
+    expected = compute_attribution(chunks, customers, n_partitions=1, memory_bytes=2 ** 40)
+    actual = compute_attribution(chunks, customers, n_partitions=2, memory_bytes=len(touchpoints) // 8 * BYTES_PER_TOUCHPOINT)
+    pd.testing.assert_frame_equal(actual, expected, check_exact=False, rtol=1e-9)
+    per_model = actual.groupby('model')['credit'].sum()
+    assert np.allclose(per_model, per_model.iloc[0]), per_model
+    print(f"partition invariance: OK ({len(actual)} credits, {per_model.iloc[0]:.0f} conversions per model)")
+
+    # A relative spill directory (as ATTRIBUTION_SPILL_DIR may be) must survive re-spills too
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            os.makedirs('spill')
+            relative = compute_attribution(chunks, customers, n_partitions=2, memory_bytes=len(touchpoints) // 8 * BYTES_PER_TOUCHPOINT, spill_dir='spill')
+        finally:
+            os.chdir(working_directory)
+    pd.testing.assert_frame_equal(relative, expected, check_exact=False, rtol=1e-9)
+    print("relative spill directory: OK")
+
+if __name__ == "__main__":
+    touchpoints, customers = synthetic_touchpoints()
+    check_respill_shrinks(touchpoints)
+    check_partition_invariance(touchpoints, customers)
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+# Outliers drawn per box; the rest are summarized by the whiskers
+MAX_OUTLIERS = 200
+
+def _value_at(values, cumulative_counts, position):
+    """Value at a position of the sorted sample that values/counts describe"""
+    return values[np.searchsorted(cumulative_counts, position, side='right')]
+
+def sketch_box_statistics(sketches, group, max_outliers=MAX_OUTLIERS):
+    """
+    Precompute what a box plot draws for each group from quantile sketches of its
+    values, following plotly's defaults.
+
+    Quartiles are the sketches' quantiles: exact and linearly interpolated (plotly's
+    quartilemethod='linear') while a sketch has not compacted, otherwise within its
+    rank error (see utils/quantile_sketch.py). Whiskers reach the furthest retained
+    value within 1.5 IQR of the box, or the exact minimum and maximum when those lie
+    within it. Values beyond the whiskers are outliers: at most max_outliers per
+    group, sampled evenly through the retained outliers weighted by the observations
+    each stands for, with the exact extremes always included. Means are exact.
+
+    Args:
+        sketches (dict): Group name -> KllSketch, in display order
+        group (str): Name of the index of the result
+
+    Returns:
+        pd.DataFrame: Indexed by group with n, q1, median, q3, lowerfence, upperfence,
+            mean and outliers (array of the kept outlier values)
+    """
+    rows = []
+    for name, sketch in sketches.items():
+        if sketch.n == 0:
+            continue
+        q1, median, q3 = sketch.quantiles([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        values, weights = sketch.weighted_values()
+        # The exact extremes are the furthest values, even when compaction dropped them
+        values = np.concatenate([[sketch.min], values, [sketch.max]])
+        weights = np.concatenate([[0], weights, [0]])
+        lower = np.searchsorted(values, q1 - 1.5 * iqr, side='left')
+        upper = np.searchsorted(values, q3 + 1.5 * iqr, side='right')
+        outliers = _sample_outliers(
+            np.concatenate([values[:lower], values[upper:]]),
+            np.concatenate([weights[:lower], weights[upper:]]),
+            max_outliers
+        )
+        extremes = [extreme for extreme, is_outlier in ((sketch.min, lower > 0), (sketch.max, upper < len(values))) if is_outlier]
+        rows.append({
+            group: name,
+            'n': sketch.n,
+            'q1': q1,
+            'median': median,
+            'q3': q3,
+            'lowerfence': values[lower],
+            'upperfence': values[upper - 1],
+            'mean': sketch.mean(),
+            'outliers': np.unique(np.concatenate([outliers, extremes])),
+        })
+
+    return pd.DataFrame(rows, columns=[group, 'n', 'q1', 'median', 'q3', 'lowerfence', 'upperfence', 'mean', 'outliers']).set_index(group)
+
+def _sample_outliers(values, counts, max_outliers):
+    """Up to max_outliers evenly spaced values of the sorted outliers, extremes included"""
+    total = int(counts.sum())
+    if total <= max_outliers:
+        return np.repeat(values, counts)
+    positions = np.linspace(0, total - 1, max_outliers).round()
+    return _value_at(values, np.cumsum(counts), positions)
+
+def summarized_box_figure(stats, title=None):
+    """
+    Build a box plot from sketch_box_statistics output.
+
+    Only the five-number summaries and the sampled outliers are sent to the browser,
+    however many rows the statistics were computed from.
+    """
+    groups = list(stats.index)
+    color = '#636efa'
+    fig = go.Figure()
+    fig.add_trace(go.Box(
+        x=groups,
+        q1=stats['q1'].tolist(),
+        median=stats['median'].tolist(),
+        q3=stats['q3'].tolist(),
+        lowerfence=stats['lowerfence'].tolist(),
+        upperfence=stats['upperfence'].tolist(),
+        marker_color=color,
+        showlegend=False,
+        name='',
+    ))
+    outlier_x = [name for name, outliers in stats['outliers'].items() for _ in range(len(outliers))]
+    if outlier_x:
+        fig.add_trace(go.Scatter(
+            x=outlier_x,
+            y=np.concatenate(stats['outliers'].tolist()),
+            mode='markers',
+            marker=dict(color=color, size=5, opacity=0.7),
+            showlegend=False,
+            name='Outliers',
+        ))
+    fig.update_layout(title=title, xaxis=dict(categoryorder='array', categoryarray=groups))
+    return fig
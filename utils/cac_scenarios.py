@@ -0,0 +1,277 @@
+"""
+What-if scenarios for true CAC, evaluated for thousands of scenarios at once.
+
+A CacScenarioModel takes the aggregated per-channel CAC inputs (from the analytics
+cube or the filter index) once and lays them out as arrays over channels. Scenario
+parameters are arrays over scenarios, or over scenarios and channels, and NumPy
+broadcasts them against the channel arrays, so a batch of scenarios costs a few array
+operations instead of a run of the pipeline each. The model reproduces get_final_df()
+when every parameter is left at its default.
+
+Channel mapping scenarios are answered from the conversion_sets input. It counts
+customers by acquisition channel and the set of touchpoint channels they converted
+on, so any mapping's converted counts are a masked sum over its rows.
+
+Usage:
+    model = CacScenarioModel.from_cube(get_cube())
+    grid = scenario_grid(spend_multiplier=[0.8, 1.0, 1.2], total_indirect_cost=[8000, 10000, 12000])
+    result = model.evaluate(**grid)    # result['true_cac'] has one row per scenario
+    bands = sensitivity_bands(model, spend_range=0.2)
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from tracing import traced
+from utils.true_customer_acquisition_cost import assemble_true_cac, load_cac_config
+
+CAC_INPUT_NAMES = ['acquisition', 'spend', 'sessions', 'converted', 'conversion_sets']
+
+# Scenarios drawn for the page's sensitivity bands, and the quantiles shown
+SENSITIVITY_SCENARIOS = 2000
+SENSITIVITY_QUANTILES = (0.05, 0.5, 0.95)
+
+class CacScenarioModel:
+    """
+    Per-channel true CAC inputs as arrays, in the row order of get_final_df().
+
+    Every evaluate() parameter takes a scalar (all scenarios and channels), a 1-D array
+    (one value per scenario) or a 2-D array of shape (scenarios or 1, channels).
+    """
+
+    def __init__(self, inputs, config=None):
+        """
+        Args:
+            inputs (dict): get_cac_inputs() output, including conversion_sets
+            config (dict): CAC configuration; defaults to load_cac_config()
+        """
+        config = config or load_cac_config()
+        self.config = config
+        self.baseline = assemble_true_cac(inputs, config)
+        self.channels = self.baseline['channel'].tolist()
+
+        self.direct_spend = self.baseline['total_direct_spend'].to_numpy(dtype='float64')
+        self.staff_cost = self.baseline['staff_cost'].to_numpy(dtype='float64')
+        self.technology_cost = self.baseline['technology_cost'].to_numpy(dtype='float64')
+        self.returns_processing_cost = self.baseline['returns_processing_cost'].to_numpy(dtype='float64')
+        self.converted_customers = self.baseline['converted_customers'].to_numpy(dtype='float64')
+        self.total_indirect_cost = float(config['total_indirect_cost'])
+
+        # Indirect cost follows each channel's share of all converted touchpoints,
+        # including channels that have no row of their own
+        sessions = inputs['sessions'].groupby('channel')['count'].sum()
+        self.session_share = np.zeros(len(self.channels))
+        if sessions.sum() > 0:
+            self.session_share = (sessions.reindex(self.channels, fill_value=0) / sessions.sum()).to_numpy(dtype='float64')
+
+        conversion_sets = inputs['conversion_sets']
+        self.touchpoint_channels = sorted(
+            {channel for channels in conversion_sets['converted_channels'] for channel in channels}
+            | {channel for channels in config['acquisition_to_touchpoint_mapping'].values() for channel in channels}
+        )
+        self._bits = {channel: 1 << bit for bit, channel in enumerate(self.touchpoint_channels)}
+        self._set_masks = np.array(
+            [sum(self._bits[channel] for channel in channels) for channels in conversion_sets['converted_channels']],
+            dtype=np.int64
+        )
+        self._set_customers = conversion_sets['customers'].to_numpy(dtype='float64')
+        # Each set's channel position; sets of channels without a row point at an extra all-zero column
+        positions = {channel: position for position, channel in enumerate(self.channels)}
+        self._set_channels = np.array(
+            [positions.get(channel, len(self.channels)) for channel in conversion_sets['acquisition_channel']],
+            dtype=np.int64
+        )
+        self._set_to_channel = np.zeros((len(conversion_sets), len(self.channels)))
+        in_table = self._set_channels < len(self.channels)
+        self._set_to_channel[np.flatnonzero(in_table), self._set_channels[in_table]] = 1.0
+
+    @classmethod
+    def from_cube(cls, cube, config=None):
+        """Build the model from the cac_* tables of the analytics cube"""
+        return cls({name: cube[f"cac_{name}"] for name in CAC_INPUT_NAMES}, config)
+
+    def mapping_masks(self, mappings):
+        """
+        Encode acquisition-to-touchpoint mappings as touchpoint channel bitmasks.
+
+        Returns:
+            np.ndarray: (len(mappings), channels) int64; channels a mapping leaves out get 0
+        """
+        # A grid repeats the same few mapping objects, so encode each one once
+        encoded = {}
+        for mapping in mappings:
+            if id(mapping) not in encoded:
+                encoded[id(mapping)] = [
+                    sum(self._bits.get(touchpoint, 0) for touchpoint in set(mapping.get(channel, ())))
+                    for channel in self.channels
+                ]
+        return np.array([encoded[id(mapping)] for mapping in mappings], dtype=np.int64).reshape(len(mappings), len(self.channels))
+
+    def converted_for(self, mappings):
+        """
+        Converted customers per channel under each mapping.
+
+        Returns:
+            np.ndarray: (len(mappings), channels) float64
+        """
+        masks = np.concatenate([self.mapping_masks(mappings), np.zeros((len(mappings), 1), dtype=np.int64)], axis=1)
+        # A conversion set counts for its acquisition channel when any of its channels is mapped to it
+        counted = (masks[:, self._set_channels] & self._set_masks) != 0
+        return (counted * self._set_customers) @ self._set_to_channel
+
+    @traced('cac_scenarios.evaluate')
+    def evaluate(self, spend_multiplier=1.0, total_indirect_cost=None, indirect_weights=None,
+                 staff_multiplier=1.0, technology_multiplier=1.0, returns_multiplier=1.0, mappings=None):
+        """
+        Evaluate a batch of scenarios.
+
+        Args:
+            spend_multiplier: Scales each channel's direct spend
+            total_indirect_cost: Indirect cost to allocate (default: the configured total)
+            indirect_weights: Split of the indirect cost across channels, normalized per
+                scenario (default: share of converted touchpoints)
+            staff_multiplier, technology_multiplier, returns_multiplier: Scale the
+                configured per-channel indirect cost details
+            mappings (dict or list): Acquisition-to-touchpoint mapping, or one per
+                scenario (default: the configured mapping)
+
+        Returns:
+            dict: channels, plus (scenarios, channels) arrays for total_direct_spend,
+                indirect_cost, staff_cost, technology_cost, returns_processing_cost,
+                true_total_cost, converted_customers and true_cac
+        """
+        n_channels = len(self.channels)
+        if total_indirect_cost is None:
+            total_indirect_cost = self.total_indirect_cost
+        if indirect_weights is None:
+            indirect_share = _per_channel(self.session_share[None, :], n_channels)
+        else:
+            weights = _per_channel(indirect_weights, n_channels)
+            totals = weights.sum(axis=1, keepdims=True)
+            indirect_share = np.divide(weights, totals, out=np.zeros(np.broadcast_shapes(weights.shape, totals.shape)), where=totals != 0)
+
+        if mappings is None:
+            converted = self.converted_customers[None, :]
+        else:
+            converted = self.converted_for([mappings] if isinstance(mappings, dict) else mappings)
+
+        components = {
+            'total_direct_spend': self.direct_spend * _per_channel(spend_multiplier, n_channels),
+            'indirect_cost': _per_channel(total_indirect_cost, n_channels) * indirect_share,
+            'staff_cost': self.staff_cost * _per_channel(staff_multiplier, n_channels),
+            'technology_cost': self.technology_cost * _per_channel(technology_multiplier, n_channels),
+            'returns_processing_cost': self.returns_processing_cost * _per_channel(returns_multiplier, n_channels),
+        }
+        shape = np.broadcast_shapes(converted.shape, *(values.shape for values in components.values()))
+        result = {name: np.broadcast_to(values, shape) for name, values in components.items()}
+        result['true_total_cost'] = sum(result.values())
+        result['converted_customers'] = np.broadcast_to(converted, shape)
+        # As in get_final_df, channels without converted customers show their total cost
+        result['true_cac'] = np.divide(
+            result['true_total_cost'], result['converted_customers'],
+            out=result['true_total_cost'].copy(), where=result['converted_customers'] != 0
+        )
+        result['channels'] = self.channels
+        return result
+
+def _per_channel(value, n_channels):
+    """Shape a scenario parameter as (scenarios or 1, channels or 1) for broadcasting"""
+    values = np.asarray(value, dtype='float64')
+    if values.ndim == 0:
+        return values.reshape(1, 1)
+    if values.ndim == 1:
+        return values[:, None]
+    if values.ndim == 2 and values.shape[1] in (1, n_channels):
+        return values
+    raise ValueError(f"Expected a scalar, one value per scenario or (scenarios, {n_channels}) values; got shape {values.shape}")
+
+def scenario_grid(**axes):
+    """
+    Every combination of the given parameter values, as evaluate() arguments.
+
+    Values may be scalars, per-channel arrays or (for mappings) mapping dicts, e.g.
+    scenario_grid(spend_multiplier=[0.9, 1.1], mappings=[mapping_a, mapping_b]) gives
+    four scenarios.
+    """
+    combinations = list(itertools.product(*axes.values()))
+    grid = {}
+    for position, name in enumerate(axes):
+        values = [combination[position] for combination in combinations]
+        grid[name] = values if name == 'mappings' else np.array(values, dtype='float64')
+    return grid
+
+def scenario_frame(result):
+    """Long-format table of an evaluate() result: one row per scenario and channel"""
+    n_scenarios, n_channels = result['true_cac'].shape
+    frame = pd.DataFrame({
+        'scenario': np.repeat(np.arange(n_scenarios), n_channels),
+        'channel': np.tile(np.array(result['channels'], dtype=object), n_scenarios),
+    })
+    for name, values in result.items():
+        if name != 'channels':
+            frame[name] = values.ravel()
+    return frame
+
+@traced('cac_scenarios.sensitivity')
+def sensitivity_bands(model, spend_range=0.2, indirect_range=0.2, overhead_range=0.2,
+                      n_scenarios=SENSITIVITY_SCENARIOS, quantiles=SENSITIVITY_QUANTILES, seed=0):
+    """
+    Spread of true CAC by channel when the costs vary independently within ranges.
+
+    Each scenario draws a uniform multiplier in [1 - range, 1 + range] for every
+    channel's direct spend and overhead (staff, technology and returns processing),
+    and one for the indirect cost total.
+
+    Returns:
+        pd.DataFrame: channel, true_cac (baseline), low, median and high quantiles
+    """
+    rng = np.random.default_rng(seed)
+    shape = (n_scenarios, len(model.channels))
+    overhead = rng.uniform(1 - overhead_range, 1 + overhead_range, shape)
+    result = model.evaluate(
+        spend_multiplier=rng.uniform(1 - spend_range, 1 + spend_range, shape),
+        total_indirect_cost=model.total_indirect_cost * rng.uniform(1 - indirect_range, 1 + indirect_range, n_scenarios),
+        staff_multiplier=overhead,
+        technology_multiplier=overhead,
+        returns_multiplier=overhead,
+    )
+    low, median, high = np.quantile(result['true_cac'], quantiles, axis=0)
+    return pd.DataFrame({
+        'channel': model.channels,
+        'true_cac': model.baseline['true_cac'].to_numpy(dtype='float64'),
+        'low': low,
+        'median': median,
+        'high': high,
+    })
+
+def get_sensitivity_figure(bands):
+    """Baseline true CAC by channel with the low-high band as error bars"""
+    figure = go.Figure(go.Bar(
+        x=bands['channel'],
+        y=bands['true_cac'],
+        error_y=dict(
+            type='data',
+            symmetric=False,
+            array=(bands['high'] - bands['true_cac']).clip(lower=0),
+            arrayminus=(bands['true_cac'] - bands['low']).clip(lower=0),
+        ),
+        name='True CAC',
+    ))
+    figure.update_layout(xaxis_title='Channel', yaxis_title='True CAC ($)', height=400)
+    return figure
+
+# For testing
+if __name__ == "__main__":
+    from utils.analytics_cube import get_cube
+
+    model = CacScenarioModel.from_cube(get_cube())
+    grid = scenario_grid(
+        spend_multiplier=np.linspace(0.5, 1.5, 21),
+        total_indirect_cost=np.linspace(5000, 15000, 11),
+        staff_multiplier=np.linspace(0.5, 1.5, 11),
+    )
+    result = model.evaluate(**grid)
+    print(f"Evaluated {result['true_cac'].shape[0]:,} scenarios for {len(model.channels)} channels")
+    print(sensitivity_bands(model))
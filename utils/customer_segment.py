@@ -1,23 +1,73 @@
 import pandas as pd
 import numpy as np
-import plotly.express as px
 import plotly.graph_objects as go
-import sys
-import os
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_handler import SEGMENT_ORDER, require_columns
+from data_refresh import register_refresh
+from tracing import traced
+from utils.aggregation_pushdown import fetch_grouped_aggregation
+from utils.analytics_cube import get_cube
 
-from data_handler import get_customers_df
+# Additive measures per (customer_segment, acquisition_channel) that every analysis
+# below can be rolled up from
+SEGMENT_CHANNEL_MEASURES = {
+    'n_rows': ('rows', None),
+    'n_ids': ('count', 'customer_id'),
+    'ltv_sum': ('sum', 'lifetime_value'),
+    'ltv_n': ('count', 'lifetime_value'),
+}
 
-def get_customer_count_by_segment_and_channel():
-    customers = get_customers_df()
-    
-    pivot_table = customers.pivot_table(
-        index='customer_segment', 
-        columns='acquisition_channel', 
-        values='customer_id', 
-        aggfunc='count'
+CUSTOMER_COLUMNS = ['customer_id', 'customer_segment', 'acquisition_channel', 'lifetime_value']
+
+require_columns('customers', CUSTOMER_COLUMNS)
+
+def fetch_segment_channel_aggregates():
+    """
+    Aggregate SEGMENT_CHANNEL_MEASURES in the warehouse over the deduplicated
+    CUSTOMERS and CUSTOMERS_EXTRA tables; this is the cube's segment_channel table.
+    """
+    return fetch_grouped_aggregation(
+        ('CUSTOMERS', 'CUSTOMERS_EXTRA'),
+        'customer_id',
+        ['customer_segment', 'acquisition_channel'],
+        SEGMENT_CHANNEL_MEASURES
     )
+
+@traced('customer_segment.aggregates')
+def get_segment_channel_aggregates(customers=None, cube=None):
+    """
+    Get customer counts and lifetime value totals per segment and acquisition channel.
+
+    By default this is the analytics cube's segment_channel table; pass another cube
+    (e.g. a filtered one from the filter index) to read its table instead, or an
+    already loaded customers frame to aggregate it in pandas. Groups with a missing
+    segment or channel are kept.
+    """
+    if customers is None:
+        return (cube or get_cube())['segment_channel'].copy()
+
+    aggregates = customers.groupby(['customer_segment', 'acquisition_channel'], dropna=False, observed=True).agg(
+        n_rows=('customer_id', 'size'),
+        n_ids=('customer_id', 'count'),
+        ltv_sum=('lifetime_value', 'sum'),
+        ltv_n=('lifetime_value', 'count')
+    ).reset_index()
+    
+    # Match the warehouse result, whose keys are plain strings
+    for key in ['customer_segment', 'acquisition_channel']:
+        aggregates[key] = aggregates[key].astype(object)
+    return aggregates
+
+def _roll_up(aggregates, keys):
+    """Sum the additive measures over keys, dropping groups with a missing key like pandas groupby"""
+    return aggregates.dropna(subset=keys).groupby(keys)[list(SEGMENT_CHANNEL_MEASURES)].sum()
+
+@traced('customer_segment.count_by_segment_and_channel')
+def get_customer_count_by_segment_and_channel(customers=None, cube=None):
+    aggregates = get_segment_channel_aggregates(customers, cube)
+    
+    pivot_table = _roll_up(aggregates, ['customer_segment', 'acquisition_channel'])['n_ids'].unstack('acquisition_channel')
+    pivot_table.columns.name = 'acquisition_channel'
     
     count_data_melted = pivot_table.reset_index().melt(
         id_vars='customer_segment',
@@ -25,8 +75,12 @@ def get_customer_count_by_segment_and_channel():
         value_name='customer_count'
     ).dropna()
     
-    segment_order = ['Dormant', 'New', 'Occasional', 'Frequent', 'High-Value']
-    
+    return pivot_table, _count_chart(count_data_melted)
+
+@traced('customer_segment.count_chart')
+def _count_chart(count_data_melted):
+    # plotly.express is imported on first use; it takes a quarter second to load
+    import plotly.express as px
     grouped_bar_figure = px.bar(
         count_data_melted,
         x='customer_segment',
@@ -38,7 +92,7 @@ def get_customer_count_by_segment_and_channel():
             'acquisition_channel': 'Acquisition Channel'
         },
         barmode='group',
-        category_orders={'customer_segment': segment_order}
+        category_orders={'customer_segment': SEGMENT_ORDER}
     )
     
     grouped_bar_figure.update_layout(
@@ -59,7 +113,7 @@ def get_customer_count_by_segment_and_channel():
         xaxis=dict(
             tickangle=0,
             categoryorder='array',
-            categoryarray=segment_order
+            categoryarray=SEGMENT_ORDER
         )
     )
     
@@ -70,25 +124,26 @@ def get_customer_count_by_segment_and_channel():
         textfont_size=10
     )
     
-    return pivot_table, grouped_bar_figure
+    return grouped_bar_figure
 
-def get_channel_insights_by_segment():
+@traced('customer_segment.channel_insights')
+def get_channel_insights_by_segment(customers=None, cube=None):
     """Get detailed insights about which channels perform best for each segment"""
-    customers = get_customers_df()
+    aggregates = get_segment_channel_aggregates(customers, cube)
     
-    channel_segment_summary = customers.groupby(['customer_segment', 'acquisition_channel']).agg({
-        'customer_id': 'count',
-        'lifetime_value': ['mean', 'sum']
+    segment_channel_totals = _roll_up(aggregates, ['customer_segment', 'acquisition_channel'])
+    channel_segment_summary = pd.DataFrame({
+        'customer_count': segment_channel_totals['n_ids'],
+        'avg_ltv': segment_channel_totals['ltv_sum'] / segment_channel_totals['ltv_n'],
+        'total_ltv': segment_channel_totals['ltv_sum']
     }).round(2)
-    
-    channel_segment_summary.columns = ['customer_count', 'avg_ltv', 'total_ltv']
     channel_segment_summary = channel_segment_summary.reset_index()
     
-    channel_performance = customers.groupby('acquisition_channel').agg({
-        'customer_id': 'count',
-        'lifetime_value': 'mean'
+    channel_totals = _roll_up(aggregates, ['acquisition_channel'])
+    channel_performance = pd.DataFrame({
+        'total_customers': channel_totals['n_ids'],
+        'avg_ltv': channel_totals['ltv_sum'] / channel_totals['ltv_n']
     }).round(2)
-    channel_performance.columns = ['total_customers', 'avg_ltv']
     channel_performance = channel_performance.reset_index().sort_values('avg_ltv', ascending=False)
     
     top_channels_by_count = channel_segment_summary.loc[
@@ -99,11 +154,9 @@ def get_channel_insights_by_segment():
         channel_segment_summary.groupby('customer_segment')['avg_ltv'].idxmax()
     ][['customer_segment', 'acquisition_channel', 'avg_ltv']].reset_index(drop=True)
     
-    segment_order = ['Dormant', 'New', 'Occasional', 'Frequent', 'High-Value']
-    
     top_channels_by_count['customer_segment'] = pd.Categorical(
         top_channels_by_count['customer_segment'], 
-        categories=segment_order, 
+        categories=SEGMENT_ORDER, 
         ordered=True
     )
     top_channels_by_count = top_channels_by_count.sort_values('customer_segment').reset_index(drop=True)
@@ -111,7 +164,7 @@ def get_channel_insights_by_segment():
     # Apply ordering to top_channels_by_ltv  
     top_channels_by_ltv['customer_segment'] = pd.Categorical(
         top_channels_by_ltv['customer_segment'], 
-        categories=segment_order, 
+        categories=SEGMENT_ORDER, 
         ordered=True
     )
     top_channels_by_ltv = top_channels_by_ltv.sort_values('customer_segment').reset_index(drop=True)
@@ -123,20 +176,26 @@ def get_channel_insights_by_segment():
         'top_channels_by_ltv': top_channels_by_ltv
     }
 
-def get_lifetime_value_by_segment():
-    customers = get_customers_df()
+@traced('customer_segment.lifetime_value_by_segment')
+def get_lifetime_value_by_segment(customers=None, cube=None):
+    aggregates = get_segment_channel_aggregates(customers, cube)
     
-    summary = customers.groupby('customer_segment')['lifetime_value'].agg([
-        'sum', 'mean', 'count'
-    ]).reset_index()
-    summary.columns = ['customer_segment', 'total_ltv', 'avg_ltv', 'customer_count']
-    
-    segment_order = ['Dormant', 'New', 'Occasional', 'Frequent', 'High-Value']
+    segment_totals = _roll_up(aggregates, ['customer_segment'])
+    summary = pd.DataFrame({
+        'total_ltv': segment_totals['ltv_sum'],
+        'avg_ltv': segment_totals['ltv_sum'] / segment_totals['ltv_n'],
+        'customer_count': segment_totals['ltv_n']
+    }).reset_index()
     
     # Reorder the summary DataFrame to match the order
-    summary['customer_segment'] = pd.Categorical(summary['customer_segment'], categories=segment_order, ordered=True)
+    summary['customer_segment'] = pd.Categorical(summary['customer_segment'], categories=SEGMENT_ORDER, ordered=True)
     summary = summary.sort_values('customer_segment').reset_index(drop=True)
     
+    return summary, _ltv_chart(summary)
+
+@traced('customer_segment.ltv_chart')
+def _ltv_chart(summary):
+    import plotly.express as px
     fig = px.bar(
         summary,
         x='customer_segment',
@@ -146,7 +205,7 @@ def get_lifetime_value_by_segment():
             'total_ltv': 'Total Lifetime Value',
             'customer_segment': 'Customer Segment'
         },
-        category_orders={'customer_segment': segment_order}
+        category_orders={'customer_segment': SEGMENT_ORDER}
     )
     
     fig.update_layout(width=800, height=500, showlegend=False)
@@ -160,26 +219,26 @@ def get_lifetime_value_by_segment():
             yshift=10
         )
     
-    return summary, fig
+    return fig
 
-def get_segment_counts():
-    customers = get_customers_df()
+@traced('customer_segment.segment_counts')
+def get_segment_counts(customers=None, cube=None):
+    aggregates = get_segment_channel_aggregates(customers, cube)
     
-    segment_counts = customers['customer_segment'].value_counts().reset_index()
+    segment_counts = _roll_up(aggregates, ['customer_segment'])['n_rows'].sort_values(ascending=False).reset_index()
     segment_counts.columns = ['customer_segment', 'customer_count']
     
-    segment_order = ['Dormant', 'New', 'Occasional', 'Frequent', 'High-Value']
-    
-    segment_counts['customer_segment'] = pd.Categorical(segment_counts['customer_segment'], categories=segment_order, ordered=True)
+    segment_counts['customer_segment'] = pd.Categorical(segment_counts['customer_segment'], categories=SEGMENT_ORDER, ordered=True)
     segment_counts = segment_counts.sort_values('customer_segment').reset_index(drop=True)
     
     return segment_counts
 
-def get_customer_segment_analysis():
-    count_pivot, count_chart = get_customer_count_by_segment_and_channel()
-    ltv_summary, ltv_bar_chart = get_lifetime_value_by_segment()
-    segment_counts = get_segment_counts()
-    channel_insights = get_channel_insights_by_segment()
+@traced('customer_segment.analysis')
+def get_customer_segment_analysis(customers=None, cube=None):
+    count_pivot, count_chart = get_customer_count_by_segment_and_channel(customers, cube)
+    ltv_summary, ltv_bar_chart = get_lifetime_value_by_segment(customers, cube)
+    segment_counts = get_segment_counts(customers, cube)
+    channel_insights = get_channel_insights_by_segment(customers, cube)
     
     return {
         'count_pivot': count_pivot,
@@ -190,6 +249,8 @@ def get_customer_segment_analysis():
         'channel_insights': channel_insights
     }
 
+register_refresh('customer_segment', get_customer_segment_analysis)
+
 # For testing
 if __name__ == "__main__":
     try:
@@ -0,0 +1,61 @@
+"""
+Check that streamed Parquet exports keep the types the loaders convert columns to,
+using a local SQLite database as a stand-in for Snowflake.
+
+Run with: python -m utils.export_check
+"""
+import decimal
+import os
+import sqlite3
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import data_handler
+from data_handler import _convert_column, _export_table, export_query, snowflake_arrow_type
+
+# Whole numbers beyond float64's 2**53 exact range, as NUMBER(38,0) ids can be
+LARGE_IDS = [2 ** 53 + 1, 2 ** 62 + 7, 12345]
+
+def check_number_38_0():
+    """A NUMBER(38,0) column is exported as int64, exactly, with or without nulls"""
+    raw = pd.Series([decimal.Decimal(value) for value in LARGE_IDS], dtype=object)
+    converted = pd.DataFrame({'id': _convert_column(raw, 'FIXED', 38, 0)})
+    declared = pa.schema([pa.field('id', snowflake_arrow_type('FIXED', 0))])
+    assert declared.equals(pa.Schema.from_pandas(converted, preserve_index=False), check_metadata=False), (
+        declared, pa.Schema.from_pandas(converted, preserve_index=False)
+    )
+    assert _export_table(converted, declared).column('id').to_pylist() == LARGE_IDS
+    print(f"NUMBER(38,0) schema: OK ({declared.field('id').type})")
+
+    # A batch with a null converts to float64; it is still written as int64 with a null
+    with_null = pd.DataFrame({'id': _convert_column(pd.Series([decimal.Decimal(12345), None], dtype=object), 'FIXED', 38, 0)})
+    assert _export_table(with_null, declared).column('id').to_pylist() == [12345, None]
+    print("NUMBER(38,0) with nulls: OK")
+
+def check_null_first_batch(directory):
+    """A column with only nulls in the first batch is still written once it has values"""
+    path = os.path.join(directory, 'stand_in.db')
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE T (ID INTEGER, NOTE TEXT)")
+        connection.executemany("INSERT INTO T VALUES (?, ?)", [(i, None if i < 1500 else f"n{i}") for i in range(3000)])
+    data_handler.set_connection_factory(lambda: sqlite3.connect(path, check_same_thread=False))
+    try:
+        output = os.path.join(directory, 'export.parquet')
+        stats = export_query("SELECT * FROM T", output, 'parquet', batch_rows=1000)
+        empty = os.path.join(directory, 'empty.parquet')
+        export_query("SELECT * FROM T WHERE 1 = 0", empty, 'parquet')
+    finally:
+        data_handler.set_connection_factory(None)
+
+    table = pq.read_table(output)
+    assert table.num_rows == stats['rows'] == 3000 and table.column('note')[2999].as_py() == 'n2999'
+    assert pq.read_table(empty).schema.names == ['id', 'note']
+    print(f"null first batch: OK ({table.num_rows} rows, {pq.ParquetFile(output).num_row_groups} row groups)")
+
+if __name__ == "__main__":
+    check_number_38_0()
+    with tempfile.TemporaryDirectory() as directory:
+        check_null_first_batch(directory)
@@ -0,0 +1,500 @@
+"""
+In-memory index behind the pages' date-range, segment and channel filters.
+
+Streamlit reruns the whole page on every widget change, so filtered views are not
+answered by re-querying the warehouse or rescanning the loaded frames. Instead the
+index keeps transactions, converted touchpoints and marketing spend as compact arrays
+partitioned by channel and sorted by time within each partition, with the offset where
+each partition starts. A date range is two binary searches per partition, and the
+aggregates are bincounts over customer codes that point into per-customer arrays.
+
+The index is rebuilt by the refresh scheduler alongside the analyses. Transactions
+and touchpoints are streamed into it in chunks, so only the compact arrays are kept.
+
+Usage:
+    index = get_filter_index()
+    aggregates = index.segment_channel(start=date(2024, 1, 1), end=date(2024, 3, 31), segments=['New'])
+"""
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_handler import (
+    DATASETS,
+    get_dataset,
+    get_datasets,
+    get_snapshot_parts,
+    iter_dataframe_batches,
+    require_columns,
+)
+from data_refresh import get_refreshed, get_refreshed_if_ready, register_refresh
+from tracing import span, traced
+from utils.aggregation_pushdown import deduplicated_union_sql
+
+# Date columns the ranges are applied to
+TRANSACTION_DATE_COLUMN = os.getenv("TRANSACTION_DATE_COLUMN", "transaction_date")
+TOUCHPOINT_DATE_COLUMN = os.getenv("TOUCHPOINT_DATE_COLUMN", "touchpoint_date")
+SPEND_DATE_COLUMN = os.getenv("SPEND_DATE_COLUMN", "spend_date")
+
+CUSTOMER_COLUMNS = ['customer_id', 'customer_segment', 'acquisition_channel', 'lifetime_value']
+TRANSACTION_COLUMNS = ['customer_id', 'channel', TRANSACTION_DATE_COLUMN]
+TOUCHPOINT_COLUMNS = ['customer_id', 'channel', 'converted_flag', TOUCHPOINT_DATE_COLUMN]
+SPEND_COLUMNS = ['channel', 'spend_amount', SPEND_DATE_COLUMN]
+
+require_columns('customers', CUSTOMER_COLUMNS)
+require_columns('marketing_spend', SPEND_COLUMNS)
+
+COHORTS = ['Single-channel', 'Omnichannel']
+
+def nanoseconds(series):
+    """Timestamps as int64 nanoseconds (wall clock for tz-aware columns); NaT sorts first"""
+    if series.dtype.kind != 'M' and not isinstance(series.dtype, pd.DatetimeTZDtype):
+        series = pd.to_datetime(series, errors='coerce')
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        series = series.dt.tz_localize(None)
+    return series.to_numpy(dtype='datetime64[ns]').view('int64')
+
+def _date_bounds(start, end):
+    """[start, end] as a half-open nanosecond range; None leaves that side unbounded"""
+    lower = None if start is None else pd.Timestamp(start).normalize().value
+    upper = None if end is None else (pd.Timestamp(end).normalize() + pd.Timedelta(days=1)).value
+    return lower, upper
+
+def _month_starts(times):
+    """Month boundaries from the first month with a non-missing time to after the last"""
+    valid = times[times != np.iinfo(np.int64).min]
+    if len(valid) == 0:
+        return np.empty(0, dtype=np.int64)
+    first = pd.Timestamp(valid.min()).normalize().replace(day=1)
+    return pd.date_range(first, pd.Timestamp(valid.max()) + pd.offsets.MonthBegin(1), freq='MS').asi8
+
+def _categorical(series):
+    """Category labels and integer codes (-1 for missing) of a string column"""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype('category')
+    return list(series.cat.categories), series.cat.codes.to_numpy()
+
+class PartitionedEvents:
+    """
+    Events partitioned by channel and sorted by time within each partition.
+
+    offsets[p]:offsets[p + 1] is partition p's slice of times, customer_codes and
+    cumulative_values. Events with a missing channel are left out, as every analysis
+    ignores them.
+
+    With customer codes, each partition is also split into calendar months: bucket
+    offsets mark where each month starts and a packed bitmap per month flags the
+    customers with an event in it, so whole months of a date range are ORed together
+    and only the events of the partial months at either end are scanned.
+    """
+
+    def __init__(self, channels, channel_codes, times, customer_codes=None, values=None, customer_count=None):
+        keep = channel_codes >= 0
+        channel_codes = channel_codes[keep]
+        order = np.lexsort((times[keep], channel_codes))
+
+        self.channels = list(channels)
+        self.times = times[keep][order]
+        self.offsets = np.searchsorted(channel_codes[order], np.arange(len(self.channels) + 1))
+        self.customer_codes = None if customer_codes is None else customer_codes[keep][order]
+        # Running totals, so the sum over a slice is the difference of two entries
+        self.cumulative_values = None if values is None else np.concatenate([[0.0], np.cumsum(values[keep][order])])
+
+        self.customer_count = customer_count
+        if self.customer_codes is not None:
+            self.bucket_edges = _month_starts(self.times)
+            self.bucket_offsets = np.array([
+                first + np.searchsorted(self.times[first:last], self.bucket_edges)
+                for first, last in zip(self.offsets[:-1], self.offsets[1:])
+            ], dtype=np.int64).reshape(len(self.channels), len(self.bucket_edges))
+            self.bucket_bitmaps = np.zeros(
+                (len(self.channels), max(len(self.bucket_edges) - 1, 0), (customer_count + 7) // 8), dtype=np.uint8
+            )
+            for position in range(len(self.channels)):
+                for bucket in range(len(self.bucket_edges) - 1):
+                    reached = np.zeros(customer_count, dtype=bool)
+                    first, last = self.bucket_offsets[position, bucket:bucket + 2]
+                    reached[self.customer_codes[first:last]] = True
+                    self.bucket_bitmaps[position, bucket] = np.packbits(reached)
+
+    @classmethod
+    def from_batches(cls, batches, date_column, customer_codes=None, value_column=None, customer_count=None):
+        """
+        Build from DataFrame chunks with a channel column and date_column.
+
+        Args:
+            batches (iterable): DataFrames, e.g. from iter_dataframe_batches()
+            customer_codes (callable): Maps a chunk's customer_id array to customer codes
+                below customer_count
+            value_column (str): Column to keep running totals of
+        """
+        vocabulary = {}
+        parts = []
+        for batch in batches:
+            codes, channels = pd.factorize(batch['channel'])
+            # The extra -1 entry maps factorize's missing-value code to itself
+            lookup = np.array([vocabulary.setdefault(channel, len(vocabulary)) for channel in channels] + [-1], dtype=np.int32)
+            parts.append((
+                lookup[codes],
+                nanoseconds(batch[date_column]),
+                None if customer_codes is None else customer_codes(batch['customer_id'].to_numpy()),
+                None if value_column is None else batch[value_column].to_numpy(dtype='float64'),
+            ))
+
+        channels = sorted(vocabulary)
+        remap = np.array([channels.index(channel) for channel in vocabulary] + [-1], dtype=np.int32)
+        def combined(position, dtype):
+            arrays = [part[position] for part in parts]
+            return np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+        return cls(
+            channels,
+            remap[combined(0, np.int32)],
+            combined(1, np.int64),
+            None if customer_codes is None else combined(2, np.int32),
+            None if value_column is None else combined(3, np.float64),
+            customer_count,
+        )
+
+    def __len__(self):
+        return len(self.times)
+
+    def slices(self, lower=None, upper=None, channels=None):
+        """Yield (channel, first, last) for each selected channel's events in [lower, upper)"""
+        for position, channel in enumerate(self.channels):
+            if channels is None or channel in channels:
+                yield (channel, *self._bounds(position, lower, upper))
+
+    def _bounds(self, position, lower, upper):
+        first, last = self.offsets[position], self.offsets[position + 1]
+        times = self.times[first:last]
+        return (
+            first if lower is None else first + np.searchsorted(times, lower),
+            last if upper is None else first + np.searchsorted(times, upper),
+        )
+
+    def reached(self, lower=None, upper=None, channels=None):
+        """Per-customer flags: has at least one event in [lower, upper) on the channels"""
+        edges = self.bucket_edges
+        first_full = 0 if lower is None else np.searchsorted(edges, lower)
+        last_full = len(edges) - 1 if upper is None else np.searchsorted(edges, upper, side='right') - 1
+
+        packed = np.zeros(self.bucket_bitmaps.shape[2], dtype=np.uint8)
+        reached = np.zeros(self.customer_count, dtype=bool)
+        for position, channel in enumerate(self.channels):
+            if channels is not None and channel not in channels:
+                continue
+            first, last = self._bounds(position, lower, upper)
+            if first_full < last_full:
+                packed |= np.bitwise_or.reduce(self.bucket_bitmaps[position, first_full:last_full], axis=0)
+                reached[self.customer_codes[first:self.bucket_offsets[position, first_full]]] = True
+                reached[self.customer_codes[self.bucket_offsets[position, last_full]:last]] = True
+            else:
+                reached[self.customer_codes[first:last]] = True
+        return reached | np.unpackbits(packed, count=self.customer_count).view(bool)
+
+    def time_range(self):
+        """Earliest and latest non-missing timestamp in nanoseconds, or None when there are none"""
+        valid = self.times[self.times != np.iinfo(np.int64).min]
+        return (valid.min(), valid.max()) if len(valid) else None
+
+class FilterIndex:
+    """
+    Customers, transactions, converted touchpoints and spend arranged for filtered aggregates.
+
+    Customer codes are row positions in the customers frame; the per-customer arrays
+    have one extra last slot that collects events whose customer is unknown.
+    """
+
+    def __init__(self, customers, transactions, touchpoints, spend, acquisition_to_touchpoint_mapping):
+        """
+        Args:
+            customers (pd.DataFrame): CUSTOMER_COLUMNS, one row per customer
+            transactions (iterable): DataFrame chunks with TRANSACTION_COLUMNS
+            touchpoints (iterable): DataFrame chunks with TOUCHPOINT_COLUMNS
+            spend (pd.DataFrame): SPEND_COLUMNS
+            acquisition_to_touchpoint_mapping (dict): From the true CAC configuration
+        """
+        self.customers = customers[CUSTOMER_COLUMNS].reset_index(drop=True)
+        customer_ids = self.customers['customer_id'].to_numpy()
+        self._id_order = np.argsort(customer_ids, kind='stable')
+        self._sorted_ids = customer_ids[self._id_order]
+
+        self.segments, segment_codes = _categorical(self.customers['customer_segment'])
+        self.acquisition_channels, acquisition_codes = _categorical(self.customers['acquisition_channel'])
+        self._segment_codes = np.append(segment_codes, -1)
+        self._acquisition_codes = np.append(acquisition_codes, -1)
+        self._has_id = self.customers['customer_id'].notna().to_numpy()
+
+        lifetime_values = self.customers['lifetime_value'].to_numpy(dtype='float64')
+        self._has_ltv = ~np.isnan(lifetime_values)
+
+        # Each customer's (segment, acquisition channel) group, with missing labels as
+        # their own groups; the id and lifetime value variants send customers without
+        # one to the discard group
+        width = len(self.acquisition_channels) + 1
+        self._group_count = (len(self.segments) + 1) * width
+        self._groups = (segment_codes.astype(np.int64) + 1) * width + acquisition_codes + 1
+        self._id_groups = np.where(self._has_id, self._groups, self._group_count)
+        self._ltv_groups = np.where(self._has_ltv, self._groups, self._group_count)
+        self._ltv_weights = np.where(self._has_ltv, lifetime_values, 0.0)
+
+        # Per-customer arrays have one more slot than there are customers
+        customer_count = len(self._segment_codes)
+        self.transactions = PartitionedEvents.from_batches(
+            transactions, TRANSACTION_DATE_COLUMN, self._customer_codes, customer_count=customer_count
+        )
+        # Raw spellings grouped under the normalized channel the omnichannel analysis counts
+        self.transaction_channels = {}
+        for channel in self.transactions.channels:
+            self.transaction_channels.setdefault(channel.strip().lower(), []).append(channel)
+
+        # Only converted touchpoints feed the CAC inputs
+        self.touchpoints = PartitionedEvents.from_batches(
+            (batch[batch['converted_flag'] == True] for batch in touchpoints),
+            TOUCHPOINT_DATE_COLUMN, self._customer_codes, customer_count=customer_count
+        )
+
+        self.spend = PartitionedEvents.from_batches([spend], SPEND_DATE_COLUMN, value_column='spend_amount')
+
+        # Per touchpoint channel: the customers whose acquisition channel it counts for
+        self.acquisition_to_touchpoint_mapping = acquisition_to_touchpoint_mapping
+        self._counts_for = {}
+        for acquisition_channel, touchpoint_channels in acquisition_to_touchpoint_mapping.items():
+            if acquisition_channel not in self.acquisition_channels:
+                continue
+            acquired = self._acquisition_codes == self.acquisition_channels.index(acquisition_channel)
+            for touchpoint_channel in touchpoint_channels:
+                self._counts_for[touchpoint_channel] = self._counts_for.get(touchpoint_channel, False) | acquired
+
+    def _customer_codes(self, customer_ids):
+        n_customers = len(self._sorted_ids)
+        if n_customers == 0:
+            return np.zeros(len(customer_ids), dtype=np.int32)
+        positions = np.minimum(np.searchsorted(self._sorted_ids, customer_ids), n_customers - 1)
+        found = self._sorted_ids[positions] == customer_ids
+        return np.where(found, self._id_order[positions], n_customers).astype(np.int32)
+
+    def date_range(self):
+        """First and last date with a transaction or converted touchpoint, or None"""
+        ranges = [events.time_range() for events in (self.transactions, self.touchpoints)]
+        ranges = [bounds for bounds in ranges if bounds is not None]
+        if not ranges:
+            return None
+        return (
+            pd.Timestamp(min(lower for lower, _ in ranges)).date(),
+            pd.Timestamp(max(upper for _, upper in ranges)).date(),
+        )
+
+    def cac_channels(self):
+        """Every channel the true CAC table can have a row for"""
+        return sorted(set(self.acquisition_channels) | set(self.touchpoints.channels) | set(self.spend.channels))
+
+    def customer_mask(self, segments=None, acquisition_channels=None):
+        """Per-customer flags (plus the unknown-customer slot) for the selected segments and channels"""
+        mask = np.ones(len(self._segment_codes), dtype=bool)
+        for selected, labels, codes in [
+            (segments, self.segments, self._segment_codes),
+            (acquisition_channels, self.acquisition_channels, self._acquisition_codes),
+        ]:
+            if selected:
+                # Looked up by code; the extra last entry is what missing values (-1) read
+                allowed = np.zeros(len(labels) + 1, dtype=bool)
+                allowed[[labels.index(label) for label in selected if label in labels]] = True
+                mask &= allowed[codes]
+        return mask
+
+    @traced('filter_index.segment_channel')
+    def segment_channel(self, start=None, end=None, segments=None, channels=None):
+        """
+        The analytics cube's segment_channel table for a subset of customers.
+
+        A date range keeps the customers with a transaction in it; channels are
+        acquisition channels.
+        """
+        selected = self.customer_mask(segments, channels)
+        lower, upper = _date_bounds(start, end)
+        if lower is not None or upper is not None:
+            selected &= self.transactions.reached(lower, upper)
+        selected = selected[:-1]
+
+        # Customers left out are counted in the discard group at the end
+        discard = self._group_count
+        n_rows, n_ids, ltv_n = (
+            np.bincount(np.where(selected, groups, discard), minlength=discard + 1)[:discard]
+            for groups in (self._groups, self._id_groups, self._ltv_groups)
+        )
+        ltv_sum = np.bincount(
+            np.where(selected, self._ltv_groups, discard), weights=self._ltv_weights, minlength=discard + 1
+        )[:discard]
+
+        keep = np.flatnonzero(n_rows)
+        width = len(self.acquisition_channels) + 1
+        segment_labels = np.array([None] + self.segments, dtype=object)
+        channel_labels = np.array([None] + self.acquisition_channels, dtype=object)
+        return pd.DataFrame({
+            'customer_segment': segment_labels[keep // width],
+            'acquisition_channel': channel_labels[keep % width],
+            'n_rows': n_rows[keep],
+            'n_ids': n_ids[keep],
+            'ltv_sum': ltv_sum[keep],
+            'ltv_n': ltv_n[keep],
+        })
+
+    @traced('filter_index.omnichannel')
+    def omnichannel(self, start=None, end=None, segments=None, channels=None):
+        """
+        Omnichannel customers and the cube's cohort_ltv_sketches table for a subset of transactions.
+
+        Channels used are counted over the transactions in the date range on the
+        selected (normalized) channels, for customers in the selected segments.
+
+        Returns:
+            tuple: (customers frame as get_omnichannel_customers() returns it, cohort_ltv_sketches)
+        """
+        from utils.omnichannel_analysis import get_cohort_ltv_sketches
+
+        lower, upper = _date_bounds(start, end)
+        channels_used = np.zeros(len(self._segment_codes), dtype=np.int8)
+        for channel, spellings in self.transaction_channels.items():
+            if not channels or channel in channels:
+                channels_used += self.transactions.reached(lower, upper, spellings)
+        channels_used = channels_used[:-1]
+        selected = (channels_used >= 1) & self._has_ltv & self.customer_mask(segments)[:-1]
+
+        rows = np.flatnonzero(selected)
+        omnichannel = channels_used[rows] >= 2
+        customers = pd.DataFrame(
+            {column: self.customers[column].array.take(rows) for column in CUSTOMER_COLUMNS}, index=rows
+        )
+        customers['channels_used'] = channels_used[rows].astype(np.int64)
+        customers['cohort'] = np.array(COHORTS, dtype=object)[omnichannel.astype(np.intp)]
+
+        return customers, get_cohort_ltv_sketches(customers)
+
+    @traced('filter_index.cac_inputs')
+    def cac_inputs(self, start=None, end=None, segments=None, channels=None):
+        """
+        get_cac_inputs() for converted touchpoints and spend in the date range.
+
+        Segments restrict the customer counts and touchpoints; spend is not attributed
+        to customers, so it only follows the date range. Channels are applied to the
+        finished table by the caller, so indirect costs are still shared across every
+        channel.
+        """
+        from utils.true_customer_acquisition_cost import conversion_sets_frame
+
+        lower, upper = _date_bounds(start, end)
+        customers = self.customer_mask(segments)
+
+        acquired = np.bincount(
+            self._acquisition_codes[customers & (self._acquisition_codes >= 0)],
+            minlength=len(self.acquisition_channels)
+        )
+        present = np.flatnonzero(acquired)
+        acquisition = pd.DataFrame({
+            'channel': np.array(self.acquisition_channels, dtype=object)[present],
+            'customers_acquired': acquired[present],
+        })
+
+        spend_rows = [
+            (channel, self.spend.cumulative_values[last] - self.spend.cumulative_values[first])
+            for channel, first, last in self.spend.slices(lower, upper) if last > first
+        ]
+        spend = pd.DataFrame(spend_rows, columns=['channel', 'total_direct_spend']).astype({'channel': object})
+
+        session_rows = []
+        converted = np.zeros(len(self._segment_codes), dtype=bool)
+        # Each customer's converted touchpoint channels as a bitmask, for the conversion sets
+        conversion_channels = sorted(channel for channel in self.touchpoints.channels if pd.notna(channel))
+        conversion_masks = np.zeros(len(self._segment_codes), dtype=np.int64)
+        for channel, first, last in self.touchpoints.slices(lower, upper):
+            count = int(customers[self.touchpoints.customer_codes[first:last]].sum()) if segments else last - first
+            if count:
+                session_rows.append((channel, count))
+            if pd.isna(channel) or first == last:
+                continue
+            reached = self.touchpoints.reached(lower, upper, [channel])
+            conversion_masks |= reached.astype(np.int64) << conversion_channels.index(channel)
+            if channel in self._counts_for:
+                converted |= reached & self._counts_for[channel]
+        sessions = pd.DataFrame(session_rows, columns=['channel', 'count']).astype({'channel': object, 'count': int})
+
+        converted_counts = np.bincount(
+            self._acquisition_codes[converted & customers], minlength=len(self.acquisition_channels)
+        )
+        mapped = list(self.acquisition_to_touchpoint_mapping)
+        converted = pd.DataFrame({
+            'channel': mapped,
+            'converted_customers': [
+                converted_counts[self.acquisition_channels.index(channel)] if channel in self.acquisition_channels else 0
+                for channel in mapped
+            ],
+        })
+
+        has_conversions = customers & (self._acquisition_codes >= 0) & (conversion_masks != 0)
+        conversion_sets = conversion_sets_frame(
+            np.array(self.acquisition_channels, dtype=object)[self._acquisition_codes[has_conversions]],
+            conversion_masks[has_conversions],
+            conversion_channels
+        )
+
+        return {
+            'acquisition': acquisition, 'spend': spend, 'sessions': sessions, 'converted': converted,
+            'conversion_sets': conversion_sets,
+        }
+
+def stream_dataset(name, columns):
+    """
+    A dataset's columns in chunks, deduplicated like the loaders (first table wins).
+
+    Tables with local snapshots are read through the regular loader as one chunk.
+    """
+    dataset = DATASETS[name]
+    if any(get_snapshot_parts(table) for table in dataset['tables']):
+        return [get_dataset(name, columns)]
+    source_sql = deduplicated_union_sql(dataset['tables'], dataset['key'], [dataset['key']] + columns)
+    return iter_dataframe_batches(f"SELECT {', '.join(columns)} FROM ({source_sql}) source")
+
+@traced('filter_index.build')
+def build_filter_index():
+    """Load the datasets and build the FilterIndex"""
+    # Imported here to avoid loading the CAC analysis just to read its configuration
+    from utils.true_customer_acquisition_cost import load_cac_config
+
+    with span('filter_index.load'):
+        frames = get_datasets({'customers': CUSTOMER_COLUMNS, 'marketing_spend': SPEND_COLUMNS})
+    return FilterIndex(
+        frames['customers'],
+        stream_dataset('transactions', TRANSACTION_COLUMNS),
+        stream_dataset('touchpoints', TOUCHPOINT_COLUMNS),
+        frames['marketing_spend'],
+        load_cac_config()['acquisition_to_touchpoint_mapping']
+    )
+
+register_refresh('filter_index', build_filter_index)
+
+def get_filter_index(wait=True):
+    """
+    The current FilterIndex; shared by every session, so treat it as read-only.
+
+    With wait=False, returns None instead of blocking while the first index is built
+    in the background.
+    """
+    return get_refreshed('filter_index') if wait else get_refreshed_if_ready('filter_index')
+
+# For testing
+if __name__ == "__main__":
+    index = get_filter_index()
+    first_date, last_date = index.date_range()
+    middle = first_date + (last_date - first_date) / 2
+    print(f"Indexed {len(index.transactions):,} transactions and {len(index.touchpoints):,} converted touchpoints")
+    for name, query in [
+        ('segment_channel', index.segment_channel),
+        ('omnichannel', index.omnichannel),
+        ('cac_inputs', index.cac_inputs),
+    ]:
+        start = time.perf_counter()
+        query(start=first_date, end=middle, segments=index.segments[:2])
+        print(f"{name}: {(time.perf_counter() - start) * 1000:.1f} ms")
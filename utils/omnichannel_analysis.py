@@ -1,47 +1,229 @@
+import numpy as np
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
-import sys
-import os
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_handler import (
+    DATASETS,
+    dataset_cache,
+    get_customers_df,
+    get_snapshot_parts,
+    get_transactions_df,
+    iter_dataframe_batches,
+    require_columns,
+)
+from data_refresh import register_refresh
+from tracing import span, traced
+from utils.aggregation_pushdown import deduplicated_union_sql
+from utils.analytics_cube import get_cube
+from utils.box_plot import sketch_box_statistics, summarized_box_figure
+from utils.quantile_sketch import merge_sketch_column, sketch_table
 
-from data_handler import get_customers_df, get_transactions_df
+CUSTOMER_COLUMNS = ['customer_id', 'customer_segment', 'acquisition_channel', 'lifetime_value']
+TRANSACTION_COLUMNS = ['customer_id', 'channel']
 
-def get_omnichannel_analysis():
+require_columns('customers', CUSTOMER_COLUMNS)
+require_columns('transactions', TRANSACTION_COLUMNS)
+
+# Channels are tracked as bits of a uint64 per customer
+MAX_CHANNELS = 64
+
+COHORT_ORDER = ['Single-channel', 'Omnichannel']
+
+# Lifetime value sketches are kept per cohort and segment, and merged per cohort
+LTV_SKETCH_GROUPS = ['cohort', 'customer_segment']
+
+def _normalize_channel(channel):
+    return channel.strip().lower()
+
+def _or_by_customer(customer_ids, masks):
+    """Combine the masks of repeated customer ids with a bitwise OR"""
+    if len(customer_ids) == 0:
+        return customer_ids, masks
+    order = np.argsort(customer_ids, kind='stable')
+    customer_ids = customer_ids[order]
+    masks = masks[order]
+    starts = np.flatnonzero(np.r_[True, customer_ids[1:] != customer_ids[:-1]])
+    return customer_ids[starts], np.bitwise_or.reduceat(masks, starts)
+
+def count_channels_per_customer(batches):
     """
-    Analyze customer lifetime value by omnichannel vs single-channel usage.
-    
+    Count distinct normalized channels per customer from transaction chunks.
+
+    Each chunk is reduced to one channel bitmask per customer and merged into the
+    running masks, so memory grows with the number of customers rather than the
+    number of transactions. Rows with a missing customer or channel are ignored,
+    as in groupby('customer_id')['channel'].nunique().
+
+    Args:
+        batches (iterable): DataFrames with customer_id and channel columns
+
     Returns:
-        tuple: (summary_df, detailed_df, bar_chart_fig, box_plot_fig)
+        pd.DataFrame: customer_id, channels_used for every customer with a channel
     """
-    customers = get_customers_df()
-    tx = get_transactions_df()
-     
-    # sort channels using lowercase column names
-    tx['channel'] = tx['channel'].str.strip().str.lower()
-    customers = customers.drop_duplicates(subset=['customer_id'])
-    customers = customers[customers['lifetime_value'].notna()]
-     
-    channel_counts = tx.groupby('customer_id')['channel'].nunique().reset_index()
-    channel_counts.columns = ['customer_id', 'channels_used']
-     
-    df = customers.merge(channel_counts, on='customer_id', how='left')
-    df['channels_used'] = df['channels_used'].fillna(0).astype(int)
-    df = df[df['channels_used'] >= 1]
-     
-    # omnichannel vs single channel
-    df['cohort'] = df['channels_used'].apply(lambda x: 'Omnichannel' if x >= 2 else 'Single-channel')
+    vocabulary = {}
+    merged_ids = None
+    merged_masks = np.empty(0, dtype=np.uint64)
+    pending = []
+    pending_rows = 0
+
+    for batch in batches:
+        batch = batch[batch['customer_id'].notna() & batch['channel'].notna()]
+        if len(batch) == 0:
+            continue
+
+        # Normalize each distinct spelling once, then map it to its bit
+        codes, raw_channels = pd.factorize(batch['channel'])
+        bits = np.empty(len(raw_channels), dtype=np.uint64)
+        for index, raw_channel in enumerate(raw_channels):
+            channel = _normalize_channel(raw_channel)
+            if channel not in vocabulary:
+                if len(vocabulary) == MAX_CHANNELS:
+                    raise ValueError(f"More than {MAX_CHANNELS} distinct transaction channels")
+                vocabulary[channel] = len(vocabulary)
+            bits[index] = np.uint64(1) << np.uint64(vocabulary[channel])
+
+        pending.append(_or_by_customer(batch['customer_id'].to_numpy(), bits[codes]))
+        pending_rows += len(pending[-1][0])
+
+        # Fold the chunk results in once they outgrow the merged masks
+        if merged_ids is None or pending_rows > len(merged_ids):
+            merged_ids, merged_masks = _merge_masks(merged_ids, merged_masks, pending)
+            pending = []
+            pending_rows = 0
+
+    if pending:
+        merged_ids, merged_masks = _merge_masks(merged_ids, merged_masks, pending)
+    if merged_ids is None:
+        return pd.DataFrame({'customer_id': pd.Series(dtype='int64'), 'channels_used': pd.Series(dtype='int64')})
+
+    channels_used = np.zeros(len(merged_masks), dtype=np.int64)
+    for bit in range(len(vocabulary)):
+        channels_used += ((merged_masks >> np.uint64(bit)) & np.uint64(1)).astype(np.int64)
+    return pd.DataFrame({'customer_id': merged_ids, 'channels_used': channels_used})
+
+def _merge_masks(merged_ids, merged_masks, pending):
+    parts = ([(merged_ids, merged_masks)] if merged_ids is not None else []) + pending
+    return _or_by_customer(
+        np.concatenate([customer_ids for customer_ids, _ in parts]),
+        np.concatenate([masks for _, masks in parts])
+    )
+
+@traced('omnichannel.channels_per_customer')
+def get_channels_per_customer():
+    """
+    Get the number of distinct transaction channels per customer.
+
+    Transactions are streamed from the warehouse in chunks (deduplicated on
+    transaction_id, first table wins) and only the per-customer result is kept in the
+    dataset cache. Tables with local snapshots are read through the regular loader.
+    """
+    tables = DATASETS['transactions']['tables']
+
+    def load():
+        if any(get_snapshot_parts(table) for table in tables):
+            return count_channels_per_customer([get_transactions_df(TRANSACTION_COLUMNS)])
+        source_sql = deduplicated_union_sql(tables, DATASETS['transactions']['key'], ['transaction_id'] + TRANSACTION_COLUMNS)
+        return count_channels_per_customer(iter_dataframe_batches(
+            f"SELECT DISTINCT customer_id, channel FROM ({source_sql}) transactions"
+        ))
+
+    return dataset_cache.get_or_load(tables, ['channels_per_customer'], load)
+
+@traced('omnichannel.customers')
+def get_omnichannel_customers():
+    """
+    Get every customer with a lifetime value and at least one transaction channel,
+    with the number of channels used and their cohort.
+
+    Returns:
+        pd.DataFrame: customer_id, customer_segment, acquisition_channel, lifetime_value,
+            channels_used, cohort
+    """
+    with span('omnichannel.load'):
+        customers = get_customers_df(CUSTOMER_COLUMNS)
+        channel_counts = get_channels_per_customer()
      
-    summary = df.groupby('cohort')['lifetime_value'].agg(['count', 'mean', 'median'])
-    summary.columns = ['n_customers', 'mean_clv', 'median_clv']
+    with span('omnichannel.cohorts'):
+        customers = customers.drop_duplicates(subset=['customer_id'])
+        customers = customers[customers['lifetime_value'].notna()]
+         
+        df = customers.merge(channel_counts, on='customer_id', how='left')
+        df['channels_used'] = df['channels_used'].fillna(0).astype(int)
+        df = df[df['channels_used'] >= 1]
+         
+        # omnichannel vs single channel
+        df['cohort'] = np.where(df['channels_used'] >= 2, 'Omnichannel', 'Single-channel').astype(object)
+    
+    return df
+
+def get_cohort_ltv_sketches(customers=None):
+    """
+    Sketch lifetime values per cohort and segment; this is the cube's cohort_ltv_sketches table.
+
+    Args:
+        customers (pd.DataFrame): As get_omnichannel_customers() returns (the default)
+
+    Returns:
+        pd.DataFrame: cohort, customer_segment, n and sketch (see utils/quantile_sketch.py)
+    """
+    if customers is None:
+        customers = get_omnichannel_customers()
+    return sketch_table([customers], LTV_SKETCH_GROUPS, 'lifetime_value')
+
+def cohort_sketches(sketches, cohort_order=COHORT_ORDER):
+    """Merge a cohort_ltv_sketches table into one lifetime value sketch per cohort"""
+    return {cohort: merge_sketch_column(sketches[sketches['cohort'] == cohort]) for cohort in cohort_order}
+
+def _cohort_summary(sketches_by_cohort, cohort_order):
+    """Customer count, exact mean and approximate median lifetime value per cohort"""
+    rows = {
+        cohort: {'n_customers': sketch.n, 'mean_clv': sketch.mean(), 'median_clv': sketch.median()}
+        for cohort, sketch in sketches_by_cohort.items() if sketch.n
+    }
+    summary = pd.DataFrame.from_dict(rows, orient='index', columns=['n_customers', 'mean_clv', 'median_clv'])
+    summary.index.name = 'cohort'
     
     # Round mean_clv to 2 decimal places
     summary['mean_clv'] = summary['mean_clv'].round(2)
+    return summary.reindex(cohort_order)
+
+@traced('omnichannel.analysis')
+def get_omnichannel_analysis(cube=None, customers=None):
+    """
+    Analyze customer lifetime value by omnichannel vs single-channel usage.
     
-    cohort_order = ['Single-channel', 'Omnichannel']
-    summary = summary.reindex(cohort_order)
-     
+    The summary and charts are answered from the analytics cube's lifetime value
+    sketches, so medians and quartiles are approximate (see utils/quantile_sketch.py);
+    the detailed frame lists the customers themselves. Pass a cube and the matching
+    customers frame (e.g. both from the filter index) to analyze a subset instead.
+    
+    Returns:
+        tuple: (summary_df, detailed_df, bar_chart_fig, box_plot_fig)
+    """
+    if customers is None:
+        customers = get_omnichannel_customers()
+    summary, fig_bar, fig_box = get_cohort_analysis(cube)
+    return summary, customers, fig_bar, fig_box
+
+def get_cohort_analysis(cube=None):
+    """
+    The summary and charts of get_omnichannel_analysis on their own, which need only
+    the cube's cohort_ltv_sketches table and no per-customer rows.
+
+    Returns:
+        tuple: (summary_df, bar_chart_fig, box_plot_fig)
+    """
+    cohort_order = COHORT_ORDER
+    sketches = (cube or get_cube())['cohort_ltv_sketches']
+
+    with span('omnichannel.summary'):
+        sketches_by_cohort = cohort_sketches(sketches, cohort_order)
+        summary = _cohort_summary(sketches_by_cohort, cohort_order)
+
+    return summary, *_cohort_charts(summary, sketches_by_cohort, cohort_order)
+
+@traced('omnichannel.charts')
+def _cohort_charts(summary, sketches_by_cohort, cohort_order):
     fig_bar = go.Figure(data=[
         go.Bar(name='Mean CLV', x=cohort_order, y=[summary.loc[cohort, 'mean_clv'] for cohort in cohort_order]),
         go.Bar(name='Median CLV', x=cohort_order, y=[summary.loc[cohort, 'median_clv'] for cohort in cohort_order])
@@ -56,11 +238,16 @@ def get_omnichannel_analysis():
         xaxis=dict(categoryorder='array', categoryarray=cohort_order)
     )
 
-    fig_box = px.box(df, x='cohort', y='lifetime_value', title='CLV Distribution by Channel Cohort', 
-                     category_orders={'cohort': cohort_order})
+    # Draw from the sketches' quartiles, whiskers and a capped outlier sample rather than every customer
+    box_stats = sketch_box_statistics(sketches_by_cohort, 'cohort')
+    fig_box = summarized_box_figure(box_stats, title='CLV Distribution by Channel Cohort')
     fig_box.update_layout(xaxis_title='Cohort', yaxis_title='CLV', width=800, height=500)
     
-    return summary, df, fig_bar, fig_box
+    return fig_bar, fig_box
+
+# The page shows the cohort summary first and the per-customer detail once it has loaded
+register_refresh('omnichannel', get_cohort_analysis)
+register_refresh('omnichannel_customers', get_omnichannel_customers)
 
 if __name__ == "__main__":
     summary, df, fig_bar, fig_box = get_omnichannel_analysis()
@@ -0,0 +1,175 @@
+import pandas as pd
+import streamlit as st
+import threading
+from contextlib import contextmanager
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import os
+
+import tracing
+from data_handler import QueryScope, get_query_cache_stats, query_scope
+from data_refresh import refresh_status
+
+# Set SHOW_DIAGNOSTICS=0 to hide the diagnostics expander on every page
+show_diagnostics = os.getenv("SHOW_DIAGNOSTICS", "1") != "0"
+
+def render_diagnostics(page_trace):
+    """Show where the page spent its time: queries, per-stage spans and exports for monitoring"""
+    if not show_diagnostics or page_trace is None:
+        return
+
+    with st.expander("Diagnostics"):
+        queries = pd.DataFrame(page_trace.queries)
+        spans = pd.DataFrame(page_trace.spans)
+
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Page time", f"{page_trace.seconds or 0:.2f}s")
+        col2.metric("Queries", len(queries))
+        col3.metric("Rows fetched", f"{int(queries['rows'].sum()) if len(queries) else 0:,}")
+
+        disk_cache = get_query_cache_stats()
+        if disk_cache is not None:
+            st.caption(
+                f"Disk query cache (this process): {disk_cache['hits']:,} hits, {disk_cache['misses']:,} misses, "
+                f"{disk_cache['bytes_read'] / 1024 ** 2:,.1f} MiB read; {disk_cache['entries']:,} entries "
+                f"using {disk_cache['bytes'] / 1024 ** 2:,.1f} MiB on disk"
+            )
+
+        st.write("**Queries**")
+        if len(queries):
+            st.dataframe(queries[[
+                'sql_hash', 'query_id', 'span', 'execute_seconds', 'fetch_seconds',
+                'conversion_seconds', 'rows', 'bytes', 'sql'
+            ]], use_container_width=True)
+        else:
+            st.write("No queries ran; every dataset came from the cache.")
+
+        st.write("**Stages**")
+        if len(spans):
+            st.dataframe(
+                spans[['name', 'parent', 'seconds', 'thread']].sort_values('seconds', ascending=False),
+                use_container_width=True
+            )
+
+        col1, col2 = st.columns(2)
+        col1.download_button(
+            "Download trace (JSON lines)", page_trace.to_jsonl(),
+            file_name=f"{page_trace.name}.jsonl", mime="application/x-ndjson"
+        )
+        col2.download_button(
+            "Download metrics (Prometheus)", tracing.prometheus_text(),
+            file_name="metrics.prom", mime="text/plain"
+        )
+
+def render_freshness(name):
+    """Caption with when the page's data was last refreshed and how long that took"""
+    status = refresh_status(name)
+    if status['refreshed_at'] is None:
+        return
+    age_minutes = (pd.Timestamp.now(tz='UTC') - status['refreshed_at']).total_seconds() / 60
+    st.caption(
+        f"Data refreshed {age_minutes:.0f} min ago "
+        f"({status['refreshed_at'].astimezone():%Y-%m-%d %H:%M}, took {status['refresh_seconds']:.1f}s)"
+    )
+    if status['error']:
+        st.caption(f"The latest background refresh failed, showing the previous data: {status['error']}")
+
+def render_filters(key, filter_index, channel_label, channel_options, note=None):
+    """
+    Sidebar date range, segment and channel filters for a page, kept in the session under key.
+
+    Args:
+        filter_index (FilterIndex): Index answering the filters, or None while it is
+            still being built, in which case the filters are not shown yet
+        channel_options (callable): Returns the channel choices given the index
+
+    Returns:
+        dict: start, end, segments and channels for the FilterIndex queries, or None
+            while every filter is at its default and the unfiltered analysis applies
+    """
+    if filter_index is None:
+        with st.sidebar:
+            st.subheader("Filters")
+            st.caption("Filters are still loading; they appear on the next interaction once ready.")
+        return None
+
+    date_range = filter_index.date_range()
+    with st.sidebar:
+        st.subheader("Filters")
+        dates = ()
+        if date_range is not None:
+            dates = st.date_input(
+                "Date range", value=date_range, min_value=date_range[0], max_value=date_range[1], key=f"{key}_dates"
+            )
+        segments = st.multiselect("Segments", filter_index.segments, key=f"{key}_segments", placeholder="All segments")
+        channels = st.multiselect(channel_label, channel_options(filter_index), key=f"{key}_channels", placeholder="All channels")
+        if note:
+            st.caption(note)
+
+    # The picker returns a single date while the end of the range is being chosen
+    start = dates[0] if len(dates) >= 1 else None
+    end = dates[1] if len(dates) == 2 else None
+    if date_range is not None:
+        start = None if start == date_range[0] else start
+        end = None if end == date_range[1] else end
+
+    if start is None and end is None and not segments and not channels:
+        return None
+    return {'start': start, 'end': end, 'segments': segments or None, 'channels': channels or None}
+
+PAGE_SIZES = [50, 100, 500, 1000]
+
+def render_paginated_dataframe(df, key, page_size=100):
+    """
+    Show a large DataFrame one page at a time.
+
+    Only the rows on the current page are sliced out and sent to the browser; the
+    page number and page size are kept in the session under key.
+    """
+    if len(df) <= page_size:
+        st.dataframe(df, use_container_width=True)
+        return
+
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        rows_per_page = st.selectbox(
+            "Rows per page", PAGE_SIZES,
+            index=PAGE_SIZES.index(page_size) if page_size in PAGE_SIZES else 0,
+            key=f"{key}_page_size"
+        )
+    page_count = (len(df) - 1) // rows_per_page + 1
+    # A larger page size leaves fewer pages, so pull the stored page back into range
+    if st.session_state.get(f"{key}_page", 1) > page_count:
+        st.session_state[f"{key}_page"] = page_count
+    with col2:
+        page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1, key=f"{key}_page")
+
+    start = (page - 1) * rows_per_page
+    end = min(start + rows_per_page, len(df))
+    st.dataframe(df.iloc[start:end], use_container_width=True)
+    st.caption(f"Rows {start + 1:,}–{end:,} of {len(df):,} (page {page} of {page_count:,})")
+
+# Streamlit session id -> QueryScope of that session's latest run
+_session_scopes = {}
+_session_scopes_lock = threading.Lock()
+
+@contextmanager
+def supersede_previous_run():
+    """
+    Run the block's queries in a fresh scope for this Streamlit session, cancelling
+    queries still running from the session's previous run (e.g. the page the user just
+    navigated away from).
+    """
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        yield
+        return
+
+    scope = QueryScope(name=ctx.session_id)
+    with _session_scopes_lock:
+        previous = _session_scopes.get(ctx.session_id)
+        _session_scopes[ctx.session_id] = scope
+    if previous is not None:
+        previous.cancel()
+
+    with query_scope(scope):
+        yield
@@ -0,0 +1,312 @@
+"""
+KLL quantile sketches: approximate quantiles from a few KB of state.
+
+A sketch keeps a hierarchy of compactors. Level h holds values that each stand for
+2**h observations, and when a level outgrows its capacity it is sorted and every
+other value (from a random offset) moves up a level. The count, sum, minimum and
+maximum are tracked exactly, so means are exact and the 0 and 1 quantiles are the
+true extremes.
+
+Error bound: for a sketch of parameter k, the rank of a returned quantile is within
+about 2.296 / k**0.9723 of the requested one with 99% confidence (1.33% of n at the
+default k=200), and a full distribution (PMF/CDF) is within 2.446 / k**0.9433 (1.65%).
+These are the empirical KLL bounds published with Apache DataSketches, whose
+compactor layout this follows; normalized_rank_error() returns them. The bound does
+not depend on n. A sketch that never compacted (up to k observations) still holds
+every observation, and its quantiles interpolate between neighbouring values like
+numpy's and pandas' defaults, so they equal the exact ones; once it compacts, a
+quantile is a retained value within the bound. A sketch holds at most about 3k
+values, i.e. under 5 KB at k=200.
+
+Sketches are built per chunk or partition and merged; merging is associative and
+commutative up to the randomness of compaction, and the bound holds for the merged
+sketch. Compaction draws from a seeded generator, so a given sequence of updates and
+merges always produces the same sketch.
+
+Usage:
+    sketch = KllSketch()
+    for chunk in chunks:
+        sketch.merge(KllSketch.from_values(chunk['lifetime_value']))
+    sketch.quantiles([0.25, 0.5, 0.75])
+    KllSketch.from_bytes(sketch.to_bytes()).median()
+"""
+import math
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+# Accuracy/size trade-off of new sketches; see normalized_rank_error()
+DEFAULT_K = int(os.getenv("QUANTILE_SKETCH_K", 200))
+
+# Smallest capacity of any level, so the lowest levels never compact on every update
+MIN_LEVEL_CAPACITY = 8
+
+# Each level's capacity is this fraction of the one above it
+CAPACITY_RATIO = 2 / 3
+
+# Version 2 added the exact flag; version 1 sketches are read as compacted
+_HEADER = struct.Struct('<BBIIQddd')
+_HEADER_V1 = struct.Struct('<BIIQddd')
+_FORMAT_VERSION = 2
+
+def normalized_rank_error(k=DEFAULT_K, pmf=False):
+    """
+    Rank error (as a fraction of n) of a sketch with parameter k, at 99% confidence.
+
+    Args:
+        pmf (bool): The error of a whole distribution (every rank at once) rather
+            than of a single quantile or rank query
+    """
+    return 2.446 / k ** 0.9433 if pmf else 2.296 / k ** 0.9723
+
+class KllSketch:
+    """
+    Mergeable approximate quantiles of a stream of numbers.
+
+    Attributes:
+        k (int): Accuracy parameter; the rank error shrinks roughly as 1/k
+        n (int): Observations added
+        sum (float): Their exact sum
+        min, max (float): Smallest and largest observation (nan while empty)
+        exact (bool): No observation has been dropped by compaction yet
+    """
+
+    def __init__(self, k=DEFAULT_K, seed=0):
+        if k < MIN_LEVEL_CAPACITY:
+            raise ValueError(f"k must be at least {MIN_LEVEL_CAPACITY}, got {k}")
+        self.k = k
+        self.n = 0
+        self.sum = 0.0
+        self.min = math.nan
+        self.max = math.nan
+        self.exact = True
+        self._levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    @classmethod
+    def from_values(cls, values, weights=None, k=DEFAULT_K, seed=0):
+        """A sketch of values, each counted weights times (default once)"""
+        return cls(k, seed).update(values, weights)
+
+    def update(self, values, weights=None):
+        """
+        Add values (missing values are ignored), each counted weights times.
+
+        A whole batch goes in at once: values of weight w are placed on the levels of
+        w's set bits, then the levels are compacted.
+
+        Returns:
+            KllSketch: self
+        """
+        values = np.asarray(values, dtype='float64').ravel()
+        weights = np.ones(len(values), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64).ravel()
+        present = ~np.isnan(values) & (weights > 0)
+        values, weights = values[present], weights[present]
+        if len(values) == 0:
+            return self
+
+        self.n += int(weights.sum())
+        self.sum += math.fsum(values * weights)
+        self.min = float(np.fmin(self.min, values.min()))
+        self.max = float(np.fmax(self.max, values.max()))
+        for level in range(int(weights.max()).bit_length()):
+            on_level = ((weights >> level) & 1).astype(bool)
+            if on_level.any():
+                self._add_to_level(level, values[on_level])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """
+        Add everything other has seen; other is left unchanged.
+
+        Returns:
+            KllSketch: self
+        """
+        if other.n == 0:
+            return self
+        self.k = min(self.k, other.k)
+        self.n += other.n
+        self.sum += other.sum
+        self.min = float(np.fmin(self.min, other.min))
+        self.max = float(np.fmax(self.max, other.max))
+        self.exact = self.exact and other.exact
+        for level, values in enumerate(other._levels):
+            if len(values):
+                self._add_to_level(level, values)
+        self._compress()
+        return self
+
+    def quantiles(self, qs):
+        """
+        Approximate quantiles: for each q in [0, 1], a value whose rank is about q * n.
+
+        While the sketch is exact they are the exact quantiles, linearly interpolated
+        like np.percentile and pandas (so the median of an even count is the mean of
+        the middle two).
+
+        Returns:
+            np.ndarray: One value per q (nan while the sketch is empty)
+        """
+        qs = np.asarray(qs, dtype='float64')
+        if self.n == 0:
+            return np.full(qs.shape, np.nan)
+        values, cumulative_weights = self._sorted_view()
+        if self.exact:
+            return _interpolated_quantiles(values, cumulative_weights, np.clip(qs, 0, 1))
+        positions = np.searchsorted(cumulative_weights, qs * self.n, side='left')
+        result = values[np.minimum(positions, len(values) - 1)]
+        return np.where(qs <= 0, self.min, np.where(qs >= 1, self.max, result))
+
+    def quantile(self, q):
+        return float(self.quantiles([q])[0])
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def rank(self, value):
+        """Approximate fraction of observations less than or equal to value"""
+        if self.n == 0:
+            return math.nan
+        values, cumulative_weights = self._sorted_view()
+        position = np.searchsorted(values, value, side='right')
+        return float(cumulative_weights[position - 1] / self.n) if position else 0.0
+
+    def weighted_values(self):
+        """
+        The retained values and the number of observations each stands for.
+
+        Returns:
+            tuple: (sorted values, int64 weights summing to n)
+        """
+        values = np.concatenate(self._levels)
+        weights = np.concatenate([np.full(len(level), 1 << height, dtype=np.int64) for height, level in enumerate(self._levels)])
+        order = np.argsort(values, kind='stable')
+        return values[order], weights[order]
+
+    def mean(self):
+        return self.sum / self.n if self.n else math.nan
+
+    def to_bytes(self):
+        """Serialize the sketch, e.g. to store it in a Parquet binary column"""
+        sizes = np.array([len(level) for level in self._levels], dtype='<u4')
+        header = _HEADER.pack(_FORMAT_VERSION, self.exact, self.k, len(self._levels), self.n, self.sum, self.min, self.max)
+        return header + sizes.tobytes() + np.concatenate(self._levels).astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, seed=0):
+        version = data[0]
+        if version == _FORMAT_VERSION:
+            _, exact, k, n_levels, n, total, minimum, maximum = _HEADER.unpack_from(data)
+            header_size = _HEADER.size
+        elif version == 1:
+            _, k, n_levels, n, total, minimum, maximum = _HEADER_V1.unpack_from(data)
+            exact, header_size = False, _HEADER_V1.size
+        else:
+            raise ValueError(f"Unsupported sketch format version {version}")
+        sketch = cls(k, seed)
+        sketch.n, sketch.sum, sketch.min, sketch.max = n, total, minimum, maximum
+        sketch.exact = bool(exact)
+        sizes = np.frombuffer(data, dtype='<u4', count=n_levels, offset=header_size)
+        values = np.frombuffer(data, dtype='<f8', offset=header_size + sizes.nbytes)
+        boundaries = np.cumsum(sizes)[:-1]
+        sketch._levels = [level.copy() for level in np.split(values, boundaries)]
+        return sketch
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return f"KllSketch(k={self.k}, n={self.n}, retained={sum(len(level) for level in self._levels)})"
+
+    def _add_to_level(self, level, values):
+        while len(self._levels) <= level:
+            self._levels.append(np.empty(0))
+        self._levels[level] = np.concatenate([self._levels[level], values])
+
+    def _capacity(self, level):
+        depth = len(self._levels) - level - 1
+        return max(MIN_LEVEL_CAPACITY, math.ceil(self.k * CAPACITY_RATIO ** depth))
+
+    def _compress(self):
+        """Compact the lowest over-capacity level until every level fits"""
+        while True:
+            for level, values in enumerate(self._levels):
+                if len(values) > self._capacity(level):
+                    self._compact(level)
+                    break
+            else:
+                return
+
+    def _compact(self, level):
+        self.exact = False
+        values = np.sort(self._levels[level])
+        # An odd value out stays behind so the promoted pairs keep the total weight exact
+        held_back = len(values) % 2
+        offset = int(self._rng.integers(2))
+        self._levels[level] = values[:held_back]
+        self._add_to_level(level + 1, values[held_back + offset::2])
+
+    def _sorted_view(self):
+        values, weights = self.weighted_values()
+        return values, np.cumsum(weights)
+
+def _interpolated_quantiles(values, cumulative_weights, qs):
+    """
+    np.percentile(np.repeat(values, weights), qs * 100) with the default linear
+    method, from sorted values and the running total of their weights
+    """
+    last = cumulative_weights[-1] - 1
+    virtual_index = last * qs
+    previous_index = np.floor(virtual_index)
+    gamma = virtual_index - previous_index
+    below = values[np.searchsorted(cumulative_weights, previous_index, side='right')]
+    above = values[np.searchsorted(cumulative_weights, np.minimum(previous_index + 1, last), side='right')]
+    # Same interpolation as numpy, which measures from the nearer neighbour
+    difference = above - below
+    return np.where(gamma >= 0.5, above - difference * (1 - gamma), below + difference * gamma)
+
+def merge_sketches(sketches, k=DEFAULT_K):
+    """Merge sketches into a new sketch, leaving them unchanged"""
+    merged = KllSketch(k)
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
+
+def sketch_table(chunks, group_columns, value_column, k=DEFAULT_K):
+    """
+    One serialized sketch of value_column per group, built chunk by chunk.
+
+    Each chunk is sketched per group and merged into the running sketches, so only
+    one chunk and the sketches are held at a time. Missing group labels form groups
+    of their own.
+
+    Args:
+        chunks (iterable): DataFrames with the group and value columns
+        group_columns (list): Columns identifying a group, e.g. ['cohort', 'customer_segment']
+        value_column (str): Numeric column to sketch
+
+    Returns:
+        pd.DataFrame: The group columns, n and sketch (bytes from KllSketch.to_bytes)
+    """
+    sketches = {}
+    for chunk in chunks:
+        for key, rows in chunk.groupby(group_columns, dropna=False, observed=True, sort=False):
+            key = tuple(None if pd.isna(part) else part for part in key)
+            chunk_sketch = KllSketch.from_values(rows[value_column], k=k)
+            if key in sketches:
+                sketches[key].merge(chunk_sketch)
+            else:
+                sketches[key] = chunk_sketch
+
+    keys = sorted(sketches, key=lambda key: tuple((part is None, str(part)) for part in key))
+    table = pd.DataFrame(keys, columns=group_columns, dtype=object)
+    table['n'] = np.array([sketches[key].n for key in keys], dtype=np.int64)
+    table['sketch'] = [sketches[key].to_bytes() for key in keys]
+    return table
+
+def merge_sketch_column(table):
+    """Merge a sketch_table()'s serialized sketches (e.g. a slice of it) into one sketch"""
+    return merge_sketches(KllSketch.from_bytes(data) for data in table['sketch'])
@@ -1,115 +1,320 @@
 
+import numpy as np
 import pandas as pd
-import sys
+import plotly.graph_objects as go
+import json
 import os
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_handler import get_datasets, require_columns
+from data_refresh import register_refresh
+from tracing import span, traced
+from utils.analytics_cube import get_cube
 
-from data_handler import fetch_data_as_dataframe_standardized
+CUSTOMER_COLUMNS = ['customer_id', 'acquisition_channel']
+TOUCHPOINT_COLUMNS = ['touchpoint_id', 'customer_id', 'channel', 'converted_flag']
+SPEND_COLUMNS = ['spend_id', 'channel', 'spend_amount']
 
-def get_final_df():
-    try:
-        customers = fetch_data_as_dataframe_standardized("SELECT customer_id, acquisition_channel FROM CUSTOMERS")
-        customers_extra = fetch_data_as_dataframe_standardized("SELECT customer_id, acquisition_channel FROM CUSTOMERS_EXTRA")
-        combined_customers = pd.concat([customers, customers_extra], ignore_index=True)
-        combined_customers = combined_customers.drop_duplicates(subset=['customer_id'], keep='first')
-        
-        touchpoints = fetch_data_as_dataframe_standardized("SELECT touchpoint_id, customer_id, channel, converted_flag FROM CUSTOMER_TOUCHPOINTS")
-        touchpoints_extra = fetch_data_as_dataframe_standardized("SELECT touchpoint_id, customer_id, channel, converted_flag FROM CUSTOMER_TOUCHPOINTS_EXTRA")
-        combined_touchpoints = pd.concat([touchpoints, touchpoints_extra], ignore_index=True)
-        combined_touchpoints = combined_touchpoints.drop_duplicates(subset=['touchpoint_id'], keep='first')
-        
-        spend = fetch_data_as_dataframe_standardized("SELECT spend_id, channel, spend_amount FROM MARKETING_SPEND")
-        spend = spend.drop_duplicates(subset='spend_id')
-         
-        acquisition_summary = combined_customers['acquisition_channel'].value_counts().reset_index()
-        acquisition_summary.columns = ['channel', 'customers_acquired']
-         
-        spend_summary = spend.groupby('channel', as_index=False).agg(total_direct_spend=('spend_amount', 'sum'))
-        spend_summary.columns = ['channel', 'total_direct_spend']
-
-        session_summary = combined_touchpoints.query("converted_flag == True")['channel'].value_counts().reset_index()
-        session_summary.columns = ['channel', 'count']
-        session_summary['count'] = session_summary['count'].astype(int)
-         
-        # Map acquisition channels to their corresponding transaction channels
-        acquisition_to_touchpoint_mapping = {
-            'Direct': ['Direct'],
-            'Email': ['Email'], 
-            'Facebook': ['Facebook'],
-            'Google': ['Google'],
-            'Instagram': ['Instagram'],
-            'TikTok': ['TikTok'],
-            'Referral': ['Walk-in', 'Direct'],  # Referral customers often convert in-store or direct
-            'Social Media': ['Instagram', 'Facebook', 'TikTok', 'Walk-in']  # Social media maps to social platforms + store
-        }
-        
-        # Calculate conversions by tracking acquired customers through any of their mapped channels
-        converted_customer_summary = []
-        
-        for acq_channel, touchpoint_channels in acquisition_to_touchpoint_mapping.items():
-            acquired_customer_ids = combined_customers[
-                combined_customers['acquisition_channel'] == acq_channel
-            ]['customer_id'].tolist()
-            
-            if acquired_customer_ids:
-                converted_count = combined_touchpoints[
-                    (combined_touchpoints['customer_id'].isin(acquired_customer_ids)) &
-                    (combined_touchpoints['channel'].isin(touchpoint_channels)) &
-                    (combined_touchpoints['converted_flag'] == True)
-                ]['customer_id'].nunique()
-            else:
-                converted_count = 0
-                
-            converted_customer_summary.append({
-                'channel': acq_channel,
-                'converted_customers': converted_count
-            })
-        
-        converted_customer_summary = pd.DataFrame(converted_customer_summary)
-
-        # allocate indirect cost proportionally
-        total_indirect = 10000
-        session_summary['indirect_cost'] = (session_summary['count'] / session_summary['count'].sum()) * total_indirect
-        
-        merged_df = (
-            acquisition_summary
-            .merge(spend_summary, on='channel', how='outer')
-            .merge(session_summary[['channel', 'indirect_cost']], on='channel', how='left')
-            .merge(converted_customer_summary, on='channel', how='left')
-            .fillna({'total_direct_spend': 0, 'indirect_cost': 0, 'converted_customers': 0})
+require_columns('customers', CUSTOMER_COLUMNS)
+require_columns('touchpoints', TOUCHPOINT_COLUMNS)
+require_columns('marketing_spend', SPEND_COLUMNS)
+
+# Channel mapping, indirect cost total and per-channel indirect cost details
+CAC_CONFIG_PATH = os.getenv(
+    "CAC_CONFIG_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "true_cac.json")
+)
+
+def load_cac_config(path=None):
+    """Load the true CAC configuration (see config/true_cac.json)"""
+    with open(path or CAC_CONFIG_PATH) as config_file:
+        return json.load(config_file)
+
+@traced('true_cac.converted_customers')
+def get_converted_customer_counts(customers, touchpoints, acquisition_to_touchpoint_mapping):
+    """
+    Count converted customers per acquisition channel in a single join.
+
+    A customer counts as converted for their acquisition channel when they have a
+    converted touchpoint on any of the touchpoint channels mapped to it.
+
+    Returns:
+        pd.DataFrame: channel, converted_customers for every mapped acquisition channel
+    """
+    mapping = pd.DataFrame(
+        [
+            (acquisition_channel, touchpoint_channel)
+            for acquisition_channel, touchpoint_channels in acquisition_to_touchpoint_mapping.items()
+            for touchpoint_channel in touchpoint_channels
+        ],
+        columns=['acquisition_channel', 'channel']
+    )
+
+    converted_touches = touchpoints.loc[touchpoints['converted_flag'] == True, ['customer_id', 'channel']].drop_duplicates()
+    converted_touches = (
+        converted_touches
+        .merge(customers[['customer_id', 'acquisition_channel']], on='customer_id')
+        .merge(mapping, on=['acquisition_channel', 'channel'])
+    )
+    converted_counts = (
+        converted_touches.groupby('acquisition_channel', observed=True)['customer_id'].nunique()
+        .reindex(list(acquisition_to_touchpoint_mapping), fill_value=0)
+    )
+
+    return pd.DataFrame({
+        'channel': converted_counts.index,
+        'converted_customers': converted_counts.to_numpy()
+    })
+
+# Touchpoint channels a conversion set can hold; each is one bit of an int64 mask
+MAX_CONVERSION_CHANNELS = 63
+
+def conversion_sets_frame(acquisition_channels, masks, channels):
+    """
+    Count customers by acquisition channel and converted-channel bitmask.
+
+    Args:
+        acquisition_channels (array): Each converted customer's acquisition channel
+        masks (array): Each converted customer's int64 mask; bit i is channels[i]
+
+    Returns:
+        pd.DataFrame: acquisition_channel, converted_channels (list), customers
+    """
+    if len(channels) > MAX_CONVERSION_CHANNELS:
+        raise ValueError(f"Conversion sets support at most {MAX_CONVERSION_CHANNELS} touchpoint channels, got {len(channels)}")
+    counts = (
+        pd.DataFrame({'acquisition_channel': acquisition_channels, 'mask': masks})
+        .groupby(['acquisition_channel', 'mask'], observed=True).size()
+        .reset_index(name='customers')
+    )
+    return pd.DataFrame({
+        'acquisition_channel': counts['acquisition_channel'].astype(object),
+        'converted_channels': [
+            [channel for bit, channel in enumerate(channels) if mask >> bit & 1] for mask in counts['mask']
+        ],
+        'customers': counts['customers'].astype(np.int64),
+    })
+
+@traced('true_cac.conversion_sets')
+def get_conversion_sets(customers, touchpoints):
+    """
+    Count customers by acquisition channel and the set of touchpoint channels they converted on.
+
+    The converted customer counts for any acquisition-to-touchpoint mapping follow
+    from this table (see utils/cac_scenarios.py) without another pass over the
+    touchpoints.
+
+    Returns:
+        pd.DataFrame: acquisition_channel, converted_channels (sorted list), customers
+    """
+    converted_touches = (
+        touchpoints.loc[touchpoints['converted_flag'] == True, ['customer_id', 'channel']]
+        .astype({'channel': object})
+        .drop_duplicates()
+        .merge(customers[['customer_id', 'acquisition_channel']], on='customer_id')
+        .dropna(subset=['channel', 'acquisition_channel'])
+    )
+    channels = sorted(converted_touches['channel'].unique())
+    bits = pd.Categorical(converted_touches['channel'], categories=channels).codes.astype(np.int64)
+    # (customer, channel) pairs are distinct, so summing the bits ORs them
+    masks = (
+        converted_touches.assign(mask=np.left_shift(1, bits))
+        .groupby(['customer_id', 'acquisition_channel'], observed=True)['mask'].sum()
+        .reset_index()
+    )
+    return conversion_sets_frame(masks['acquisition_channel'].to_numpy(), masks['mask'].to_numpy(), channels)
+
+def _observed_value_counts(series):
+    """value_counts() as a frame with plain string values, leaving out unused categories"""
+    counts = series.value_counts()
+    counts = counts[counts > 0]
+    counts.index = counts.index.astype(object)
+    return counts.reset_index()
+
+@traced('true_cac.inputs')
+def get_cac_inputs(customers, touchpoints, spend, config=None):
+    """
+    Aggregate loaded frames into the per-channel counts and sums true CAC is built from.
+
+    Args:
+        customers (pd.DataFrame): customer_id, acquisition_channel (deduplicated)
+        touchpoints (pd.DataFrame): customer_id, channel, converted_flag (deduplicated)
+        spend (pd.DataFrame): channel, spend_amount (deduplicated)
+        config (dict): CAC configuration; defaults to load_cac_config()
+
+    Returns:
+        dict: acquisition, spend, sessions and converted summaries, one row per channel,
+            and the conversion_sets table
+    """
+    config = config or load_cac_config()
+
+    acquisition_summary = _observed_value_counts(customers['acquisition_channel'])
+    acquisition_summary.columns = ['channel', 'customers_acquired']
+     
+    spend_summary = spend.groupby('channel', as_index=False, observed=True).agg(total_direct_spend=('spend_amount', 'sum'))
+    spend_summary.columns = ['channel', 'total_direct_spend']
+    spend_summary['channel'] = spend_summary['channel'].astype(object)
+
+    session_summary = _observed_value_counts(touchpoints.loc[touchpoints['converted_flag'] == True, 'channel'])
+    session_summary.columns = ['channel', 'count']
+    session_summary['count'] = session_summary['count'].astype(int)
+    
+    converted_customer_summary = get_converted_customer_counts(
+        customers, touchpoints, config['acquisition_to_touchpoint_mapping']
+    )
+
+    return {
+        'acquisition': acquisition_summary,
+        'spend': spend_summary,
+        'sessions': session_summary,
+        'converted': converted_customer_summary,
+        'conversion_sets': get_conversion_sets(customers, touchpoints),
+    }
+
+@traced('true_cac.compute')
+def assemble_true_cac(inputs, config=None):
+    """
+    Compute the true customer acquisition cost per channel from get_cac_inputs() output.
+
+    Returns:
+        pd.DataFrame: One row per channel with acquisition counts, cost breakdown and true_cac
+    """
+    config = config or load_cac_config()
+    acquisition_summary = inputs['acquisition']
+    spend_summary = inputs['spend']
+    session_summary = inputs['sessions'].copy()
+    converted_customer_summary = inputs['converted']
+
+    # allocate indirect cost proportionally
+    total_indirect = config['total_indirect_cost']
+    session_summary['indirect_cost'] = (session_summary['count'] / session_summary['count'].sum()) * total_indirect
+    
+    merged_df = (
+        acquisition_summary
+        .merge(spend_summary, on='channel', how='outer')
+        .merge(session_summary[['channel', 'indirect_cost']], on='channel', how='left')
+        .merge(converted_customer_summary, on='channel', how='left')
+        .fillna({'total_direct_spend': 0, 'indirect_cost': 0, 'converted_customers': 0})
+    )
+    
+    # detailed indirect costs
+    indirect_details = pd.DataFrame.from_dict(config['indirect_cost_details'], orient='index')
+    indirect_details = indirect_details.rename_axis('channel').reset_index()
+
+    # convert all cost columns to float before assigning final costs
+    cost_columns = ['total_direct_spend', 'indirect_cost', 'staff_cost', 'technology_cost', 'returns_processing_cost']
+    for col in cost_columns:
+        if col in merged_df.columns:
+            merged_df[col] = merged_df[col].astype(float)
+
+    # merge and calculate final costs
+    final_df = (
+        merged_df
+        .merge(indirect_details, on='channel', how='left')
+        .fillna({'staff_cost': 0, 'technology_cost': 0, 'returns_processing_cost': 0})
+        .assign(
+            true_total_cost=lambda df: df['total_direct_spend'] + df['indirect_cost'] + df['staff_cost'] + df['technology_cost'] + df['returns_processing_cost'],
+            true_cac=lambda df: df['true_total_cost'].where(df['converted_customers'] == 0, df['true_total_cost'] / df['converted_customers'])
         )
-        
-        # detailed indirect costs
-        indirect_details = pd.DataFrame({
-            'channel': ['Direct', 'Email', 'Facebook', 'Google', 'Instagram', 'Referral', 'Social Media', 'TikTok'],
-            'staff_cost': [800, 400, 1200, 1800, 1500, 1000, 1100, 1000],
-            'technology_cost': [700, 600, 1000, 1500, 1400, 800, 900, 1200],
-            'returns_processing_cost': [500, 300, 800, 1000, 900, 600, 700, 1100]
+    )
+    return final_df
+
+def compute_true_cac(customers, touchpoints, spend, config=None):
+    """Compute the true customer acquisition cost per channel from loaded frames"""
+    return assemble_true_cac(get_cac_inputs(customers, touchpoints, spend, config), config)
+
+def fetch_cac_inputs():
+    """Load the raw datasets and aggregate them into the CAC inputs (see analytics_cube)"""
+    # The loaders fetch the base and _EXTRA tables concurrently and keep the first row per id
+    with span('true_cac.load'):
+        frames = get_datasets({
+            'customers': CUSTOMER_COLUMNS,
+            'touchpoints': TOUCHPOINT_COLUMNS,
+            'marketing_spend': SPEND_COLUMNS,
         })
+    return get_cac_inputs(frames['customers'], frames['touchpoints'], frames['marketing_spend'])
+
+@traced('true_cac.analysis')
+def build_final_df(cube=None, attribution=None, credits=None):
+    """
+    True CAC per channel; raises if it cannot be computed.
 
-        # convert all cost columns to float before assigning final costs
-        cost_columns = ['total_direct_spend', 'indirect_cost', 'staff_cost', 'technology_cost', 'returns_processing_cost']
-        for col in cost_columns:
-            if col in merged_df.columns:
-                merged_df[col] = merged_df[col].astype(float)
-
-        # merge and calculate final costs
-        final_df = (
-            merged_df
-            .merge(indirect_details, on='channel', how='left')
-            .fillna({'staff_cost': 0, 'technology_cost': 0, 'returns_processing_cost': 0})
-            .assign(
-                true_total_cost=lambda df: df['total_direct_spend'] + df['indirect_cost'] + df['staff_cost'] + df['technology_cost'] + df['returns_processing_cost'],
-                true_cac=lambda df: df.apply(lambda row: row['true_total_cost'] if row['converted_customers'] == 0 else row['true_total_cost'] / row['converted_customers'], axis=1)
-            )
+    Args:
+        cube (dict): Analytics cube to read the inputs from (default: the current one)
+        attribution (str): Attribution model (see utils/attribution.py) whose credits
+            replace the converted customer counts; default counts every customer with
+            a converted touchpoint on a mapped channel once
+        credits (pd.DataFrame): Attribution credits (default: the current ones)
+    """
+    # Counts and sums come from the analytics cube, built once per data refresh,
+    # unless a filtered cube is passed in
+    cube = cube or get_cube()
+    inputs = {name: cube[f"cac_{name}"] for name in ['acquisition', 'spend', 'sessions', 'converted']}
+    if attribution is not None:
+        from utils.attribution import attributed_converted_counts, get_attribution_credits
+        credits = credits if credits is not None else get_attribution_credits()
+        inputs['converted'] = attributed_converted_counts(
+            credits, attribution, load_cac_config()['acquisition_to_touchpoint_mapping']
         )
-        return final_df
-    
+    return assemble_true_cac(inputs)
+
+def get_final_df(cube=None, attribution=None, credits=None):
+    """build_final_df(), or None (with the error printed) if it fails"""
+    try:
+        return build_final_df(cube, attribution, credits)
     except Exception as e:
         print(f"Error in get_final_df: {e}")
         return None
 
+# Components stacked in the cost breakdown chart, bottom to top
+COST_COMPONENTS = [
+    ('total_direct_spend', 'Direct Spend'),
+    ('staff_cost', 'Staff Cost'),
+    ('technology_cost', 'Technology Cost'),
+    ('returns_processing_cost', 'Returns Processing'),
+    ('indirect_cost', 'Indirect Cost'),
+]
+
+def get_cac_figures(final_df):
+    """
+    Build the True CAC charts for a get_final_df result.
+
+    Returns:
+        dict: cost_breakdown (stacked cost components), true_cac and customers_acquired
+            bar charts by channel
+    """
+    import plotly.express as px
+
+    cost_breakdown_fig = go.Figure()
+    for column, name in COST_COMPONENTS:
+        cost_breakdown_fig.add_trace(go.Bar(name=name, x=final_df['channel'], y=final_df[column]))
+    cost_breakdown_fig.update_layout(
+        barmode='stack',
+        xaxis_title='Channel',
+        yaxis_title='Cost ($)',
+        height=500
+    )
+
+    cac_fig = px.bar(
+        final_df,
+        x='channel',
+        y='true_cac',
+        labels={'true_cac': 'True CAC ($)', 'channel': 'Channel'}
+    )
+    cac_fig.update_layout(height=400)
+
+    customers_fig = px.bar(
+        final_df,
+        x='channel',
+        y='customers_acquired',
+        labels={'customers_acquired': 'Customers', 'channel': 'Channel'}
+    )
+    customers_fig.update_layout(height=400)
+
+    return {'cost_breakdown': cost_breakdown_fig, 'true_cac': cac_fig, 'customers_acquired': customers_fig}
+
+# Refreshed with the raising variant, so a failed refresh keeps the previous result
+register_refresh('true_cac', build_final_df)
+
 # For testing
 if __name__ == "__main__":
     try: